@@ -1,3 +1,5 @@
+from typing import List
+
 from pydantic_settings import BaseSettings
 
 
@@ -6,5 +8,136 @@ class AppConfig(BaseSettings):
     ALGORITHM: str = "HS256"
     ACCESS_TOKEN_EXPIRE_MINUTES: int = 30
 
+    DATABASE_URL: str = "sqlite:///./shopify_clone.db"
+    # Serve the async handlers from an AsyncSession instead of a Session.
+    # Use postgresql+asyncpg://... in production.
+    DATABASE_ASYNC: bool = False
+    ASYNC_DATABASE_URL: str = "sqlite+aiosqlite:///./shopify_clone.db"
+
+    # Create tables and apply migrations when the app starts. Turn off to
+    # run `python -m migrations upgrade` once per deploy instead.
+    SCHEMA_UPGRADE_ON_STARTUP: bool = True
+
+    # Read replicas of DATABASE_URL serving the read-only endpoints, picked
+    # "round_robin" or by "least_connections". A client (token subject, or
+    # address) that commits a write reads from the primary for the next
+    # READ_YOUR_WRITES_SECONDS; this is tracked per process, so keep it
+    # above the replication lag. Only sync sessions use replicas.
+    DATABASE_REPLICA_URLS: List[str] = []
+    DB_REPLICA_SELECTION: str = "round_robin"
+    READ_YOUR_WRITES_SECONDS: float = 5.0
+    READ_YOUR_WRITES_CLIENTS: int = 100000
+
+    # Shard databases for carts and orders, placed by a hash of the user id;
+    # everything else stays on DATABASE_URL. Users being moved between
+    # shards are looked up in a directory cached for
+    # SHARD_DIRECTORY_CACHE_SECONDS. Requires DATABASE_ASYNC off; see
+    # sharding.py.
+    SHARD_URLS: List[str] = []
+    SHARD_DIRECTORY_CACHE_SECONDS: float = 1.0
+    SHARD_DIRECTORY_CACHE_SIZE: int = 100000
+
+    # Connection pool
+    DB_POOL_SIZE: int = 5
+    DB_MAX_OVERFLOW: int = 10
+    DB_POOL_TIMEOUT: int = 30
+    DB_POOL_PRE_PING: bool = True
+    DB_POOL_RECYCLE: int = 1800
+
+    # Pragmas applied to every new SQLite connection
+    SQLITE_JOURNAL_MODE: str = "WAL"
+    SQLITE_SYNCHRONOUS: str = "NORMAL"
+    SQLITE_BUSY_TIMEOUT_MS: int = 5000
+    SQLITE_MMAP_SIZE: int = 256 * 1024 * 1024
+    # Negative values are in KiB
+    SQLITE_CACHE_SIZE: int = -64000
+
+    # Per-route latency and SQL metrics, served on /metrics. Requests slower
+    # than SLOW_REQUEST_SECONDS (0 disables) are logged with their slowest
+    # statements, and for SLOW_REQUEST_PLAN_SAMPLE_RATE of them, their plans.
+    METRICS_ENABLED: bool = True
+    METRICS_SLOWEST_STATEMENTS: int = 5
+    SLOW_REQUEST_SECONDS: float = 0.0
+    SLOW_REQUEST_PLAN_SAMPLE_RATE: float = 0.1
+
+    # Sampling profiler, switched at runtime through PUT /admin/profile.
+    # While a sampled request is in flight, thread stacks are taken every
+    # PROFILER_INTERVAL_SECONDS; at most PROFILER_MAX_STACKS distinct
+    # stacks are kept until cleared.
+    PROFILER_ENABLED: bool = False
+    PROFILER_SAMPLE_RATE: float = 0.01
+    PROFILER_INTERVAL_SECONDS: float = 0.005
+    PROFILER_MAX_STACKS: int = 10000
+
+    # Authenticated user cache
+    USER_CACHE_SIZE: int = 10000
+    USER_CACHE_TTL_SECONDS: int = 60
+
+    # Verified JWT cache. Revocations are kept until their token expires;
+    # revoking more unexpired tokens than TOKEN_REVOCATION_LIST_SIZE fails.
+    TOKEN_CACHE_SIZE: int = 10000
+    TOKEN_REVOCATION_LIST_SIZE: int = 100000
+
+    # Catalog response cache: "local" (in-process LRU), "redis" or "none"
+    CATALOG_CACHE_BACKEND: str = "local"
+    CATALOG_CACHE_URL: str = "redis://localhost:6379/0"
+    CATALOG_CACHE_SIZE: int = 10000
+    CATALOG_CACHE_TTL_SECONDS: int = 300
+
+    # Bulk catalog import/export. Only the first CATALOG_IMPORT_MAX_ERRORS
+    # row errors are returned; the rest are only counted.
+    CATALOG_IMPORT_BATCH_SIZE: int = 5000
+    CATALOG_IMPORT_MAX_ERRORS: int = 1000
+    CATALOG_EXPORT_CHUNK_SIZE: int = 1000
+
+    # Full-text search ranks every match by default. A positive value ranks
+    # only that many of the newest matches: older ones aren't returned, and
+    # offsets past it are rejected.
+    SEARCH_MAX_CANDIDATES: int = 0
+
+    # bcrypt worker pool: "thread", "process" or "inline" (on the event loop).
+    # 0 workers means one per CPU, minus one left for the event loop.
+    PASSWORD_HASH_EXECUTOR: str = "thread"
+    PASSWORD_HASH_WORKERS: int = 0
+    PASSWORD_HASH_QUEUE_DEPTH: int = 64
+    PASSWORD_HASH_NICENESS: int = 0
+
+    # Cart storage: "sql" (the carts tables), "memory" (this process only)
+    # or "redis". memory and redis carts expire after CART_TTL_SECONDS
+    # without a change and are only written to SQL, as an order, at checkout.
+    CART_STORE: str = "sql"
+    CART_STORE_URL: str = "redis://localhost:6379/1"
+    CART_STORE_SIZE: int = 100000
+    CART_TTL_SECONDS: int = 7 * 24 * 3600
+    # Largest accepted POST /cart/cart/items/batch
+    CART_BATCH_MAX_CHANGES: int = 100
+
+    # Stock held for a pending checkout is returned after this long
+    RESERVATION_TTL_SECONDS: int = 15 * 60
+    RESERVATION_SWEEP_INTERVAL_SECONDS: int = 60
+
+    # Stripe. Webhook events are acknowledged once recorded and processed by
+    # a pool of workers; failures are retried with exponential backoff, and
+    # a claimed event whose worker died is retried after the lease expires.
+    STRIPE_API_KEY: str = "your_stripe_secret_key"
+    STRIPE_API_BASE: str = "https://api.stripe.com"
+    STRIPE_TIMEOUT_SECONDS: float = 10.0
+    STRIPE_MAX_CONNECTIONS: int = 100
+    # Fail fast for STRIPE_BREAKER_RESET_SECONDS after this many failures
+    STRIPE_BREAKER_FAILURES: int = 5
+    STRIPE_BREAKER_RESET_SECONDS: float = 30.0
+    STRIPE_WEBHOOK_SECRET: str = "your_stripe_webhook_secret"
+    STRIPE_WEBHOOK_WORKERS: int = 4
+    STRIPE_WEBHOOK_MAX_ATTEMPTS: int = 8
+    STRIPE_WEBHOOK_BACKOFF_SECONDS: float = 1.0
+    STRIPE_WEBHOOK_BACKOFF_MAX_SECONDS: float = 300.0
+    STRIPE_WEBHOOK_LEASE_SECONDS: int = 60
+    STRIPE_WEBHOOK_POLL_SECONDS: float = 1.0
+
+    # Checkout payment gateway: "stripe", or "fake" (in-process, for tests
+    # and benchmarks) answering after FAKE_GATEWAY_LATENCY_SECONDS
+    PAYMENT_GATEWAY: str = "stripe"
+    FAKE_GATEWAY_LATENCY_SECONDS: float = 0.0
+
 
 app_config = AppConfig()
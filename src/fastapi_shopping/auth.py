@@ -1,20 +1,37 @@
 from app.config import app_config
-from db import get_db
+from cache import TTLCache
+from db import get_session, run_db
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
-from jose import JWTError, jwt
 from models import User
 from sqlalchemy.orm import Session
-
-# These should be in your environment variables
+from tokens import InvalidTokenError, decode_access_token
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
-SECRET_KEY = app_config.SECRET_KEY
-ALGORITHM = app_config.ALGORITHM
+
+# Authenticated users keyed by token subject. Entries never outlive the token
+# that loaded them and are capped at USER_CACHE_TTL_SECONDS so changes made by
+# other workers are picked up.
+user_cache = TTLCache(
+    maxsize=app_config.USER_CACHE_SIZE, ttl=app_config.USER_CACHE_TTL_SECONDS
+)
+
+
+def invalidate_user(email: str):
+    user_cache.invalidate(email)
+
+
+def _load_user(db: Session, email: str):
+    UserQ = User.__sqlmodel__
+    user = db.query(UserQ).filter(UserQ.email == email).first()
+    if user is None:
+        return None
+    # Return a detached copy so it stays usable after this session closes
+    return UserQ(**user.model_dump())
 
 
 async def get_current_user(
-    token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)
+    token: str = Depends(oauth2_scheme), db: Session = Depends(get_session)
 ) -> User:
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
@@ -24,20 +41,24 @@ async def get_current_user(
 
     try:
         # Decode JWT token
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = decode_access_token(token)
         email: str = payload.get("sub")
         if email is None:
             raise credentials_exception
 
-    except JWTError:
+    except InvalidTokenError:
         raise credentials_exception
 
+    user = user_cache.get(email)
+    if user is not None:
+        return user
+
     # Get user from database
-    UserQ = User.__sqlmodel__
-    user = db.query(UserQ).filter(UserQ.email == email).first()
+    user = await run_db(db, _load_user, email)
     if user is None:
         raise credentials_exception
 
+    user_cache.set(email, user, expires_at=payload.get("exp"))
     return user
 
 
@@ -0,0 +1,196 @@
+"""Shared helpers for the benchmark scripts in this directory."""
+
+import hashlib
+import hmac
+import os
+import random
+import subprocess
+import time
+from typing import Dict, List
+
+from app.config import app_config
+from db import create_db_engine, get_async_db, get_db
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from sqlalchemy.orm import sessionmaker
+from sqlmodel import SQLModel
+
+BENCH_DATABASE_URL = os.environ.get("BENCH_DATABASE_URL", "sqlite:///./bench.db")
+
+
+def setup_database(url: str = BENCH_DATABASE_URL, reset: bool = True):
+    """
+    Create a fresh schema at ``url`` (or keep the existing data if ``reset``
+    is False) and point the app's session dependencies at it. The async
+    dependency is overridden too when DATABASE_ASYNC is set.
+    """
+    from main import app
+
+    engine = create_db_engine(url)
+    if reset:
+        SQLModel.metadata.drop_all(engine)
+    SQLModel.metadata.create_all(engine)
+    SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+    def override_get_db():
+        db = SessionLocal()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    app.dependency_overrides[get_db] = override_get_db
+
+    if app_config.DATABASE_ASYNC:
+        async_url = url.replace("sqlite://", "sqlite+aiosqlite://", 1)
+        AsyncSessionLocal = async_sessionmaker(
+            bind=create_db_engine(async_url, is_async=True),
+            autoflush=False,
+            expire_on_commit=False,
+        )
+
+        async def override_get_async_db():
+            async with AsyncSessionLocal() as db:
+                yield db
+
+        app.dependency_overrides[get_async_db] = override_get_async_db
+    return app, SessionLocal
+
+
+def seed_catalog(SessionLocal, products: int = 100, categories: int = 10):
+    from models import Category, Product
+
+    with SessionLocal() as db:
+        CategoryQ = Category.__sqlmodel__
+        db.add_all(
+            [
+                CategoryQ(name=f"Category {i}", description=f"Category {i}")
+                for i in range(categories)
+            ]
+        )
+        db.commit()
+        category_ids = [c.id for c in db.query(CategoryQ).all()]
+        ProductQ = Product.__sqlmodel__
+        db.add_all(
+            [
+                ProductQ(
+                    name=f"Product {i}",
+                    description=f"Synthetic product {i}",
+                    price=round(random.uniform(1, 500), 2),
+                    stock=1_000_000,
+                    category_id=category_ids[i % len(category_ids)],
+                )
+                for i in range(products)
+            ]
+        )
+        db.commit()
+
+
+ADJECTIVES = (
+    "compact wireless portable classic premium rugged slim smart vintage "
+    "organic ergonomic heavy light silent waterproof foldable modular digital "
+    "analog ceramic bamboo leather carbon titanium cotton wool glass steel"
+).split()
+NOUNS = (
+    "laptop phone tablet headset speaker camera monitor keyboard mouse lamp "
+    "desk chair backpack jacket sweater jeans dress sneaker boot watch kettle "
+    "blender toaster mug bottle novel cookbook notebook pen guitar drone"
+).split()
+WORDS = (
+    "durable fast quiet bright soft warm everyday travel office outdoor "
+    "kitchen gaming studio kids eco refurbished bundle edition gift sale"
+).split()
+
+
+def synthetic_products(count: int, category_ids: List[int], seed: int = 0):
+    """
+    Yield ``count`` product rows with searchable, realistically skewed text:
+    names pair an adjective with a noun, descriptions draw from a wider
+    vocabulary plus a unique model code.
+    """
+    rng = random.Random(seed)
+    for i in range(count):
+        adjective, noun = rng.choice(ADJECTIVES), rng.choice(NOUNS)
+        extra = " ".join(rng.sample(WORDS, 4))
+        yield {
+            "name": f"{adjective.title()} {noun.title()} {i}",
+            "description": f"{adjective} {noun} {extra} model{i:07d}",
+            "price": round(rng.uniform(1, 500), 2),
+            "stock": 1_000_000,
+            "category_id": category_ids[i % len(category_ids)],
+        }
+
+
+def bulk_seed_catalog(
+    SessionLocal, products: int, categories: int = 50, batch_size: int = 50_000
+):
+    """Like seed_catalog, but with executemany batches so 1M rows is minutes."""
+    from models import Category, Product
+    from sqlalchemy import insert
+
+    seed_catalog(SessionLocal, products=0, categories=categories)
+    with SessionLocal() as db:
+        category_ids = [c.id for c in db.query(Category.__sqlmodel__).all()]
+        rows = synthetic_products(products, category_ids)
+        while batch := [row for _, row in zip(range(batch_size), rows)]:
+            db.execute(insert(Product.__sqlmodel__), batch)
+        db.commit()
+
+
+def seed_user(SessionLocal, email: str, password: str):
+    from models import User
+    from passwords import _hash
+
+    with SessionLocal() as db:
+        db.add(User.__sqlmodel__(email=email, hashed_password=_hash(password)))
+        db.commit()
+
+
+def seed_users(SessionLocal, count: int, admin: bool = False) -> List[dict]:
+    """
+    Create ``count`` users and return bearer headers for each. Passwords are
+    not usable; this skips bcrypt so large user counts stay cheap.
+    """
+    from models import User
+    from tokens import create_access_token
+
+    emails = [f"bench{i}@example.com" for i in range(count)]
+    with SessionLocal() as db:
+        db.add_all(
+            [
+                User.__sqlmodel__(email=e, hashed_password="!", is_admin=admin)
+                for e in emails
+            ]
+        )
+        db.commit()
+    return [
+        {"Authorization": f"Bearer {create_access_token(data={'sub': e})}"}
+        for e in emails
+    ]
+
+
+def sign(payload: bytes, secret: str) -> str:
+    """The Stripe-Signature header Stripe would send with ``payload``."""
+    timestamp = int(time.time())
+    signed = f"{timestamp}.".encode() + payload
+    digest = hmac.new(secret.encode(), signed, hashlib.sha256).hexdigest()
+    return f"t={timestamp},v1={digest}"
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def git_commit() -> Dict[str, object]:
+    def git(*cmd):
+        return subprocess.run(
+            ["git", *cmd], capture_output=True, text=True, check=True
+        ).stdout.strip()
+
+    try:
+        return {"commit": git("rev-parse", "HEAD"), "dirty": bool(git("status", "-s"))}
+    except (OSError, subprocess.CalledProcessError):
+        return {"commit": None, "dirty": None}
@@ -0,0 +1,62 @@
+"""
+Measure bulk import and export throughput of the product catalog.
+
+Run from src/fastapi_shopping with:
+
+    python -m bench.bulk_import --products 500000
+"""
+
+import argparse
+import json
+import time
+
+from bench._support import seed_catalog, seed_users, setup_database, synthetic_products
+from fastapi.testclient import TestClient
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--products", type=int, default=500_000)
+    args = parser.parse_args()
+
+    app, SessionLocal = setup_database()
+    seed_catalog(SessionLocal, products=0, categories=50)
+    client = TestClient(app)
+    (admin_headers,) = seed_users(SessionLocal, 1, admin=True)
+
+    # Streamed from a generator, so the feed is never in memory at once
+    feed = (
+        json.dumps(row).encode() + b"\n"
+        for row in synthetic_products(args.products, list(range(1, 51)))
+    )
+    start = time.perf_counter()
+    response = client.post(
+        "/catalog/products/import",
+        content=feed,
+        headers={"Content-Type": "application/x-ndjson", **admin_headers},
+    )
+    elapsed = time.perf_counter() - start
+    assert response.status_code == 200, response.text
+    result = response.json()
+    print(
+        f"import: {result['inserted']} rows ({result['failed']} failed) in "
+        f"{elapsed:.1f}s, {result['inserted'] / elapsed:,.0f} rows/s"
+    )
+
+    for format in ("ndjson", "csv"):
+        start = time.perf_counter()
+        size = 0
+        with client.stream(
+            "GET", "/catalog/products/export", params={"format": format}
+        ) as response:
+            for chunk in response.iter_bytes():
+                size += len(chunk)
+        elapsed = time.perf_counter() - start
+        print(
+            f"export {format}: {size / 1e6:.0f} MB in {elapsed:.1f}s, "
+            f"{args.products / elapsed:,.0f} rows/s"
+        )
+
+
+if __name__ == "__main__":
+    main()
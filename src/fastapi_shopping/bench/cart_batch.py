@@ -0,0 +1,81 @@
+"""
+Compare filling a cart with one POST /cart/cart/items/ per product against a
+single POST /cart/cart/items/batch: requests, latency and SQL statements.
+
+Run from src/fastapi_shopping with:
+
+    python -m bench.cart_batch --items 1 10 50 100
+"""
+
+import argparse
+import statistics
+import time
+
+from bench._support import seed_catalog, seed_users, setup_database
+from fastapi.testclient import TestClient
+from sqlalchemy import event
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--items", type=int, nargs="+", default=[1, 10, 50, 100])
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    app, SessionLocal = setup_database()
+    seed_catalog(SessionLocal, products=max(args.items))
+    (headers,) = seed_users(SessionLocal, 1)
+    engine = SessionLocal.kw["bind"]
+    statements = []
+    event.listen(
+        engine, "before_cursor_execute", lambda *args: statements.append(args[2])
+    )
+
+    client = TestClient(app)
+
+    def one_by_one(product_ids):
+        for product_id in product_ids:
+            response = client.post(
+                "/cart/cart/items/",
+                json={"product_id": product_id, "quantity": 1},
+                headers=headers,
+            )
+            assert response.status_code == 200, response.text
+        return len(product_ids)
+
+    def batched(product_ids):
+        response = client.post(
+            "/cart/cart/items/batch",
+            json=[
+                {"product_id": product_id, "quantity": 1} for product_id in product_ids
+            ],
+            headers=headers,
+        )
+        assert response.status_code == 200, response.text
+        return 1
+
+    for items in args.items:
+        product_ids = list(range(1, items + 1))
+        for name, fill in (("single", one_by_one), ("batch", batched)):
+            timings = []
+            queries = 0
+            for _ in range(args.repeat):
+                statements.clear()
+                start = time.perf_counter()
+                requests = fill(product_ids)
+                timings.append(time.perf_counter() - start)
+                queries += len(statements)
+                client.post(
+                    "/cart/cart/items/batch",
+                    json=[{"op": "remove", "product_id": pid} for pid in product_ids],
+                    headers=headers,
+                )
+            print(
+                f"items={items:4d} {name:6s} requests={requests:4d} "
+                f"median={statistics.median(timings) * 1000:8.1f}ms "
+                f"queries={queries / args.repeat:.0f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+Drive concurrent cart traffic (add item, read cart) through the ASGI app.
+
+Run from src/fastapi_shopping once per session mode or cart store and
+compare throughput:
+
+    python -m bench.cart_load
+    DATABASE_ASYNC=true python -m bench.cart_load
+    CART_STORE=memory python -m bench.cart_load
+"""
+
+import argparse
+import asyncio
+import random
+import time
+
+import httpx
+from app.config import app_config
+from bench._support import percentile, seed_catalog, seed_users, setup_database
+
+
+async def run(app, users: list, requests_per_user: int, products: int):
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as c:
+        latencies = []
+
+        async def shopper(headers):
+            for _ in range(requests_per_user):
+                start = time.perf_counter()
+                await c.post(
+                    "/cart/cart/items/",
+                    json={"product_id": random.randint(1, products), "quantity": 1},
+                    headers=headers,
+                )
+                await c.get("/cart/cart/", headers=headers)
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*[shopper(headers) for headers in users])
+        elapsed = time.perf_counter() - start
+    return latencies, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--requests", type=int, default=10)
+    parser.add_argument("--products", type=int, default=200)
+    args = parser.parse_args()
+
+    app, SessionLocal = setup_database()
+    seed_catalog(SessionLocal, products=args.products)
+    users = seed_users(SessionLocal, args.users)
+
+    latencies, elapsed = asyncio.run(run(app, users, args.requests, args.products))
+    mode = "async" if app_config.DATABASE_ASYNC else "sync"
+    print(
+        f"mode={mode} store={app_config.CART_STORE} users={args.users} "
+        f"rps={len(latencies) * 2 / elapsed:.0f} "
+        f"p50={percentile(latencies, 50) * 1000:.1f}ms "
+        f"p99={percentile(latencies, 99) * 1000:.1f}ms"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+Checkout throughput with a slow payment provider.
+
+Every shopper adds an item and checks out against an in-process FakeGateway
+that answers after --latency seconds. With --blocking the fake sleeps on the
+event loop instead, which is what calling the synchronous stripe client from
+the async checkout handler did.
+
+Run from src/fastapi_shopping with:
+
+    python -m bench.checkout_gateway --latency 0.2
+    python -m bench.checkout_gateway --latency 0.2 --blocking
+"""
+
+import argparse
+import asyncio
+import time
+from unittest.mock import patch
+
+import httpx
+from bench._support import percentile, seed_catalog, seed_users, setup_database
+from gateway import FakeGateway
+
+
+class BlockingFakeGateway(FakeGateway):
+    async def create_payment_intent(self, *args, **kwargs):
+        time.sleep(self.latency)
+        latency, self.latency = self.latency, 0.0
+        try:
+            return await super().create_payment_intent(*args, **kwargs)
+        finally:
+            self.latency = latency
+
+
+async def run(app, users: list, products: int):
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as c:
+        latencies = []
+
+        async def shopper(i, headers):
+            await c.post(
+                "/cart/cart/items/",
+                json={"product_id": i % products + 1, "quantity": 1},
+                headers=headers,
+            )
+            start = time.perf_counter()
+            response = await c.post("/cart/cart/checkout/", headers=headers)
+            latencies.append(time.perf_counter() - start)
+            assert response.status_code == 200, response.text
+
+        start = time.perf_counter()
+        await asyncio.gather(*[shopper(i, h) for i, h in enumerate(users)])
+        elapsed = time.perf_counter() - start
+    return latencies, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--products", type=int, default=100)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--blocking", action="store_true")
+    args = parser.parse_args()
+
+    app, SessionLocal = setup_database()
+    seed_catalog(SessionLocal, products=args.products)
+    users = seed_users(SessionLocal, args.users)
+
+    kind = BlockingFakeGateway if args.blocking else FakeGateway
+    fake = kind(latency=args.latency)
+    with patch("gateway.payment_gateway", fake):
+        latencies, elapsed = asyncio.run(run(app, users, args.products))
+    assert len(fake.intents) == args.users
+    print(
+        f"gateway={'blocking' if args.blocking else 'async'} "
+        f"latency={args.latency * 1000:.0f}ms users={args.users} "
+        f"checkouts/s={len(latencies) / elapsed:.1f} "
+        f"p50={percentile(latencies, 50) * 1000:.0f}ms "
+        f"p99={percentile(latencies, 99) * 1000:.0f}ms"
+    )
+
+
+if __name__ == "__main__":
+    main()
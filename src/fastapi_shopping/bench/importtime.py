@@ -0,0 +1,144 @@
+"""
+Track the cost of importing the app, as seen by every new worker process.
+
+Imports ``--module`` (main by default) in fresh interpreters under
+``python -X importtime`` and reports the median total import time and the
+packages that take the most of it, counting each module's own time toward
+its top-level package. Packages the app is meant to import lazily are
+flagged if they show up at startup. Results are written as JSON tagged with
+the git commit, and two result files can be compared like bench.suite's.
+
+Run from src/fastapi_shopping with:
+
+    python -m bench.importtime run --output base.json
+    python -m bench.importtime compare base.json new.json
+"""
+
+import argparse
+import json
+import re
+import statistics
+import subprocess
+import sys
+from collections import defaultdict
+from typing import Dict
+
+from bench._support import git_commit
+
+# Loaded on first use, by the request that needs them; see gateway.py,
+# passwords.py and routes/payments.py
+LAZY_PACKAGES = ["stripe", "httpx", "passlib", "bcrypt", "redis"]
+
+LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)")
+
+
+def measure(module: str) -> Dict[str, object]:
+    """Import ``module`` once in a new interpreter; times are in ms."""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+    )
+    if proc.returncode != 0:
+        sys.exit(f"importing {module} failed:\n{proc.stderr[-2000:]}")
+    total = 0.0
+    packages: Dict[str, float] = defaultdict(float)
+    for match in LINE.finditer(proc.stderr):
+        self_us, cumulative_us, indent, name = match.groups()
+        packages[name.split(".")[0]] += int(self_us) / 1000
+        if name == module and not indent:
+            total = int(cumulative_us) / 1000
+    return {"total_ms": total, "packages": dict(packages)}
+
+
+def run(args):
+    runs = [measure(args.module) for _ in range(args.runs)]
+    names = set().union(*(r["packages"] for r in runs))
+    packages = {
+        name: round(statistics.median(r["packages"].get(name, 0.0) for r in runs), 2)
+        for name in names
+    }
+    top = dict(sorted(packages.items(), key=lambda kv: -kv[1])[: args.top])
+    result = {
+        **git_commit(),
+        "module": args.module,
+        "runs": args.runs,
+        "python": sys.version.split()[0],
+        "total_ms": round(statistics.median(r["total_ms"] for r in runs), 2),
+        "top_packages_ms": top,
+        "eager_lazy_packages": sorted(set(LAZY_PACKAGES) & names),
+    }
+
+    print(f"import {args.module}: {result['total_ms']:.1f}ms (median of {args.runs})")
+    for name, ms in top.items():
+        print(f"  {name:30s} {ms:8.1f}ms")
+    if result["eager_lazy_packages"]:
+        print("imported at startup: " + ", ".join(result["eager_lazy_packages"]))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+        print(f"wrote {args.output}", file=sys.stderr)
+
+
+def compare(args) -> int:
+    """Print the change in import time; return 1 if it regressed."""
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    print(f"base {base.get('commit')}  new {new.get('commit')}")
+
+    regressed = False
+    old, now = base["total_ms"], new["total_ms"]
+    change = (now - old) / old if old else 0.0
+    flag = ""
+    if change > args.threshold:
+        flag = "  REGRESSION"
+        regressed = True
+    print(f"total {old:10.1f}ms -> {now:10.1f}ms ({change:+.1%}){flag}")
+
+    for name in new["top_packages_ms"]:
+        if name not in base["top_packages_ms"]:
+            print(
+                f"new in the top packages: {name} {new['top_packages_ms'][name]:.1f}ms"
+            )
+    newly_eager = set(new["eager_lazy_packages"]) - set(base["eager_lazy_packages"])
+    if newly_eager:
+        print(
+            "now imported at startup: "
+            + ", ".join(sorted(newly_eager))
+            + "  REGRESSION"
+        )
+        regressed = True
+    return 1 if regressed else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="measure the import time")
+    run_parser.add_argument("--module", default="main")
+    run_parser.add_argument("--runs", type=int, default=5)
+    run_parser.add_argument("--top", type=int, default=15)
+    run_parser.add_argument("--output", help="JSON result file")
+
+    compare_parser = commands.add_parser("compare", help="compare two result files")
+    compare_parser.add_argument("base")
+    compare_parser.add_argument("new")
+    compare_parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="relative slowdown counted as a regression (default 0.1)",
+    )
+
+    args = parser.parse_args()
+    if args.command == "run":
+        run(args)
+    else:
+        sys.exit(compare(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,36 @@
+"""
+Compare cold (signature verified) and warm (memoized) bearer token decoding.
+
+Run from src/fastapi_shopping with:
+
+    python -m bench.jwt_decode
+"""
+
+import argparse
+import timeit
+
+from tokens import create_access_token, decode_access_token, token_cache
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", "--number", type=int, default=20000)
+    args = parser.parse_args()
+
+    token = create_access_token(data={"sub": "bench@example.com"})
+
+    def cold():
+        token_cache.clear()
+        decode_access_token(token)
+
+    def warm():
+        decode_access_token(token)
+
+    decode_access_token(token)
+    for name, fn in (("cold", cold), ("warm", warm)):
+        seconds = timeit.timeit(fn, number=args.number)
+        print(f"{name}: {seconds / args.number * 1e6:8.2f} us/decode")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""
+Measure /catalog/products/ latency while a storm of logins is in flight.
+
+Run from src/fastapi_shopping, once per executor, to compare bcrypt on the
+event loop with the worker pool:
+
+    python -m bench.login_storm --executor inline
+    python -m bench.login_storm --executor thread
+"""
+
+import argparse
+import asyncio
+import time
+
+import httpx
+from bench._support import percentile, seed_catalog, seed_user, setup_database
+from passwords import HashingPool, hashing_pool
+
+EMAIL = "storm@example.com"
+PASSWORD = "storm-password"
+
+
+async def run(app, logins: int, browses: int):
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as c:
+        latencies = []
+
+        async def login():
+            await c.post("/user/token", data={"username": EMAIL, "password": PASSWORD})
+
+        async def browse():
+            for _ in range(browses):
+                start = time.perf_counter()
+                await c.get("/catalog/products/", params={"limit": 20})
+                latencies.append(time.perf_counter() - start)
+                await asyncio.sleep(0.005)
+
+        await asyncio.gather(browse(), *[login() for _ in range(logins)])
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--executor", default="thread")
+    parser.add_argument("--workers", type=int, default=0)
+    parser.add_argument("--logins", type=int, default=50)
+    parser.add_argument("--browses", type=int, default=100)
+    args = parser.parse_args()
+
+    configured = HashingPool(executor=args.executor, workers=args.workers)
+    hashing_pool.executor = configured.executor
+    hashing_pool.workers = configured.workers
+    hashing_pool.queue_depth = args.logins
+    app, SessionLocal = setup_database()
+    seed_catalog(SessionLocal)
+    seed_user(SessionLocal, EMAIL, PASSWORD)
+
+    latencies = asyncio.run(run(app, args.logins, args.browses))
+    print(
+        f"executor={args.executor} logins={args.logins} "
+        f"products p50={percentile(latencies, 50) * 1000:.1f}ms "
+        f"p99={percentile(latencies, 99) * 1000:.1f}ms"
+    )
+    hashing_pool.shutdown()
+
+
+if __name__ == "__main__":
+    main()
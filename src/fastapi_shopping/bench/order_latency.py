@@ -0,0 +1,52 @@
+"""
+Measure POST /catalog/orders/ latency and query count against line-item count.
+
+Run from src/fastapi_shopping with:
+
+    python -m bench.order_latency --lines 1 10 100 500
+"""
+
+import argparse
+import statistics
+import time
+
+from bench._support import seed_catalog, setup_database
+from fastapi.testclient import TestClient
+from sqlalchemy import event
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--lines", type=int, nargs="+", default=[1, 10, 100, 500])
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    app, SessionLocal = setup_database()
+    seed_catalog(SessionLocal, products=max(args.lines))
+    engine = SessionLocal.kw["bind"]
+    statements = []
+    event.listen(
+        engine, "before_cursor_execute", lambda *args: statements.append(args[2])
+    )
+
+    client = TestClient(app)
+    for lines in args.lines:
+        payload = {
+            "items": [{"product_id": i + 1, "quantity": 1} for i in range(lines)]
+        }
+        timings = []
+        statements.clear()
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            response = client.post("/catalog/orders/", json=payload)
+            timings.append(time.perf_counter() - start)
+            assert response.status_code == 200, response.text
+        print(
+            f"lines={lines:5d} "
+            f"median={statistics.median(timings) * 1000:7.1f}ms "
+            f"queries/order={len(statements) / args.repeat:.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
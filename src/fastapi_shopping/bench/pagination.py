@@ -0,0 +1,73 @@
+"""
+Compare offset (skip) and keyset (cursor) paging of GET /catalog/products/
+at increasing page depths. The catalog cache is bypassed so every request
+hits the database.
+
+Run from src/fastapi_shopping with:
+
+    python -m bench.pagination --products 100000 --depths 0 1000 10000 90000
+"""
+
+import argparse
+import statistics
+import time
+
+from bench._support import seed_catalog, setup_database
+from catalog_cache import NullBackend, catalog_cache
+from fastapi.testclient import TestClient
+from models import Product
+from pagination import encode_cursor
+
+
+def _timed(client, params, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        response = client.get("/catalog/products/", params=params)
+        timings.append(time.perf_counter() - start)
+        assert response.status_code == 200, response.text
+    return statistics.median(timings) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--products", type=int, default=100_000)
+    parser.add_argument(
+        "--depths", type=int, nargs="+", default=[0, 1000, 10_000, 90_000]
+    )
+    parser.add_argument("--limit", type=int, default=50)
+    parser.add_argument("--sort", default="price", choices=["id", "price", "name"])
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    app, SessionLocal = setup_database()
+    seed_catalog(SessionLocal, products=args.products)
+    catalog_cache.backend = NullBackend()
+    client = TestClient(app)
+
+    ProductQ = Product.__sqlmodel__
+    columns = {
+        "id": [ProductQ.id],
+        "price": [ProductQ.price, ProductQ.id],
+        "name": [ProductQ.name, ProductQ.id],
+    }[args.sort]
+    for depth in args.depths:
+        params = {"sort": args.sort, "limit": args.limit}
+        offset_ms = _timed(client, {**params, "skip": depth}, args.repeat)
+        if depth:
+            # The cursor a client would hold after paging down to ``depth``
+            with SessionLocal() as db:
+                last = (
+                    db.query(*columns)
+                    .order_by(*columns)
+                    .offset(depth - 1)
+                    .limit(1)
+                    .one()
+                )
+            params["cursor"] = encode_cursor(args.sort, list(last))
+        cursor_ms = _timed(client, params, args.repeat)
+        print(f"depth={depth:7d} offset={offset_ms:7.2f}ms cursor={cursor_ms:7.2f}ms")
+
+
+if __name__ == "__main__":
+    main()
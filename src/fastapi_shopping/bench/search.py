@@ -0,0 +1,67 @@
+"""
+Measure GET /catalog/search latency on a synthetic catalog.
+
+Run from src/fastapi_shopping with:
+
+    python -m bench.search --products 1000000
+
+The target is a p99 below 10 ms at 1M products. Seeding 1M products takes a
+few minutes; pass --reuse to search an existing bench.db again.
+"""
+
+import argparse
+import time
+
+from bench._support import bulk_seed_catalog, percentile, setup_database
+from fastapi.testclient import TestClient
+from search import search_products
+
+QUERIES = [
+    {"q": "laptop"},
+    {"q": "lap"},
+    {"q": "wireless headset"},
+    {"q": "quiet office ch"},
+    {"q": "model0000042"},
+    {"q": "leather", "category_id": 7},
+    {"q": "camera", "min_price": 100, "max_price": 200},
+    {"q": "premium sneaker", "max_price": 50, "limit": 50},
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--products", type=int, default=1_000_000)
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--reuse", action="store_true")
+    args = parser.parse_args()
+
+    app, SessionLocal = setup_database(reset=not args.reuse)
+    if not args.reuse:
+        start = time.perf_counter()
+        bulk_seed_catalog(SessionLocal, args.products)
+        print(f"seeded {args.products} products in {time.perf_counter() - start:.0f}s")
+
+    client = TestClient(app)
+    for params in QUERIES:
+        # End to end through the app, and search_products() alone
+        http, db_only = [], []
+        filters = {k: v for k, v in params.items() if k != "q"}
+        with SessionLocal() as db:
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                response = client.get("/catalog/search", params=params)
+                http.append((time.perf_counter() - start) * 1000)
+                assert response.status_code == 200, response.text
+
+                start = time.perf_counter()
+                search_products(db, params["q"], **filters)
+                db_only.append((time.perf_counter() - start) * 1000)
+        print(
+            f"{str(params):58s} hits={len(response.json()):3d} "
+            f"http p50={percentile(http, 50):6.2f}ms p99={percentile(http, 99):6.2f}ms "
+            f"db p50={percentile(db_only, 50):6.2f}ms p99={percentile(db_only, 99):6.2f}ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+Compare ways of turning a product listing into JSON bytes, at several list
+sizes. Every path includes the query, since hydrating ORM objects is part
+of what the row path avoids:
+
+  orm+response_model  ORM objects validated into ProductOut and dumped, as
+                      FastAPI does for a handler returning ORM objects
+  orm+adapter         ORM objects through TypeAdapter validate + dump_json
+  rows+typeddict      row tuples dumped via serialization.dump_rows
+
+Run from src/fastapi_shopping with:
+
+    python -m bench.serialization --sizes 100 1000 10000
+"""
+
+import argparse
+import json
+import statistics
+import time
+from typing import List
+
+from bench._support import seed_catalog, setup_database
+from models import Product
+from pydantic import TypeAdapter
+from pydantic_models import ProductOut
+from serialization import columns_for, dump_rows
+
+ProductList = TypeAdapter(List[ProductOut])
+
+
+def orm_response_model(db, size):
+    products = db.query(Product.__sqlmodel__).limit(size).all()
+    validated = ProductList.validate_python(products, from_attributes=True)
+    content = ProductList.dump_python(validated, mode="json")
+    return json.dumps(content, separators=(",", ":")).encode()
+
+
+def orm_adapter(db, size):
+    products = db.query(Product.__sqlmodel__).limit(size).all()
+    return ProductList.dump_json(
+        ProductList.validate_python(products, from_attributes=True)
+    )
+
+
+def rows_typeddict(db, size):
+    ProductQ = Product.__sqlmodel__
+    rows = db.query(*columns_for(ProductOut, ProductQ)).limit(size).all()
+    return dump_rows(ProductOut, rows)
+
+
+PATHS = {
+    "orm+response_model": orm_response_model,
+    "orm+adapter": orm_adapter,
+    "rows+typeddict": rows_typeddict,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10_000])
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    _, SessionLocal = setup_database()
+    seed_catalog(SessionLocal, products=max(args.sizes))
+    for size in args.sizes:
+        timings = {}
+        with SessionLocal() as db:
+            for name, path in PATHS.items():
+                assert json.loads(path(db, size)) == json.loads(
+                    rows_typeddict(db, size)
+                )
+                samples = []
+                for _ in range(args.repeat):
+                    db.expunge_all()
+                    start = time.perf_counter()
+                    path(db, size)
+                    samples.append(time.perf_counter() - start)
+                timings[name] = statistics.median(samples) * 1000
+        print(
+            f"items={size:6d} "
+            + " ".join(f"{name}={ms:8.2f}ms" for name, ms in timings.items())
+        )
+
+
+if __name__ == "__main__":
+    main()
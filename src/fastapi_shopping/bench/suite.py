@@ -0,0 +1,385 @@
+"""
+Benchmark suite for the shop's critical flows.
+
+Seeds a database with the requested volumes, then drives the real app
+through login, browse, add-to-cart, checkout and webhook traffic. Each flow
+runs on its own and reports requests per second, p50/p95/p99 latency, the
+error count and SQL statements per request. Results are written as JSON
+tagged with the git commit, and two result files can be compared to catch
+regressions between commits.
+
+The app is driven either in-process through httpx's ASGI transport, or
+over real sockets by a uvicorn server started on a background thread.
+Both run in this process, so SQL statements are counted either way.
+Lifespan tasks (the reservation sweeper and webhook workers) are not
+started, so webhook numbers are for acknowledging deliveries only.
+Payment intents come from an in-process FakeGateway.
+
+Run from src/fastapi_shopping with:
+
+    python -m bench.suite run --products 1000000 --output base.json
+    python -m bench.suite run --driver uvicorn --flows browse checkout
+    python -m bench.suite compare base.json new.json
+"""
+
+import argparse
+import asyncio
+import datetime
+import json
+import random
+import socket
+import sys
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Callable, List
+from unittest.mock import patch
+
+import httpx
+from app.config import app_config
+from bench._support import (
+    bulk_seed_catalog,
+    git_commit,
+    percentile,
+    seed_user,
+    seed_users,
+    setup_database,
+    sign,
+)
+from gateway import FakeGateway
+from sqlalchemy import event, select
+
+FLOWS = ["login", "browse", "add_to_cart", "checkout", "webhook"]
+LOGIN_EMAIL = "suite@example.com"
+LOGIN_PASSWORD = "suite-password"
+
+
+@dataclass
+class Context:
+    users: List[dict]
+    # Headers of the users whose carts were seeded, one checkout each
+    cart_users: List[dict]
+    products: int
+    gateway: FakeGateway
+    # Payment intents created by the checkout flow, paid by the webhook flow
+    intents: List[str] = field(default_factory=list)
+
+
+# One request of each flow; ``i`` numbers the requests within a run
+async def login(client: httpx.AsyncClient, ctx: Context, i: int):
+    return await client.post(
+        "/user/token", data={"username": LOGIN_EMAIL, "password": LOGIN_PASSWORD}
+    )
+
+
+async def browse(client: httpx.AsyncClient, ctx: Context, i: int):
+    if i % 2:
+        return await client.get(f"/catalog/products/{random.randint(1, ctx.products)}")
+    return await client.get(
+        "/catalog/products/",
+        params={"limit": 20, "sort": random.choice(["id", "price", "name"])},
+    )
+
+
+async def add_to_cart(client: httpx.AsyncClient, ctx: Context, i: int):
+    return await client.post(
+        "/cart/cart/items/",
+        json={"product_id": random.randint(1, ctx.products), "quantity": 1},
+        headers=ctx.users[i % len(ctx.users)],
+    )
+
+
+async def checkout(client: httpx.AsyncClient, ctx: Context, i: int):
+    return await client.post("/cart/cart/checkout/", headers=ctx.cart_users[i])
+
+
+async def webhook(client: httpx.AsyncClient, ctx: Context, i: int):
+    intent = ctx.intents[i % len(ctx.intents)] if ctx.intents else f"pi_suite_{i}"
+    payload = json.dumps(
+        {
+            "id": f"evt_suite_{time.time_ns()}_{i}",
+            "type": "payment_intent.succeeded",
+            "data": {"object": {"id": intent, "object": "payment_intent"}},
+        }
+    ).encode()
+    return await client.post(
+        "/payments/webhook/stripe",
+        content=payload,
+        headers={"stripe-signature": sign(payload, app_config.STRIPE_WEBHOOK_SECRET)},
+    )
+
+
+async def run_flow(
+    client: httpx.AsyncClient,
+    flow: Callable,
+    ctx: Context,
+    requests: int,
+    concurrency: int,
+    statements: list,
+) -> dict:
+    latencies = []
+    errors = 0
+    indexes = iter(range(requests))
+
+    async def worker():
+        nonlocal errors
+        for i in indexes:
+            start = time.perf_counter()
+            response = await flow(client, ctx, i)
+            latencies.append(time.perf_counter() - start)
+            if response.status_code >= 400:
+                errors += 1
+
+    statements.clear()
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    return {
+        "requests": requests,
+        "errors": errors,
+        "rps": round(requests / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "queries_per_request": round(len(statements) / requests, 2) if requests else 0,
+    }
+
+
+def seed(SessionLocal, args) -> Context:
+    from cart_store import CartChange, get_cart_store
+    from models import Product, User
+
+    started = time.perf_counter()
+    bulk_seed_catalog(SessionLocal, products=args.products, categories=args.categories)
+    seed_user(SessionLocal, LOGIN_EMAIL, LOGIN_PASSWORD)
+    users = seed_users(SessionLocal, args.users)
+
+    carts = min(args.carts, args.users)
+    ProductQ = Product.__sqlmodel__
+    UserQ = User.__sqlmodel__
+    store = get_cart_store()
+    with SessionLocal() as db:
+        user_ids = (
+            db.execute(
+                select(UserQ.id)
+                .where(UserQ.email.like("bench%"))
+                .order_by(UserQ.id)
+                .limit(carts)
+            )
+            .scalars()
+            .all()
+        )
+        for user_id in user_ids:
+            product_ids = random.sample(
+                range(1, args.products + 1), min(args.cart_items, args.products)
+            )
+            prices = dict(
+                db.execute(
+                    select(ProductQ.id, ProductQ.price).where(
+                        ProductQ.id.in_(product_ids)
+                    )
+                ).all()
+            )
+            changes = [CartChange("add", pid, 1) for pid in product_ids]
+            store.apply(db, user_id, changes, prices)
+    print(
+        f"seeded {args.products} products, {args.users} users and {carts} carts "
+        f"in {time.perf_counter() - started:.1f}s",
+        file=sys.stderr,
+    )
+    return Context(
+        users=users,
+        cart_users=users[:carts],
+        products=args.products,
+        gateway=FakeGateway(latency=args.gateway_latency),
+    )
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class UvicornServer:
+    """A uvicorn server for ``app`` on a background thread."""
+
+    def __init__(self, app):
+        import uvicorn
+
+        self.port = free_port()
+        config = uvicorn.Config(
+            app, host="127.0.0.1", port=self.port, log_level="warning", lifespan="off"
+        )
+        self.server = uvicorn.Server(config)
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+
+    def __enter__(self) -> str:
+        self.thread.start()
+        while not self.server.started:
+            time.sleep(0.01)
+        return f"http://127.0.0.1:{self.port}"
+
+    def __exit__(self, *exc):
+        self.server.should_exit = True
+        self.thread.join()
+
+
+async def drive(base_url: str, transport, ctx: Context, args, statements) -> dict:
+    limits = httpx.Limits(max_connections=args.concurrency)
+    results = {}
+    async with httpx.AsyncClient(
+        transport=transport, base_url=base_url, limits=limits, timeout=60
+    ) as client:
+        for name in args.flows:
+            ctx.intents = [intent.id for intent in ctx.gateway.intents.values()]
+            requests = {
+                "login": args.login_requests,
+                "checkout": min(args.requests, len(ctx.cart_users)),
+            }.get(name, args.requests)
+            results[name] = await run_flow(
+                client,
+                globals()[name],
+                ctx,
+                requests,
+                args.concurrency,
+                statements,
+            )
+            print(format_row(name, results[name]), file=sys.stderr)
+    return results
+
+
+def format_row(name: str, result: dict) -> str:
+    return (
+        f"{name:12s} requests={result['requests']:6d} errors={result['errors']:4d} "
+        f"rps={result['rps']:8.1f} p50={result['p50_ms']:8.1f}ms "
+        f"p95={result['p95_ms']:8.1f}ms p99={result['p99_ms']:8.1f}ms "
+        f"queries/request={result['queries_per_request']:.1f}"
+    )
+
+
+def run(args):
+    app, SessionLocal = setup_database()
+    ctx = seed(SessionLocal, args)
+    engine = SessionLocal.kw["bind"]
+    statements = []
+    event.listen(engine, "before_cursor_execute", lambda *a: statements.append(a[2]))
+
+    with patch("gateway.payment_gateway", ctx.gateway):
+        if args.driver == "uvicorn":
+            with UvicornServer(app) as base_url:
+                flows = asyncio.run(drive(base_url, None, ctx, args, statements))
+        else:
+            transport = httpx.ASGITransport(app=app)
+            flows = asyncio.run(drive("http://bench", transport, ctx, args, statements))
+
+    result = {
+        **git_commit(),
+        "created_at": datetime.datetime.utcnow().isoformat(),
+        "driver": args.driver,
+        "config": {
+            "users": args.users,
+            "categories": args.categories,
+            "products": args.products,
+            "carts": args.carts,
+            "cart_items": args.cart_items,
+            "concurrency": args.concurrency,
+            "gateway_latency": args.gateway_latency,
+            "database_async": app_config.DATABASE_ASYNC,
+            "cart_store": app_config.CART_STORE,
+            "catalog_cache": app_config.CATALOG_CACHE_BACKEND,
+        },
+        "flows": flows,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+        print(f"wrote {args.output}", file=sys.stderr)
+    else:
+        print(json.dumps(result, indent=2))
+
+
+# Metric -> True if bigger is better
+METRICS = {
+    "rps": True,
+    "p50_ms": False,
+    "p95_ms": False,
+    "p99_ms": False,
+    "queries_per_request": False,
+}
+
+
+def compare(args) -> int:
+    """Print the change of every metric; return 1 if any regressed."""
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    print(f"base {base.get('commit')}  new {new.get('commit')}")
+    if base.get("config") != new.get("config"):
+        print("warning: the runs used different configurations")
+
+    regressed = False
+    for name, new_flow in new["flows"].items():
+        base_flow = base["flows"].get(name)
+        if base_flow is None:
+            continue
+        for metric, higher_is_better in METRICS.items():
+            old, now = base_flow[metric], new_flow[metric]
+            change = (now - old) / old if old else 0.0
+            worse = -change if higher_is_better else change
+            # Query counts are deterministic, so any increase counts
+            threshold = 0.0 if metric == "queries_per_request" else args.threshold
+            flag = ""
+            if worse > threshold:
+                flag = "  REGRESSION"
+                regressed = True
+            print(
+                f"{name:12s} {metric:20s} {old:10.2f} -> {now:10.2f} "
+                f"({change:+.1%}){flag}"
+            )
+        if new_flow["errors"] > base_flow["errors"]:
+            print(f"{name:12s} errors {base_flow['errors']} -> {new_flow['errors']}")
+            regressed = True
+    return 1 if regressed else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="seed, drive the flows, report")
+    run_parser.add_argument("--flows", nargs="+", choices=FLOWS, default=FLOWS)
+    run_parser.add_argument(
+        "--driver", choices=["inprocess", "uvicorn"], default="inprocess"
+    )
+    run_parser.add_argument("--users", type=int, default=200)
+    run_parser.add_argument("--categories", type=int, default=50)
+    run_parser.add_argument("--products", type=int, default=10_000)
+    run_parser.add_argument("--carts", type=int, default=200)
+    run_parser.add_argument("--cart-items", type=int, default=3)
+    run_parser.add_argument("--requests", type=int, default=1000)
+    run_parser.add_argument("--login-requests", type=int, default=50)
+    run_parser.add_argument("--concurrency", type=int, default=20)
+    run_parser.add_argument("--gateway-latency", type=float, default=0.0)
+    run_parser.add_argument("--output", help="JSON result file (default: stdout)")
+
+    compare_parser = commands.add_parser("compare", help="compare two result files")
+    compare_parser.add_argument("base")
+    compare_parser.add_argument("new")
+    compare_parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="relative change in rps or latency reported as a regression",
+    )
+
+    args = parser.parse_args()
+    if args.command == "run":
+        run(args)
+    else:
+        sys.exit(compare(args))
+
+
+if __name__ == "__main__":
+    main()
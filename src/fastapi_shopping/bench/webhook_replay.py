@@ -0,0 +1,130 @@
+"""
+Replay Stripe webhook deliveries, duplicates included, and measure how fast
+they are acknowledged and how long the workers take to drain them.
+
+A local Stripe stand-in signs every payload with STRIPE_WEBHOOK_SECRET, so
+requests go through real signature verification. Each pending order gets a
+payment_intent.created and a payment_intent.succeeded event; a share of all
+events is delivered again, and the deliveries are shuffled.
+
+Run from src/fastapi_shopping with:
+
+    python -m bench.webhook_replay --events 10000 --duplicates 0.25
+"""
+
+import argparse
+import json
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import inventory
+from app.config import app_config
+from bench._support import percentile, seed_catalog, setup_database, sign
+from fastapi.testclient import TestClient
+from models import Order, StockReservation, WebhookEvent
+from routes.payments import webhook_processor
+from sqlalchemy import func, insert, select
+
+
+def seed_orders(SessionLocal, count: int):
+    OrderQ = Order.__sqlmodel__
+    with SessionLocal() as db:
+        db.execute(
+            insert(OrderQ),
+            [
+                {
+                    "status": "pending",
+                    "total_amount": 10.0,
+                    "payment_intent_id": f"pi_{i}",
+                    "payment_intent_status": "pending",
+                }
+                for i in range(count)
+            ],
+        )
+        order_ids = db.execute(select(OrderQ.id).order_by(OrderQ.id)).scalars().all()
+        for order_id in order_ids:
+            inventory.reserve(db, order_id, {order_id % 100 + 1: 1})
+        db.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--events", type=int, default=10_000)
+    parser.add_argument("--duplicates", type=float, default=0.25)
+    parser.add_argument("--concurrency", type=int, default=8)
+    args = parser.parse_args()
+
+    unique = int(args.events / (1 + args.duplicates))
+    orders = unique // 2
+    app, SessionLocal = setup_database()
+    seed_catalog(SessionLocal, products=100)
+    seed_orders(SessionLocal, orders)
+
+    events = []
+    for i in range(orders):
+        for kind in ("created", "succeeded"):
+            events.append(
+                {
+                    "id": f"evt_{kind}_{i}",
+                    "type": f"payment_intent.{kind}",
+                    "data": {"object": {"id": f"pi_{i}", "object": "payment_intent"}},
+                }
+            )
+    deliveries = events + random.choices(events, k=args.events - len(events))
+    random.shuffle(deliveries)
+    payloads = [json.dumps(event).encode() for event in deliveries]
+
+    webhook_processor.session_factory = SessionLocal
+    with TestClient(app) as client:
+
+        def deliver(payload):
+            start = time.perf_counter()
+            response = client.post(
+                "/payments/webhook/stripe",
+                content=payload,
+                headers={
+                    "stripe-signature": sign(payload, app_config.STRIPE_WEBHOOK_SECRET)
+                },
+            )
+            assert response.status_code == 200, response.text
+            return (time.perf_counter() - start) * 1000
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(args.concurrency) as pool:
+            acks = list(pool.map(deliver, payloads))
+        delivered = time.perf_counter() - start
+
+        WebhookEventQ = WebhookEvent.__sqlmodel__
+        with SessionLocal() as db:
+            while db.execute(
+                select(func.count()).where(WebhookEventQ.status != "done")
+            ).scalar():
+                db.rollback()
+                time.sleep(0.05)
+        drained = time.perf_counter() - start
+
+    print(
+        f"deliveries={len(payloads)} unique={len(events)} "
+        f"delivered in {delivered:.1f}s ({len(payloads) / delivered:,.0f}/s), "
+        f"ack p50={percentile(acks, 50):.1f}ms p99={percentile(acks, 99):.1f}ms, "
+        f"all processed after {drained:.1f}s"
+    )
+
+    OrderQ = Order.__sqlmodel__
+    ReservationQ = StockReservation.__sqlmodel__
+    with SessionLocal() as db:
+        recorded = db.execute(select(func.count(WebhookEventQ.id))).scalar()
+        paid = db.execute(select(func.count()).where(OrderQ.status == "paid")).scalar()
+        committed = db.execute(
+            select(func.count()).where(ReservationQ.status == inventory.COMMITTED)
+        ).scalar()
+    assert recorded == len(events), recorded
+    assert paid == committed == orders, (paid, committed)
+    print(
+        f"events recorded={recorded} orders paid={paid} reservations committed={committed}"
+    )
+
+
+if __name__ == "__main__":
+    main()
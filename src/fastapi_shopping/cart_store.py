@@ -0,0 +1,559 @@
+"""
+Where shopping carts live.
+
+SQLCartStore keeps carts in the carts/cart_items tables, as before. Every
+cart write is then a database write, which makes carts the largest source
+of write contention. MemoryCartStore (one process) and RedisCartStore
+(shared between workers) keep them in a key-value store instead. Carts
+that aren't touched for CART_TTL_SECONDS expire. A cart only reaches SQL
+at checkout, when it is written out as the order and its items.
+
+A cart is its id and a mapping of product id -> quantity. It changes by
+applying a list of CartChanges (add, set, remove) in one write. Stores
+don't check products or stock; the cart routes do that before calling them.
+
+Every cart also keeps its subtotal and item count, adjusted by each write
+with the prices the route looked up, so reading them never touches the
+cart's lines. They follow price changes through reprice(); checkout
+always charges the total at current prices.
+"""
+
+import abc
+import itertools
+import random
+import threading
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+import sharding
+from app.config import app_config
+from cache import TTLCache
+from models import Cart, CartItem, Product
+from pydantic_models import CartOut, ProductOut
+from serialization import columns_for, dump
+from sqlalchemy import and_, bindparam, delete, func, insert, inspect, select, update
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+ADD = "add"
+SET = "set"
+REMOVE = "remove"
+
+
+class CartChange(NamedTuple):
+    # ADD increases the quantity, SET replaces it; setting 0 removes the line
+    op: str
+    product_id: int
+    quantity: int = 0
+
+
+class CartTotals(NamedTuple):
+    id: int
+    subtotal: float
+    item_count: int
+
+
+@dataclass
+class StoredCart:
+    id: int
+    # product id -> quantity, in the order the products were added
+    items: Dict[int, int] = field(default_factory=dict)
+    subtotal: float = 0.0
+    item_count: int = 0
+
+
+def cart_json(totals: CartTotals, lines: Iterable[Tuple[int, tuple]]) -> bytes:
+    """CartOut JSON from the cart's totals and (quantity, ProductOut row) pairs."""
+    items = []
+    for quantity, product in lines:
+        product = dict(zip(ProductOut.model_fields, product))
+        items.append(
+            {"product_id": product["id"], "quantity": quantity, "product": product}
+        )
+    return dump(
+        CartOut,
+        {
+            "id": totals.id,
+            "items": items,
+            "total": totals.subtotal,
+            "item_count": totals.item_count,
+        },
+    )
+
+
+def apply_changes(items: Dict[int, int], changes: List[CartChange]):
+    """Apply ``changes`` to a product id -> quantity mapping in place."""
+    for op, product_id, quantity in changes:
+        if op == REMOVE or (op == SET and quantity == 0):
+            items.pop(product_id, None)
+        elif op == ADD:
+            items[product_id] = items.get(product_id, 0) + quantity
+        else:
+            items[product_id] = quantity
+
+
+def totals_delta(
+    before: Dict[int, int], after: Dict[int, int], prices: Dict[int, float]
+) -> Tuple[float, int]:
+    """How much the subtotal and item count move from ``before`` to ``after``."""
+    subtotal = 0.0
+    count = 0
+    for product_id in before.keys() | after.keys():
+        change = after.get(product_id, 0) - before.get(product_id, 0)
+        subtotal += change * prices.get(product_id, 0.0)
+        count += change
+    return subtotal, count
+
+
+class CartStore(abc.ABC):
+    @abc.abstractmethod
+    def get(self, db: Session, user_id: int) -> Optional[StoredCart]:
+        """The user's cart, or None if there is none."""
+
+    def get_totals(self, db: Session, user_id: int) -> Optional[CartTotals]:
+        cart = self.get(db, user_id)
+        if cart is None:
+            return None
+        return CartTotals(cart.id, cart.subtotal, cart.item_count)
+
+    @abc.abstractmethod
+    def apply(
+        self,
+        db: Session,
+        user_id: int,
+        changes: List[CartChange],
+        prices: Dict[int, float],
+    ):
+        """
+        Apply ``changes`` in order, creating the cart if needed. ``prices``
+        holds the current price of every product in ``changes``.
+        """
+
+    def add_item(
+        self, db: Session, user_id: int, product_id: int, quantity: int, price: float
+    ):
+        self.apply(
+            db, user_id, [CartChange(ADD, product_id, quantity)], {product_id: price}
+        )
+
+    @abc.abstractmethod
+    def reprice(self, db: Session, product_id: int, old_price: float, new_price: float):
+        """Move the subtotal of every cart holding ``product_id`` to its new price."""
+
+    @abc.abstractmethod
+    def clear(self, db: Session, user_id: int):
+        """
+        Delete the user's cart. The SQL store does this in ``db``'s
+        transaction, so the caller commits.
+        """
+
+    def get_json(self, db: Session, user_id: int) -> Optional[bytes]:
+        """The user's cart as CartOut JSON, or None if there is no cart."""
+        cart = self.get(db, user_id)
+        if cart is None:
+            return None
+        ProductQ = Product.__sqlmodel__
+        products = {
+            row.id: row
+            for row in db.execute(
+                select(*columns_for(ProductOut, ProductQ)).where(
+                    ProductQ.id.in_(cart.items)
+                )
+            )
+        }
+        return cart_json(
+            CartTotals(cart.id, cart.subtotal, cart.item_count),
+            [
+                (quantity, products[product_id])
+                for product_id, quantity in cart.items.items()
+                if product_id in products
+            ],
+        )
+
+
+class SQLCartStore(CartStore):
+    """Carts in SQL, on the user's shard when sharding is on (see sharding.py)."""
+
+    def get(self, db: Session, user_id: int) -> Optional[StoredCart]:
+        sharding.route(db, user_id)
+        CartQ = Cart.__sqlmodel__
+        CartItemQ = CartItem.__sqlmodel__
+        rows = db.execute(
+            select(
+                CartQ.id,
+                CartQ.subtotal,
+                CartQ.item_count,
+                CartItemQ.product_id,
+                CartItemQ.quantity,
+            )
+            .outerjoin(CartItemQ, CartItemQ.cart_id == CartQ.id)
+            .where(CartQ.user_id == user_id)
+            .order_by(CartItemQ.id)
+        ).all()
+        if not rows:
+            return None
+        cart = StoredCart(id=rows[0][0], subtotal=rows[0][1], item_count=rows[0][2])
+        for *_, product_id, quantity in rows:
+            if product_id is not None:
+                cart.items[product_id] = cart.items.get(product_id, 0) + quantity
+        return cart
+
+    def get_totals(self, db: Session, user_id: int) -> Optional[CartTotals]:
+        sharding.route(db, user_id)
+        CartQ = Cart.__sqlmodel__
+        row = db.execute(
+            select(CartQ.id, CartQ.subtotal, CartQ.item_count).where(
+                CartQ.user_id == user_id
+            )
+        ).first()
+        return None if row is None else CartTotals(*row)
+
+    def apply(
+        self,
+        db: Session,
+        user_id: int,
+        changes: List[CartChange],
+        prices: Dict[int, float],
+    ):
+        sharding.route(db, user_id)
+        CartQ = Cart.__sqlmodel__
+        CartItemQ = CartItem.__sqlmodel__
+        # The cart and the lines being changed, in one query
+        rows = db.execute(
+            select(CartQ.id, CartItemQ.product_id, CartItemQ.quantity)
+            .outerjoin(
+                CartItemQ,
+                and_(
+                    CartItemQ.cart_id == CartQ.id,
+                    CartItemQ.product_id.in_({c.product_id for c in changes}),
+                ),
+            )
+            .where(CartQ.user_id == user_id)
+        ).all()
+        cart_id = rows[0][0] if rows else None
+        before = {pid: qty for _, pid, qty in rows if pid is not None}
+        lines = dict(before)
+        apply_changes(lines, changes)
+        subtotal, count = totals_delta(before, lines, prices)
+
+        if cart_id is None:
+            cart = CartQ(user_id=user_id, subtotal=subtotal, item_count=count)
+            db.add(cart)
+            db.flush()
+            cart_id = cart.id
+        elif subtotal or count:
+            db.execute(
+                update(CartQ)
+                .where(CartQ.id == cart_id)
+                .values(
+                    subtotal=CartQ.subtotal + subtotal,
+                    item_count=CartQ.item_count + count,
+                )
+            )
+
+        # Write each kind of line difference with one statement
+        added = [pid for pid in lines if pid not in before]
+        changed = [pid for pid in lines if pid in before and lines[pid] != before[pid]]
+        removed = [pid for pid in before if pid not in lines]
+        if added:
+            db.execute(
+                insert(CartItemQ),
+                [
+                    {"cart_id": cart_id, "product_id": pid, "quantity": lines[pid]}
+                    for pid in added
+                ],
+            )
+        if changed:
+            db.connection(bind_arguments={"mapper": CartItemQ}).execute(
+                update(CartItemQ)
+                .where(
+                    CartItemQ.cart_id == cart_id,
+                    CartItemQ.product_id == bindparam("pid"),
+                )
+                .values(quantity=bindparam("qty")),
+                [{"pid": pid, "qty": lines[pid]} for pid in changed],
+            )
+        if removed:
+            db.execute(
+                delete(CartItemQ).where(
+                    CartItemQ.cart_id == cart_id, CartItemQ.product_id.in_(removed)
+                )
+            )
+        db.commit()
+
+    def reprice(self, db: Session, product_id: int, old_price: float, new_price: float):
+        if sharding.shard_map is not None:
+            # Shards can't join the products table, so shift the totals
+            for shard in range(len(sharding.shard_map.engines)):
+                sharding.use_shard(db, shard)
+                db.execute(shift_totals(product_id, new_price - old_price))
+            return
+        # Recompute the affected carts from current prices rather than
+        # shifting them, which also corrects any earlier drift
+        CartItemQ = CartItem.__sqlmodel__
+        db.flush()
+        db.execute(
+            recompute_totals().where(
+                Cart.__sqlmodel__.id.in_(
+                    select(CartItemQ.cart_id).where(CartItemQ.product_id == product_id)
+                )
+            )
+        )
+
+    def clear(self, db: Session, user_id: int):
+        sharding.route(db, user_id)
+        CartQ = Cart.__sqlmodel__
+        CartItemQ = CartItem.__sqlmodel__
+        cart_id = db.query(CartQ.id).filter(CartQ.user_id == user_id).scalar()
+        db.query(CartItemQ).filter(CartItemQ.cart_id == cart_id).delete()
+        db.query(CartQ).filter(CartQ.id == cart_id).delete()
+
+    def get_json(self, db: Session, user_id: int) -> Optional[bytes]:
+        if sharding.shard_map is not None:
+            # The products are on another database
+            return super().get_json(db, user_id)
+        # One joined query instead of the cart, then its products
+        CartQ = Cart.__sqlmodel__
+        CartItemQ = CartItem.__sqlmodel__
+        ProductQ = Product.__sqlmodel__
+        rows = db.execute(
+            select(
+                CartQ.id,
+                CartQ.subtotal,
+                CartQ.item_count,
+                CartItemQ.quantity,
+                *columns_for(ProductOut, ProductQ),
+            )
+            .outerjoin(CartItemQ, CartItemQ.cart_id == CartQ.id)
+            .outerjoin(ProductQ, ProductQ.id == CartItemQ.product_id)
+            .where(CartQ.user_id == user_id)
+            .order_by(CartItemQ.id)
+        ).all()
+        if not rows:
+            return None
+        return cart_json(
+            CartTotals(*rows[0][:3]),
+            [
+                (quantity, product)
+                for _, _, _, quantity, *product in rows
+                if quantity is not None  # an empty cart
+            ],
+        )
+
+
+def recompute_totals():
+    """UPDATE carts setting subtotal and item_count from current prices."""
+    CartQ = Cart.__sqlmodel__
+    CartItemQ = CartItem.__sqlmodel__
+    ProductQ = Product.__sqlmodel__
+    lines = CartItemQ.cart_id == CartQ.id
+    return update(CartQ).values(
+        subtotal=select(func.coalesce(func.sum(CartItemQ.quantity * ProductQ.price), 0))
+        .join(ProductQ, ProductQ.id == CartItemQ.product_id)
+        .where(lines)
+        .scalar_subquery(),
+        item_count=select(func.coalesce(func.sum(CartItemQ.quantity), 0))
+        .where(lines)
+        .scalar_subquery(),
+    )
+
+
+def shift_totals(product_id: int, price_change: float):
+    """UPDATE carts holding ``product_id`` for a change of its price."""
+    CartQ = Cart.__sqlmodel__
+    CartItemQ = CartItem.__sqlmodel__
+    holding = and_(CartItemQ.cart_id == CartQ.id, CartItemQ.product_id == product_id)
+    return (
+        update(CartQ)
+        .where(
+            CartQ.id.in_(
+                select(CartItemQ.cart_id).where(CartItemQ.product_id == product_id)
+            )
+        )
+        .values(
+            subtotal=CartQ.subtotal
+            + price_change
+            * select(func.sum(CartItemQ.quantity)).where(holding).scalar_subquery()
+        )
+    )
+
+
+def migrate(engine: Engine):
+    """Add the totals columns to an existing carts table and fill them in."""
+    columns = {c["name"] for c in inspect(engine).get_columns("carts")}
+    with engine.begin() as conn:
+        if "subtotal" not in columns:
+            conn.exec_driver_sql(
+                "ALTER TABLE carts ADD COLUMN subtotal FLOAT NOT NULL DEFAULT 0"
+            )
+        if "item_count" not in columns:
+            conn.exec_driver_sql(
+                "ALTER TABLE carts ADD COLUMN item_count INTEGER NOT NULL DEFAULT 0"
+            )
+        conn.execute(recompute_totals())
+
+
+class MemoryCartStore(CartStore):
+    """Carts in this process only; for single-worker deployments and tests."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self._carts = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def get(self, db: Session, user_id: int) -> Optional[StoredCart]:
+        with self._lock:
+            cart = self._carts.get(user_id)
+            if cart is None:
+                return None
+            return StoredCart(cart.id, dict(cart.items), cart.subtotal, cart.item_count)
+
+    def apply(
+        self,
+        db: Session,
+        user_id: int,
+        changes: List[CartChange],
+        prices: Dict[int, float],
+    ):
+        with self._lock:
+            cart = self._carts.get(user_id) or StoredCart(id=next(self._ids))
+            before = dict(cart.items)
+            apply_changes(cart.items, changes)
+            subtotal, count = totals_delta(before, cart.items, prices)
+            cart.subtotal += subtotal
+            cart.item_count += count
+            # Setting it again restarts the TTL
+            self._carts.set(user_id, cart)
+
+    def reprice(self, db: Session, product_id: int, old_price: float, new_price: float):
+        with self._lock:
+            for cart in self._carts.values():
+                if product_id in cart.items:
+                    cart.subtotal += (new_price - old_price) * cart.items[product_id]
+
+    def clear(self, db: Session, user_id: int):
+        self._carts.invalidate(user_id)
+
+
+class RedisCartStore(CartStore):
+    """
+    One hash per cart, product id -> quantity, plus the cart id, subtotal
+    and item count under ``_id``, ``_subtotal`` and ``_count``. A write
+    reads the lines it changes and commits in one MULTI/EXEC, retried if
+    the cart changed in between; it also resets the TTL. Requires the
+    ``redis`` package; pass ``client`` to use an existing (or fake)
+    connection.
+    """
+
+    ID_FIELD = "_id"
+    SUBTOTAL_FIELD = "_subtotal"
+    COUNT_FIELD = "_count"
+
+    def __init__(
+        self, url: str = None, client=None, ttl: int = 0, namespace: str = "cart:"
+    ):
+        if client is None:
+            import redis
+
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.ttl = ttl
+        self.namespace = namespace
+
+    def _key(self, user_id: int) -> str:
+        return f"{self.namespace}{user_id}"
+
+    def get(self, db: Session, user_id: int) -> Optional[StoredCart]:
+        fields = self.client.hgetall(self._key(user_id))
+        if not fields:
+            return None
+        cart = StoredCart(
+            id=int(fields.pop(self.ID_FIELD.encode())),
+            subtotal=float(fields.pop(self.SUBTOTAL_FIELD.encode(), 0)),
+            item_count=int(fields.pop(self.COUNT_FIELD.encode(), 0)),
+        )
+        cart.items = {int(k): int(v) for k, v in fields.items()}
+        return cart
+
+    def get_totals(self, db: Session, user_id: int) -> Optional[CartTotals]:
+        cart_id, subtotal, count = self.client.hmget(
+            self._key(user_id), self.ID_FIELD, self.SUBTOTAL_FIELD, self.COUNT_FIELD
+        )
+        if cart_id is None:
+            return None
+        return CartTotals(int(cart_id), float(subtotal or 0), int(count or 0))
+
+    def apply(
+        self,
+        db: Session,
+        user_id: int,
+        changes: List[CartChange],
+        prices: Dict[int, float],
+    ):
+        key = self._key(user_id)
+        product_ids = list({c.product_id for c in changes})
+
+        def write(pipe):
+            quantities = pipe.hmget(key, product_ids)
+            before = {
+                pid: int(qty)
+                for pid, qty in zip(product_ids, quantities)
+                if qty is not None
+            }
+            lines = dict(before)
+            apply_changes(lines, changes)
+            subtotal, count = totals_delta(before, lines, prices)
+
+            pipe.multi()
+            # A random id keeps creation cheap; 53 bits stay exact in
+            # JavaScript clients
+            pipe.hsetnx(key, self.ID_FIELD, random.getrandbits(53))
+            for pid in product_ids:
+                if pid in lines:
+                    pipe.hset(key, pid, lines[pid])
+                elif pid in before:
+                    pipe.hdel(key, pid)
+            pipe.hincrbyfloat(key, self.SUBTOTAL_FIELD, subtotal)
+            pipe.hincrby(key, self.COUNT_FIELD, count)
+            if self.ttl:
+                pipe.expire(key, self.ttl)
+
+        self.client.transaction(write, key)
+
+    def reprice(self, db: Session, product_id: int, old_price: float, new_price: float):
+        # Walks every cart, so this is O(carts); prices change rarely. A
+        # cart written concurrently may drift until checkout.
+        keys = list(self.client.scan_iter(match=f"{self.namespace}*", count=1000))
+        pipe = self.client.pipeline(transaction=False)
+        for key in keys:
+            pipe.hget(key, product_id)
+        quantities = pipe.execute()
+        for key, quantity in zip(keys, quantities):
+            if quantity is not None:
+                change = (new_price - old_price) * int(quantity)
+                pipe.hincrbyfloat(key, self.SUBTOTAL_FIELD, change)
+        pipe.execute()
+
+    def clear(self, db: Session, user_id: int):
+        self.client.delete(self._key(user_id))
+
+
+def make_cart_store(kind: str) -> CartStore:
+    if kind == "sql":
+        return SQLCartStore()
+    if kind == "memory":
+        return MemoryCartStore(
+            maxsize=app_config.CART_STORE_SIZE, ttl=app_config.CART_TTL_SECONDS
+        )
+    if kind == "redis":
+        return RedisCartStore(
+            url=app_config.CART_STORE_URL, ttl=app_config.CART_TTL_SECONDS
+        )
+    raise ValueError(f"Unknown cart store: {kind}")
+
+
+cart_store = make_cart_store(app_config.CART_STORE)
+
+
+def get_cart_store() -> CartStore:
+    return cart_store
@@ -0,0 +1,261 @@
+"""
+Read-through cache for serialized catalog responses.
+
+Entries are JSON bytes under keys built by cache_key(), e.g. ``products:0:100:``
+or ``product:42:``. The first part is the key family that hit-rate metrics
+are reported under. Writes register invalidations on the SQLAlchemy session
+and they are applied once the transaction commits, so a reader can't
+re-cache data the writer is about to replace.
+
+An invalidation names either a single key or a whole family (``products:``).
+Every family has a version number that is part of the stored keys, so
+dropping a family is one counter increment rather than a scan for its keys;
+the orphaned entries age out with their TTL.
+
+Stock changes from checkouts only drop the products' own keys: listings
+may show stock up to CATALOG_CACHE_TTL_SECONDS old, and checkout checks
+the live stock anyway.
+"""
+
+import threading
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+from app.config import app_config
+from cache import TTLCache
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+
+def cache_key(family: str, *parts) -> str:
+    return ":".join([family, *map(str, parts)]) + ":"
+
+
+class LocalBackend:
+    """In-process LRU with per-entry TTL."""
+
+    def __init__(self, maxsize: int):
+        self._cache = TTLCache(maxsize=maxsize)
+        self._versions: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[bytes]:
+        return self._cache.get(key)
+
+    def set(self, key: str, value: bytes, ttl: int):
+        self._cache.set(key, value, expires_at=time.time() + ttl)
+
+    def delete(self, key: str):
+        self._cache.invalidate(key)
+
+    def version(self, family: str) -> int:
+        return self._versions.get(family, 0)
+
+    def bump(self, family: str):
+        with self._lock:
+            self._versions[family] = self._versions.get(family, 0) + 1
+
+    def clear(self):
+        self._cache.clear()
+
+
+class RedisBackend:
+    """
+    Shared cache speaking the Redis protocol. Requires the ``redis``
+    package; pass ``client`` to use an existing (or fake) connection.
+    """
+
+    def __init__(self, url: str = None, client=None, namespace: str = "catalog:"):
+        if client is None:
+            import redis
+
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.namespace = namespace
+
+    def get(self, key: str) -> Optional[bytes]:
+        return self.client.get(self.namespace + key)
+
+    def set(self, key: str, value: bytes, ttl: int):
+        self.client.set(self.namespace + key, value, ex=ttl)
+
+    def delete(self, key: str):
+        self.client.delete(self.namespace + key)
+
+    def version(self, family: str) -> int:
+        return int(self.client.get(f"{self.namespace}@version:{family}") or 0)
+
+    def bump(self, family: str):
+        self.client.incr(f"{self.namespace}@version:{family}")
+
+    def clear(self):
+        keys = list(self.client.scan_iter(match=f"{self.namespace}*"))
+        if keys:
+            self.client.delete(*keys)
+
+
+class NullBackend:
+    def get(self, key: str):
+        return None
+
+    def set(self, key: str, value: bytes, ttl: int):
+        pass
+
+    def delete(self, key: str):
+        pass
+
+    def version(self, family: str) -> int:
+        return 0
+
+    def bump(self, family: str):
+        pass
+
+    def clear(self):
+        pass
+
+
+class CatalogCache:
+    """
+    ``settle`` is how long after an invalidation loads aren't stored: with
+    read replicas, a load may read a replica that hasn't seen the write yet.
+    """
+
+    def __init__(self, backend, ttl: int, settle: float = 0.0):
+        self.backend = backend
+        self.ttl = ttl
+        self.settle = settle
+        self.metrics: Dict[str, Dict[str, int]] = {}
+        # Family or key -> (invalidations, time of the last one) in this
+        # process, to tell whether a load raced an invalidation
+        self._invalidations: Dict[str, Tuple[int, float]] = {}
+        self._inflight: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def _stored_key(self, key: str) -> str:
+        family, rest = key.split(":", 1)
+        return f"{family}:{self.backend.version(family)}:{rest}"
+
+    def _unchanged_since(self, scopes, seen) -> bool:
+        """Whether ``scopes`` still match ``seen`` and are past the settle time."""
+        now = time.monotonic()
+        for scope, before in zip(scopes, seen):
+            after = self._invalidations.get(scope, (0, float("-inf")))
+            if after != before or now - after[1] < self.settle:
+                return False
+        return True
+
+    def _count(self, key: str, outcome: str):
+        family = key.split(":", 1)[0]
+        with self._lock:
+            counters = self.metrics.setdefault(
+                family, {"hits": 0, "misses": 0, "coalesced": 0}
+            )
+            counters[outcome] += 1
+
+    def get_or_load(self, key: str, loader: Callable[[], bytes]) -> bytes:
+        """
+        Return the cached bytes for ``key``, calling ``loader`` on a miss.
+        Concurrent misses for one key share a single load (single-flight).
+        """
+        stored_key = self._stored_key(key)
+        value = self.backend.get(stored_key)
+        if value is not None:
+            self._count(key, "hits")
+            return value
+
+        with self._lock:
+            flight = self._inflight.setdefault(key, threading.Lock())
+        with flight:
+            stored_key = self._stored_key(key)
+            value = self.backend.get(stored_key)
+            if value is not None:
+                self._count(key, "coalesced")
+                return value
+            scopes = (key.split(":", 1)[0] + ":", key)
+            never = (0, float("-inf"))
+            seen = [self._invalidations.get(scope, never) for scope in scopes]
+            try:
+                value = loader()
+            finally:
+                with self._lock:
+                    self._inflight.pop(key, None)
+            self._count(key, "misses")
+            # Don't store what was read before an invalidation landed
+            if self._unchanged_since(scopes, seen):
+                self.backend.set(stored_key, value, self.ttl)
+            return value
+
+    def invalidate(self, *keys: str):
+        """Drop each key, or each whole family given as ``family:``."""
+        now = time.monotonic()
+        with self._lock:
+            for key in keys:
+                count, _ = self._invalidations.get(key, (0, 0.0))
+                self._invalidations[key] = (count + 1, now)
+        for key in keys:
+            family, rest = key.split(":", 1)
+            if rest:
+                self.backend.delete(self._stored_key(key))
+            else:
+                self.backend.bump(family)
+
+    def invalidate_on_commit(self, db: Session, *keys: str):
+        db.info.setdefault("catalog_cache_invalidations", []).append((self, keys))
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = {}
+            for family, counters in self.metrics.items():
+                lookups = sum(counters.values())
+                hits = counters["hits"] + counters["coalesced"]
+                stats[family] = {**counters, "hit_rate": hits / lookups}
+            return stats
+
+    def clear(self):
+        self.backend.clear()
+        with self._lock:
+            self._invalidations.clear()
+            self.metrics.clear()
+
+
+def make_backend(kind: str):
+    if kind == "local":
+        return LocalBackend(maxsize=app_config.CATALOG_CACHE_SIZE)
+    if kind == "redis":
+        return RedisBackend(url=app_config.CATALOG_CACHE_URL)
+    if kind == "none":
+        return NullBackend()
+    raise ValueError(f"Unknown catalog cache backend: {kind}")
+
+
+catalog_cache = CatalogCache(
+    make_backend(app_config.CATALOG_CACHE_BACKEND),
+    ttl=app_config.CATALOG_CACHE_TTL_SECONDS,
+    settle=(
+        app_config.READ_YOUR_WRITES_SECONDS if app_config.DATABASE_REPLICA_URLS else 0.0
+    ),
+)
+
+
+def invalidate_categories(db: Session):
+    catalog_cache.invalidate_on_commit(db, cache_key("categories"))
+
+
+def invalidate_products(db: Session, product_ids=()):
+    """Drop cached product listings, and the given products, once db commits."""
+    catalog_cache.invalidate_on_commit(
+        db,
+        cache_key("products"),
+        *[cache_key("product", product_id) for product_id in product_ids],
+    )
+
+
+@event.listens_for(Session, "after_commit")
+def _apply_invalidations(session: Session):
+    for cache, keys in session.info.pop("catalog_cache_invalidations", ()):
+        cache.invalidate(*keys)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_invalidations(session: Session):
+    session.info.pop("catalog_cache_invalidations", None)
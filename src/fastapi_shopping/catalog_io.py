@@ -0,0 +1,178 @@
+"""
+Streaming bulk import and export of products as NDJSON or CSV.
+
+Imports read the request body incrementally and never hold more than one
+batch of rows: each batch is validated, checked against the existing
+categories and inserted with a single executemany in its own transaction.
+Invalid rows are reported back by row number and skipped; they don't abort
+their batch. Exports page through the table by primary key, so memory use
+stays flat however large the catalog is.
+"""
+
+import csv
+import io
+import json
+from typing import AsyncIterator, Dict, Iterator, List, Tuple
+
+from app.config import app_config
+from catalog_cache import invalidate_products
+from models import Category, Product
+from pydantic import ValidationError
+from pydantic_models import ProductCreate
+from sqlalchemy import insert, select
+from sqlalchemy.orm import Session
+
+PRODUCT_COLUMNS = ("id", "name", "description", "price", "stock", "category_id")
+
+MEDIA_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+
+async def iter_lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    """
+    Split a byte stream into lines, keeping the line endings. Lines stay
+    bytes so a row that isn't valid UTF-8 is reported like any other bad row.
+    """
+    buffer = b""
+    async for chunk in chunks:
+        *lines, buffer = (buffer + chunk).split(b"\n")
+        for line in lines:
+            yield line + b"\n"
+    if buffer:
+        yield buffer
+
+
+async def iter_batches(
+    lines: AsyncIterator[bytes], format: str, batch_size: int
+) -> AsyncIterator[List[Tuple[int, object]]]:
+    """
+    Group parsed records into batches of (row number, record) pairs. A
+    record is a dict, or the exception that made its row unparseable.
+    """
+    batch: List[Tuple[int, object]] = []
+    row = 0
+    if format == "ndjson":
+        async for line in lines:
+            if not line.strip():
+                continue
+            row += 1
+            try:
+                # UnicodeDecodeError is a ValueError too
+                batch.append((row, json.loads(line.decode())))
+            except ValueError as exc:
+                batch.append((row, exc))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+    else:
+        # Only cut between lines where every quoted field is closed, so a
+        # quoted newline never splits a record across two csv readers.
+        # Undecodable bytes are kept as surrogates and checked per record.
+        header, pending, quotes = None, [], 0
+        async for line in lines:
+            text = line.decode(errors="surrogateescape")
+            pending.append(text)
+            quotes += text.count('"')
+            if quotes % 2 or len(pending) < batch_size:
+                continue
+            header, records = _read_csv(header, pending)
+            for record in records:
+                row += 1
+                batch.append((row, record))
+            pending, quotes = [], 0
+            yield batch
+            batch = []
+        header, records = _read_csv(header, pending)
+        for record in records:
+            row += 1
+            batch.append((row, record))
+    if batch:
+        yield batch
+
+
+def _read_csv(header, lines: List[str]):
+    reader = csv.reader(lines)
+    if header is None:
+        header = next(reader, None)
+    records = [_utf8_record(dict(zip(header, values))) for values in reader if values]
+    return header, records
+
+
+def _utf8_record(record: Dict[str, str]):
+    """``record``, or the error if any of it wasn't valid UTF-8."""
+    for value in record.values():
+        try:
+            value.encode()
+        except UnicodeEncodeError:
+            return ValueError("not valid UTF-8")
+    return record
+
+
+def import_batch(db: Session, batch: List[Tuple[int, object]]):
+    """
+    Validate and insert one batch. Returns the number of rows inserted and
+    a list of {"row", "error"} dicts for the rows that were skipped.
+    """
+    errors = []
+    valid: List[Tuple[int, Dict]] = []
+    for row, record in batch:
+        if isinstance(record, Exception):
+            errors.append({"row": row, "error": f"Unparseable row: {record}"})
+            continue
+        try:
+            product = ProductCreate.model_validate(record)
+        except ValidationError as exc:
+            message = "; ".join(
+                f"{'.'.join(map(str, e['loc']))}: {e['msg']}" for e in exc.errors()
+            )
+            errors.append({"row": row, "error": message})
+            continue
+        valid.append((row, product.model_dump()))
+
+    CategoryQ = Category.__sqlmodel__
+    referenced = {values["category_id"] for _, values in valid}
+    known = set(
+        db.execute(select(CategoryQ.id).where(CategoryQ.id.in_(referenced))).scalars()
+    )
+    rows = []
+    for row, values in valid:
+        if values["category_id"] in known:
+            rows.append(values)
+        else:
+            errors.append({"row": row, "error": "category_id: Category not found"})
+
+    if rows:
+        db.execute(insert(Product.__sqlmodel__), rows)
+        invalidate_products(db)
+        db.commit()
+    return len(rows), sorted(errors, key=lambda e: e["row"])
+
+
+def export_products(db: Session, format: str, chunk_size: int = None) -> Iterator[str]:
+    """Yield the product table as NDJSON or CSV, one chunk of rows at a time."""
+    chunk_size = chunk_size or app_config.CATALOG_EXPORT_CHUNK_SIZE
+    ProductQ = Product.__sqlmodel__
+    columns = [getattr(ProductQ, name) for name in PRODUCT_COLUMNS]
+    if format == "csv":
+        yield ",".join(PRODUCT_COLUMNS) + "\r\n"
+
+    last_id = 0
+    while True:
+        rows = db.execute(
+            select(*columns)
+            .where(ProductQ.id > last_id)
+            .order_by(ProductQ.id)
+            .limit(chunk_size)
+        ).all()
+        if not rows:
+            return
+        last_id = rows[-1][0]
+        if format == "csv":
+            out = io.StringIO()
+            csv.writer(out).writerows(rows)
+            yield out.getvalue()
+        else:
+            yield "".join(
+                json.dumps(dict(zip(PRODUCT_COLUMNS, row))) + "\n" for row in rows
+            )
+        # Don't hold the read transaction open while the client catches up
+        db.rollback()
@@ -1,36 +1,18 @@
-from dataclasses import dataclass
 from unittest.mock import patch
 
 import pytest
-
-
-@dataclass
-class PaymentIntent:
-    id: str
-    client_secret: str
-    amount: int
-    currency: str
-    status: str
+from gateway import FakeGateway
 
 
 @pytest.fixture
 def mock_payment_intent():
     """
-    Fixture that mocks Stripe PaymentIntent.create()
+    Fixture that swaps the payment gateway for an in-process fake. Yields
+    the fake, whose ``intents`` holds every payment intent created.
     """
-    mock_intent = PaymentIntent(
-        **{
-            "id": "pi_test_123",
-            "client_secret": "pi_test_secret_123",
-            "amount": 2000,
-            "currency": "usd",
-            "status": "succeeded",
-        }
-    )
-
-    with patch("stripe.PaymentIntent.create") as mock_create:
-        mock_create.return_value = mock_intent
-        yield mock_create
+    fake = FakeGateway()
+    with patch("gateway.payment_gateway", fake):
+        yield fake
 
 
 @pytest.fixture
@@ -38,7 +20,11 @@ def mock_webhook():
     """
     Fixture that mocks Stripe webhook
     """
-    mock_event = {"type": {"payment_intent": "succeeded"}}
+    mock_event = {
+        "id": "evt_test_123",
+        "type": "payment_intent.succeeded",
+        "data": {"object": {"id": "pi_test_123", "object": "payment_intent"}},
+    }
 
     with patch("stripe.Webhook.construct_event") as mock_construct:
         mock_construct.return_value = mock_event
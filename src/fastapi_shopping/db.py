@@ -1,16 +1,246 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+import itertools
+import threading
+import time
+from typing import List, Optional
+
+from app.config import app_config
+from cache import TTLCache
+from fastapi import Request
+from profiler import profiler
+from sqlalchemy import create_engine, event, inspect
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+from starlette.concurrency import run_in_threadpool
+from tokens import InvalidTokenError, decode_access_token
+
+
+class _CheckoutTimer:
+    """Pool mixin that records how long callers wait for a connection."""
+
+    checkout_wait_total = 0.0
+    checkout_wait_max = 0.0
+    checkouts = 0
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            waited = time.perf_counter() - start
+            self.checkouts += 1
+            self.checkout_wait_total += waited
+            self.checkout_wait_max = max(self.checkout_wait_max, waited)
+
+
+class InstrumentedQueuePool(_CheckoutTimer, QueuePool):
+    pass
+
+
+class InstrumentedAsyncQueuePool(_CheckoutTimer, AsyncAdaptedQueuePool):
+    pass
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"PRAGMA journal_mode={app_config.SQLITE_JOURNAL_MODE}")
+    cursor.execute(f"PRAGMA synchronous={app_config.SQLITE_SYNCHRONOUS}")
+    cursor.execute(f"PRAGMA busy_timeout={app_config.SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.execute(f"PRAGMA mmap_size={app_config.SQLITE_MMAP_SIZE}")
+    cursor.execute(f"PRAGMA cache_size={app_config.SQLITE_CACHE_SIZE}")
+    cursor.close()
+
+
+def create_db_engine(url: str, is_async: bool = False):
+    """
+    Build an engine with the pool settings from AppConfig. SQLite connections
+    get the tuned pragma profile; in-memory SQLite keeps its default pool.
+    """
+    sa_url = make_url(url)
+    is_sqlite = sa_url.get_backend_name() == "sqlite"
+    kwargs = {"pool_pre_ping": app_config.DB_POOL_PRE_PING}
+    if not (is_sqlite and sa_url.database in (None, "", ":memory:")):
+        kwargs.update(
+            poolclass=InstrumentedAsyncQueuePool if is_async else InstrumentedQueuePool,
+            pool_size=app_config.DB_POOL_SIZE,
+            max_overflow=app_config.DB_MAX_OVERFLOW,
+            pool_timeout=app_config.DB_POOL_TIMEOUT,
+            pool_recycle=app_config.DB_POOL_RECYCLE,
+        )
+    if is_sqlite:
+        kwargs["connect_args"] = {"check_same_thread": False}
+
+    new_engine = (create_async_engine if is_async else create_engine)(url, **kwargs)
+    if is_sqlite:
+        sync_engine = new_engine.sync_engine if is_async else new_engine
+        event.listen(sync_engine, "connect", _set_sqlite_pragmas)
+    return new_engine
+
+
+def pool_stats(db_engine) -> dict:
+    """Gauges for the engine's connection pool."""
+    pool = getattr(db_engine, "sync_engine", db_engine).pool
+    stats = {"checked_out": pool.checkedout() if hasattr(pool, "checkedout") else 0}
+    if isinstance(pool, QueuePool):
+        stats.update(size=pool.size(), overflow=pool.overflow())
+    # Only the pools built by create_db_engine() time their checkouts
+    if isinstance(pool, _CheckoutTimer):
+        stats.update(
+            checkouts=pool.checkouts,
+            checkout_wait_seconds_total=pool.checkout_wait_total,
+            checkout_wait_seconds_max=pool.checkout_wait_max,
+        )
+    return stats
+
+
+class ShardNotSelected(RuntimeError):
+    """A sharded table was used before sharding.route() picked a shard."""
+
+
+class RoutingSession(Session):
+    """
+    Sends statements on tables marked sharded (see sharding.py) to the
+    engine in ``info["shard_engine"]``, and everything else to its bind.
+    """
+
+    def get_bind(self, mapper=None, clause=None, **kw):
+        if mapper is not None:
+            table = inspect(mapper).local_table
+            if table.info.get("sharded"):
+                shard_engine = self.info.get("shard_engine")
+                if shard_engine is None:
+                    raise ShardNotSelected(f"{table.name} is sharded, route first")
+                return shard_engine
+        return super().get_bind(mapper, clause=clause, **kw)
+
 
 # Database setup
-SQLALCHEMY_DATABASE_URL = "sqlite:///./shopify_clone.db"
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+SQLALCHEMY_DATABASE_URL = app_config.DATABASE_URL
+engine = create_db_engine(SQLALCHEMY_DATABASE_URL)
+SessionLocal = sessionmaker(
+    autocommit=False, autoflush=False, bind=engine, class_=RoutingSession
+)
+
+# Async database setup (aiosqlite locally, asyncpg in production). Objects
+# stay loaded after commit since they can't lazily refresh outside run_db().
+async_engine = None
+AsyncSessionLocal = None
+if app_config.DATABASE_ASYNC:
+    async_engine = create_db_engine(app_config.ASYNC_DATABASE_URL, is_async=True)
+    AsyncSessionLocal = async_sessionmaker(
+        bind=async_engine, autoflush=False, expire_on_commit=False
+    )
+
+
+class ReplicaRouter:
+    """
+    Picks the replica engine for each read-only session, in turn
+    ("round_robin") or the one with the fewest checked out connections
+    ("least_connections").
+    """
+
+    def __init__(self, engines: List[Engine], selection: str = "round_robin"):
+        if selection not in ("round_robin", "least_connections"):
+            raise ValueError(f"Unknown replica selection: {selection}")
+        self.engines = engines
+        self.selection = selection
+        self._turn = itertools.cycle(range(len(engines)))
+        self._lock = threading.Lock()
+
+    def choose(self) -> Engine:
+        if self.selection == "least_connections":
+            return min(self.engines, key=lambda e: e.pool.checkedout())
+        with self._lock:
+            return self.engines[next(self._turn)]
+
+
+replica_router: Optional[ReplicaRouter] = None
+if app_config.DATABASE_REPLICA_URLS:
+    replica_router = ReplicaRouter(
+        [create_db_engine(url) for url in app_config.DATABASE_REPLICA_URLS],
+        app_config.DB_REPLICA_SELECTION,
+    )
+ReplicaSessionLocal = sessionmaker(
+    autocommit=False, autoflush=False, class_=RoutingSession
+)
+
+# Clients that committed a write recently, and so read from the primary
+recent_writers = TTLCache(
+    maxsize=app_config.READ_YOUR_WRITES_CLIENTS,
+    ttl=app_config.READ_YOUR_WRITES_SECONDS,
+)
+
+
+def client_key(request: Request) -> Optional[str]:
+    """Who a request comes from: its token's subject, else its address."""
+    scheme, _, token = request.headers.get("authorization", "").partition(" ")
+    if scheme.lower() == "bearer" and token:
+        try:
+            return "user:" + decode_access_token(token)["sub"]
+        except (InvalidTokenError, KeyError):
+            pass
+    return "addr:" + request.client.host if request.client else None
+
+
+def read_session(client: Optional[str], router: Optional[ReplicaRouter]) -> Session:
+    """A session for reads: on a replica, unless ``client`` wrote recently."""
+    if router is None or (client is not None and recent_writers.get(client)):
+        return SessionLocal()
+    return ReplicaSessionLocal(bind=router.choose())
+
+
+@event.listens_for(Session, "after_commit")
+def _remember_writer(session: Session):
+    client = session.info.get("client")
+    if client is not None:
+        recent_writers.set(client, True)
 
 
 # Database dependency
-def get_db():
+def get_db(request: Request):
     db = SessionLocal()
+    if replica_router is not None:
+        db.info["client"] = client_key(request)
     try:
         yield db
     finally:
         db.close()
+
+
+async def get_async_db(request: Request):
+    async with AsyncSessionLocal() as db:
+        if replica_router is not None:
+            db.info["client"] = client_key(request)
+        yield db
+
+
+def get_replica_db(request: Request):
+    db = read_session(client_key(request), replica_router)
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+# Session dependency for async def handlers. Pair it with run_db() so the
+# queries never run on the event loop, whichever session type is configured.
+get_session = get_async_db if app_config.DATABASE_ASYNC else get_db
+
+# Session dependency for read-only handlers, served by a replica when
+# DATABASE_REPLICA_URLS is set. It is get_db itself otherwise, so reads
+# pay nothing for routing. Async sessions always use the primary.
+get_read_db = get_replica_db if replica_router is not None else get_db
+get_read_session = get_async_db if app_config.DATABASE_ASYNC else get_read_db
+
+
+async def run_db(db, fn, *args):
+    """
+    Call ``fn(session, *args)`` without blocking the event loop.
+
+    An AsyncSession runs ``fn`` through ``run_sync`` so lazy loads stay non
+    blocking; a plain Session runs it on the threadpool.
+    """
+    if isinstance(db, AsyncSession):
+        return await db.run_sync(fn, *args)
+    return await run_in_threadpool(profiler.tagged(fn), db, *args)
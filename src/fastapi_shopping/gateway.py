@@ -0,0 +1,241 @@
+"""
+Async payment gateway.
+
+Checkout talks to the payment provider through a PaymentGateway instead of
+the blocking ``stripe`` client, so a slow provider only holds up the
+checkouts waiting on it, not the event loop. StripeGateway calls the Stripe
+REST API over one pooled httpx.AsyncClient with per-call timeouts, and sends
+an Idempotency-Key so a retried checkout can't create a second intent.
+
+A CircuitBreaker stops calling a provider that keeps failing: after
+``failure_threshold`` consecutive failures (timeouts, connection errors,
+5xx) calls fail fast with GatewayUnavailable for ``reset_timeout`` seconds,
+then a single trial call decides whether to close it again. Declines and
+other 4xx errors are the caller's problem and don't count.
+
+FakeGateway is an in-process stand-in for tests and benchmarks, with
+optional injected latency and failures.
+"""
+
+import abc
+import asyncio
+import random
+import time
+import uuid
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Dict, Optional
+
+from app.config import app_config
+
+if TYPE_CHECKING:
+    import httpx
+
+
+@dataclass
+class PaymentIntent:
+    id: str
+    client_secret: str
+    amount: int
+    currency: str
+    status: str
+
+
+class PaymentError(Exception):
+    """The provider rejected the request, e.g. an invalid amount."""
+
+
+class GatewayUnavailable(PaymentError):
+    """The provider timed out, failed, or the circuit breaker is open."""
+
+    def __init__(self, message: str, retry_after: float = 1.0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._trial_running = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def before_call(self):
+        state = self.state
+        if state == "open" or (state == "half-open" and self._trial_running):
+            remaining = self.opened_at + self.reset_timeout - time.monotonic()
+            raise GatewayUnavailable(
+                "Payment provider unavailable, try again later",
+                retry_after=max(remaining, 1.0),
+            )
+        if state == "half-open":
+            self._trial_running = True
+
+    def end_trial(self):
+        """Let another half-open trial call through, whatever this one did."""
+        self._trial_running = False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.opened_at is not None or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+
+
+class PaymentGateway(abc.ABC):
+    @abc.abstractmethod
+    async def create_payment_intent(
+        self,
+        amount: int,
+        currency: str,
+        metadata: Dict[str, str],
+        idempotency_key: str,
+    ) -> PaymentIntent:
+        """Create an intent, or return the one already made for the key."""
+
+    async def aclose(self):
+        pass
+
+
+class StripeGateway(PaymentGateway):
+    def __init__(
+        self,
+        api_key: str,
+        base_url: str = "https://api.stripe.com",
+        timeout: float = 10.0,
+        max_connections: int = 100,
+        breaker: Optional[CircuitBreaker] = None,
+        transport: Optional["httpx.AsyncBaseTransport"] = None,
+    ):
+        import httpx
+
+        self.breaker = breaker or CircuitBreaker(
+            app_config.STRIPE_BREAKER_FAILURES, app_config.STRIPE_BREAKER_RESET_SECONDS
+        )
+        self.client = httpx.AsyncClient(
+            base_url=base_url,
+            auth=(api_key, ""),
+            timeout=httpx.Timeout(timeout),
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+            ),
+            transport=transport,
+        )
+
+    async def create_payment_intent(
+        self,
+        amount: int,
+        currency: str,
+        metadata: Dict[str, str],
+        idempotency_key: str,
+    ) -> PaymentIntent:
+        import httpx
+
+        form = {"amount": amount, "currency": currency}
+        form.update({f"metadata[{k}]": v for k, v in metadata.items()})
+        self.breaker.before_call()
+        try:
+            response = await self.client.post(
+                "/v1/payment_intents",
+                data=form,
+                headers={"Idempotency-Key": idempotency_key},
+            )
+        except httpx.HTTPError as exc:
+            self.breaker.record_failure()
+            raise GatewayUnavailable(f"Payment provider unreachable: {exc!r}")
+        finally:
+            # A cancelled or otherwise failed trial call mustn't keep the
+            # breaker waiting on it
+            self.breaker.end_trial()
+        if response.status_code >= 500 or response.status_code == 429:
+            self.breaker.record_failure()
+            raise GatewayUnavailable(
+                f"Payment provider error (HTTP {response.status_code})"
+            )
+        self.breaker.record_success()
+        body = response.json()
+        if response.status_code >= 400:
+            raise PaymentError(body.get("error", {}).get("message", response.text))
+        return PaymentIntent(
+            id=body["id"],
+            client_secret=body["client_secret"],
+            amount=body["amount"],
+            currency=body["currency"],
+            status=body["status"],
+        )
+
+    async def aclose(self):
+        await self.client.aclose()
+
+
+class FakeGateway(PaymentGateway):
+    """
+    Succeeds after ``latency`` seconds, or fails with GatewayUnavailable at
+    ``failure_rate``. Like Stripe, a repeated idempotency key returns the
+    intent created the first time.
+    """
+
+    def __init__(self, latency: float = 0.0, failure_rate: float = 0.0):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.intents: Dict[str, PaymentIntent] = {}
+        self.calls = 0
+
+    async def create_payment_intent(
+        self,
+        amount: int,
+        currency: str,
+        metadata: Dict[str, str],
+        idempotency_key: str,
+    ) -> PaymentIntent:
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.failure_rate and random.random() < self.failure_rate:
+            raise GatewayUnavailable("Injected payment provider failure")
+        if idempotency_key not in self.intents:
+            intent_id = f"pi_fake_{uuid.uuid4().hex[:24]}"
+            self.intents[idempotency_key] = PaymentIntent(
+                id=intent_id,
+                client_secret=f"{intent_id}_secret",
+                amount=amount,
+                currency=currency,
+                status="requires_payment_method",
+            )
+        return self.intents[idempotency_key]
+
+
+def make_gateway(kind: str) -> PaymentGateway:
+    if kind == "stripe":
+        return StripeGateway(
+            app_config.STRIPE_API_KEY,
+            base_url=app_config.STRIPE_API_BASE,
+            timeout=app_config.STRIPE_TIMEOUT_SECONDS,
+            max_connections=app_config.STRIPE_MAX_CONNECTIONS,
+        )
+    if kind == "fake":
+        return FakeGateway(latency=app_config.FAKE_GATEWAY_LATENCY_SECONDS)
+    raise ValueError(f"Unknown payment gateway: {kind}")
+
+
+# Built on first use, so importing the app doesn't import httpx
+payment_gateway: Optional[PaymentGateway] = None
+
+
+def get_payment_gateway() -> PaymentGateway:
+    global payment_gateway
+    if payment_gateway is None:
+        payment_gateway = make_gateway(app_config.PAYMENT_GATEWAY)
+    return payment_gateway
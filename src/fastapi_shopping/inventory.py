@@ -0,0 +1,203 @@
+"""
+Stock reservations.
+
+Stock only ever changes through conditional UPDATEs (``stock >= qty``), so
+parallel buyers can't oversell and nothing is read-modified-written in
+Python. A checkout reserves stock up front; the reservation is committed
+when payment succeeds or released when the checkout is cancelled or expires.
+Every transition is a conditional UPDATE on the reservation status, which
+makes commit and release idempotent: a replayed webhook or a second sweeper
+finds nothing left to do.
+"""
+
+import asyncio
+import datetime
+import logging
+from typing import Dict, Optional
+
+import sharding
+from app.config import app_config
+from catalog_cache import invalidate_products
+from models import Order, Product, StockReservation
+from sqlalchemy import bindparam, insert, select, update
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+logger = logging.getLogger(__name__)
+
+HELD = "held"
+COMMITTED = "committed"
+RELEASED = "released"
+
+
+class InsufficientStock(Exception):
+    pass
+
+
+def _take_stock(db: Session, quantities: Dict[int, int]) -> bool:
+    """Decrement stock for every product, guarded by stock >= qty."""
+    ProductQ = Product.__sqlmodel__
+    invalidate_products(db, quantities)
+    statement = (
+        update(ProductQ)
+        .where(ProductQ.id == bindparam("pid"), ProductQ.stock >= bindparam("qty"))
+        .values(stock=ProductQ.stock - bindparam("qty"))
+    )
+    params = [{"pid": pid, "qty": qty} for pid, qty in quantities.items()]
+    connection = db.connection()
+    # Only some drivers report the rows matched by an executemany; elsewhere
+    # run one UPDATE per product and count its rows
+    if connection.dialect.supports_sane_multi_rowcount:
+        updated = connection.execute(statement, params).rowcount
+    else:
+        updated = sum(connection.execute(statement, p).rowcount for p in params)
+    return updated == len(quantities)
+
+
+def _return_stock(db: Session, quantities: Dict[int, int]):
+    ProductQ = Product.__sqlmodel__
+    invalidate_products(db, quantities)
+    db.connection().execute(
+        update(ProductQ)
+        .where(ProductQ.id == bindparam("pid"))
+        .values(stock=ProductQ.stock + bindparam("qty")),
+        [{"pid": pid, "qty": qty} for pid, qty in quantities.items()],
+    )
+
+
+def _claim(db: Session, order_id: int, from_status: str, to_status: str):
+    """Move an order's reservations between states, returning the rows moved."""
+    ReservationQ = StockReservation.__sqlmodel__
+    rows = db.execute(
+        update(ReservationQ)
+        .where(ReservationQ.order_id == order_id, ReservationQ.status == from_status)
+        .values(status=to_status)
+        .returning(ReservationQ.product_id, ReservationQ.quantity)
+    ).all()
+    quantities: Dict[int, int] = {}
+    for product_id, quantity in rows:
+        quantities[product_id] = quantities.get(product_id, 0) + quantity
+    return quantities
+
+
+def reserve(
+    db: Session,
+    order_id: int,
+    quantities: Dict[int, int],
+    ttl: Optional[int] = None,
+):
+    """
+    Hold ``quantities`` (product id -> units) for ``order_id``.
+
+    Either every line is reserved or InsufficientStock is raised, in which
+    case the caller must roll back the transaction.
+    """
+    if not _take_stock(db, quantities):
+        raise InsufficientStock(f"Insufficient stock for order {order_id}")
+
+    ttl = app_config.RESERVATION_TTL_SECONDS if ttl is None else ttl
+    expires_at = datetime.datetime.utcnow() + datetime.timedelta(seconds=ttl)
+    ReservationQ = StockReservation.__sqlmodel__
+    db.execute(
+        insert(ReservationQ),
+        [
+            {
+                "order_id": order_id,
+                "product_id": product_id,
+                "quantity": quantity,
+                "status": HELD,
+                "expires_at": expires_at,
+            }
+            for product_id, quantity in quantities.items()
+        ],
+    )
+
+
+def commit(db: Session, order_id: int) -> bool:
+    """
+    Make the stock held for ``order_id`` permanent.
+
+    Reservations that already expired are re-taken if stock allows. Returns
+    False when that fails, i.e. the order can't be fulfilled from stock.
+    """
+    _claim(db, order_id, HELD, COMMITTED)
+    ReservationQ = StockReservation.__sqlmodel__
+    released = db.execute(
+        select(ReservationQ.product_id, ReservationQ.quantity).where(
+            ReservationQ.order_id == order_id, ReservationQ.status == RELEASED
+        )
+    ).all()
+    if not released:
+        return True
+
+    quantities: Dict[int, int] = {}
+    for product_id, quantity in released:
+        quantities[product_id] = quantities.get(product_id, 0) + quantity
+    if not _take_stock(db, quantities):
+        return False
+    _claim(db, order_id, RELEASED, COMMITTED)
+    return True
+
+
+def release(db: Session, order_id: int):
+    """Return any stock still held for ``order_id``."""
+    quantities = _claim(db, order_id, HELD, RELEASED)
+    if quantities:
+        _return_stock(db, quantities)
+    return quantities
+
+
+def release_expired(db: Session, now: Optional[datetime.datetime] = None) -> int:
+    """
+    Release reservations of abandoned checkouts and mark their orders
+    expired. Returns the number of orders released.
+    """
+    now = now or datetime.datetime.utcnow()
+    ReservationQ = StockReservation.__sqlmodel__
+    OrderQ = Order.__sqlmodel__
+    order_ids = (
+        db.execute(
+            select(ReservationQ.order_id)
+            .where(ReservationQ.status == HELD, ReservationQ.expires_at <= now)
+            .distinct()
+        )
+        .scalars()
+        .all()
+    )
+    released = 0
+    for order_id in order_ids:
+        try:
+            # Missing if the order's shard didn't commit along with its
+            # reservations; the stock is returned all the same
+            has_order = sharding.route_to_order(db, order_id)
+        except sharding.UserMoving:
+            # Left for the next sweep
+            continue
+        release(db, order_id)
+        released += 1
+        if has_order:
+            db.execute(
+                update(OrderQ)
+                .where(OrderQ.id == order_id, OrderQ.status == "pending")
+                .values(status="expired")
+            )
+    db.commit()
+    return released
+
+
+async def sweep_expired(session_factory, interval: float):
+    """Background task: periodically release expired reservations."""
+
+    def sweep():
+        with session_factory() as db:
+            return release_expired(db)
+
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            released = await run_in_threadpool(sweep)
+        except Exception:
+            logger.exception("Releasing expired stock reservations failed")
+        else:
+            if released:
+                logger.info("Released stock for %d expired checkouts", released)
@@ -1,20 +1,60 @@
-from db import engine
+import asyncio
+from contextlib import asynccontextmanager
+
+import gateway
+import inventory
+import metrics
+import sharding
+from app.config import app_config
+from db import SessionLocal, engine
 from fastapi import FastAPI
+from migrations import upgrade_once, upgrade_shards
+from passwords import hashing_pool
+from profiler import ProfilerMiddleware, profiler
+from routes.admin import router as admin_router
 from routes.cart import router as cart_router
 from routes.catalog import router as catalog_router
+from routes.metrics import router as metrics_router
 from routes.order import router as order_router
 from routes.payments import router as payments_router
+from routes.payments import webhook_processor
 from routes.user import router as user_router
-from sqlmodel import SQLModel
+from starlette.concurrency import run_in_threadpool
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Create tables and apply pending migrations
+    if app_config.SCHEMA_UPGRADE_ON_STARTUP:
+        await run_in_threadpool(upgrade_once, engine)
+        if sharding.shard_map is not None:
+            await run_in_threadpool(upgrade_shards, sharding.shard_map)
+    sweeper = asyncio.create_task(
+        inventory.sweep_expired(
+            SessionLocal, app_config.RESERVATION_SWEEP_INTERVAL_SECONDS
+        )
+    )
+    webhook_processor.start()
+    yield
+    sweeper.cancel()
+    await webhook_processor.stop()
+    if gateway.payment_gateway is not None:
+        await gateway.payment_gateway.aclose()
+    hashing_pool.shutdown()
+    profiler.stop()
+
 
 # FastAPI app
-app = FastAPI(title="Shopify Clone API")
+app = FastAPI(title="Shopify Clone API", lifespan=lifespan)
 app.include_router(user_router)
 app.include_router(catalog_router)
 app.include_router(cart_router)
 app.include_router(order_router)
 app.include_router(payments_router)
+app.include_router(admin_router)
+app.add_middleware(ProfilerMiddleware)
 
-
-# Create tables
-SQLModel.metadata.create_all(bind=engine)
+if app_config.METRICS_ENABLED:
+    metrics.instrument_sql()
+    app.add_middleware(metrics.MetricsMiddleware)
+    app.include_router(metrics_router)
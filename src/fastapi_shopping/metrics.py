@@ -0,0 +1,305 @@
+"""
+Per-request latency and SQL instrumentation.
+
+MetricsMiddleware times every request and, through a context variable,
+collects the statements SQLAlchemy runs on its behalf, including those run
+on the threadpool by sync handlers and run_db(). Per route it keeps a
+latency histogram, query and SQL time totals and the slowest statements,
+rendered in the Prometheus text format by render().
+
+Requests slower than SLOW_REQUEST_SECONDS are logged with their slowest
+statements; for a sample of them the log also carries each statement's
+query plan.
+"""
+
+import heapq
+import logging
+import random
+import re
+import threading
+import time
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Tuple
+
+from app.config import app_config
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from starlette.concurrency import run_in_threadpool
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+MAX_STATEMENT_LENGTH = 200
+
+
+def _normalize(statement: str) -> str:
+    return re.sub(r"\s+", " ", statement).strip()[:MAX_STATEMENT_LENGTH]
+
+
+class RequestStats:
+    """SQL run while serving one request."""
+
+    def __init__(self, keep: int):
+        self.queries = 0
+        self.sql_seconds = 0.0
+        self.keep = keep
+        # Min-heap of (seconds, n, statement, parameters, engine)
+        self.slowest: List[tuple] = []
+
+    def add(self, seconds: float, statement: str, parameters, engine):
+        self.queries += 1
+        self.sql_seconds += seconds
+        entry = (seconds, self.queries, statement, parameters, engine)
+        if len(self.slowest) < self.keep:
+            heapq.heappush(self.slowest, entry)
+        elif seconds > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, entry)
+
+
+_current: ContextVar[Optional[RequestStats]] = ContextVar("request_stats", default=None)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current.get() is not None:
+        conn.info["query_start"] = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = _current.get()
+    if stats is None:
+        return
+    start = conn.info.pop("query_start", None)
+    if start is None:
+        return
+    seconds = time.perf_counter() - start
+    # Plans are only taken for single statements, see explain()
+    stats.add(seconds, statement, None if executemany else parameters, conn.engine)
+
+
+def instrument_sql():
+    """Time the statements of every engine, sync or async. Idempotent."""
+    if not event.contains(Engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+
+
+def explain(engine: Engine, statement: str, parameters) -> str:
+    """
+    The query plan of a SELECT, or "" for anything else. Runs on a raw
+    connection so the EXPLAIN itself isn't instrumented.
+    """
+    if parameters is None or not statement.lstrip().upper().startswith("SELECT"):
+        return ""
+    prefix = "EXPLAIN QUERY PLAN " if engine.dialect.name == "sqlite" else "EXPLAIN "
+    try:
+        connection = engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.execute(prefix + statement, parameters)
+            rows = cursor.fetchall()
+            cursor.close()
+        finally:
+            connection.close()
+    except Exception as e:
+        return f"unavailable: {e}"
+    return "\n".join(" ".join(str(column) for column in row) for row in rows)
+
+
+class RouteMetrics:
+    """Totals for one (method, route, status)."""
+
+    def __init__(self):
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+        self.count = 0
+        self.seconds = 0.0
+        self.queries = 0
+        self.sql_seconds = 0.0
+
+
+class MetricsRegistry:
+    """Thread safe per route totals and slowest statements."""
+
+    def __init__(self, slowest_statements: int = 5):
+        self.slowest_statements = slowest_statements
+        self._routes: Dict[Tuple[str, str, int], RouteMetrics] = {}
+        # Per (method, route): statement -> slowest time seen
+        self._slowest: Dict[Tuple[str, str], Dict[str, float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(
+        self, method: str, route: str, status: int, seconds: float, stats: RequestStats
+    ):
+        with self._lock:
+            metrics = self._routes.get((method, route, status))
+            if metrics is None:
+                metrics = self._routes[(method, route, status)] = RouteMetrics()
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    metrics.buckets[i] += 1
+            metrics.count += 1
+            metrics.seconds += seconds
+            metrics.queries += stats.queries
+            metrics.sql_seconds += stats.sql_seconds
+
+            slowest = self._slowest.setdefault((method, route), {})
+            for statement_seconds, _, statement, _, _ in stats.slowest:
+                statement = _normalize(statement)
+                if statement_seconds > slowest.get(statement, 0.0):
+                    slowest[statement] = statement_seconds
+            if len(slowest) > self.slowest_statements:
+                keep = heapq.nlargest(
+                    self.slowest_statements, slowest.items(), key=lambda kv: kv[1]
+                )
+                self._slowest[(method, route)] = dict(keep)
+
+    def clear(self):
+        with self._lock:
+            self._routes.clear()
+            self._slowest.clear()
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format."""
+        lines = [
+            "# HELP http_request_duration_seconds Request latency.",
+            "# TYPE http_request_duration_seconds histogram",
+        ]
+        with self._lock:
+            routes = sorted(self._routes.items())
+            slowest = sorted(self._slowest.items())
+            for (method, route, status), metrics in routes:
+                labels = _labels(method=method, route=route, status=status)
+                for bound, count in zip(LATENCY_BUCKETS, metrics.buckets):
+                    lines.append(
+                        f'http_request_duration_seconds_bucket{{{labels},le="{bound}"}}'
+                        f" {count}"
+                    )
+                lines += [
+                    f'http_request_duration_seconds_bucket{{{labels},le="+Inf"}}'
+                    f" {metrics.count}",
+                    f"http_request_duration_seconds_sum{{{labels}}} {metrics.seconds}",
+                    f"http_request_duration_seconds_count{{{labels}}} {metrics.count}",
+                ]
+            lines += [
+                "# HELP http_request_sql_queries_total Statements run by requests.",
+                "# TYPE http_request_sql_queries_total counter",
+            ]
+            for (method, route, status), metrics in routes:
+                labels = _labels(method=method, route=route, status=status)
+                lines.append(
+                    f"http_request_sql_queries_total{{{labels}}} {metrics.queries}"
+                )
+            lines += [
+                "# HELP http_request_sql_seconds_total Time spent running statements.",
+                "# TYPE http_request_sql_seconds_total counter",
+            ]
+            for (method, route, status), metrics in routes:
+                labels = _labels(method=method, route=route, status=status)
+                lines.append(
+                    f"http_request_sql_seconds_total{{{labels}}} {metrics.sql_seconds}"
+                )
+            lines += [
+                "# HELP http_request_sql_slowest_seconds Slowest runs of the slowest"
+                " statements per route.",
+                "# TYPE http_request_sql_slowest_seconds gauge",
+            ]
+            for (method, route), statements in slowest:
+                for statement, seconds in sorted(statements.items()):
+                    labels = _labels(method=method, route=route, statement=statement)
+                    lines.append(
+                        f"http_request_sql_slowest_seconds{{{labels}}} {seconds}"
+                    )
+        return "\n".join(lines) + "\n"
+
+
+def render_gauges(prefix: str, gauges: dict, help: str) -> str:
+    """Render a dict of numbers, such as db.pool_stats(), as gauges."""
+    lines = []
+    for name, value in gauges.items():
+        lines += [
+            f"# HELP {prefix}_{name} {help}",
+            f"# TYPE {prefix}_{name} gauge",
+            f"{prefix}_{name} {value}",
+        ]
+    return "\n".join(lines) + "\n"
+
+
+def render_labelled_gauges(prefix: str, label: str, groups: dict, help: str) -> str:
+    """
+    Render a dict of gauge dicts, such as CatalogCache.stats() per key family,
+    as one gauge per name with the group in ``label``.
+    """
+    names = dict.fromkeys(name for gauges in groups.values() for name in gauges)
+    lines = []
+    for name in names:
+        lines += [f"# HELP {prefix}_{name} {help}", f"# TYPE {prefix}_{name} gauge"]
+        for group, gauges in sorted(groups.items()):
+            if name in gauges:
+                lines.append(
+                    f"{prefix}_{name}{{{_labels(**{label: group})}}} {gauges[name]}"
+                )
+    return "\n".join(lines) + "\n"
+
+
+def _labels(**labels) -> str:
+    def escape(value) -> str:
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    return ",".join(f'{name}="{escape(value)}"' for name, value in labels.items())
+
+
+registry = MetricsRegistry(app_config.METRICS_SLOWEST_STATEMENTS)
+
+
+async def log_slow_request(
+    method: str, route: str, seconds: float, stats: RequestStats
+):
+    lines = [
+        f"Slow request {method} {route}: {seconds * 1000:.1f}ms, "
+        f"{stats.queries} queries in {stats.sql_seconds * 1000:.1f}ms"
+    ]
+    with_plans = random.random() < app_config.SLOW_REQUEST_PLAN_SAMPLE_RATE
+    for statement_seconds, _, statement, parameters, engine in sorted(
+        stats.slowest, reverse=True
+    ):
+        lines.append(f"  {statement_seconds * 1000:.1f}ms {_normalize(statement)}")
+        if with_plans:
+            plan = await run_in_threadpool(explain, engine, statement, parameters)
+            lines += [f"    {line}" for line in plan.splitlines()]
+    logger.warning("\n".join(lines))
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware feeding ``registry``. Requests that match no route are
+    recorded as "unmatched" to keep the label set bounded.
+    """
+
+    def __init__(self, app, skip_paths=("/metrics",)):
+        self.app = app
+        self.skip_paths = set(skip_paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in self.skip_paths:
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        stats = RequestStats(registry.slowest_statements)
+        token = _current.set(stats)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            seconds = time.perf_counter() - start
+            _current.reset(token)
+            route = getattr(scope.get("route"), "path", "unmatched")
+            registry.observe(scope["method"], route, status, seconds, stats)
+            if 0 < app_config.SLOW_REQUEST_SECONDS <= seconds:
+                await log_slow_request(scope["method"], route, seconds, stats)
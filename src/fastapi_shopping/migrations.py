@@ -0,0 +1,289 @@
+"""
+Versioned schema migrations.
+
+``upgrade()`` creates missing tables and then applies, in order, every
+migration not yet recorded in the ``schema_version`` table. Migrations must
+be idempotent (``IF NOT EXISTS``) so an interrupted run, or two workers
+starting at once, can simply be repeated. Index builds on PostgreSQL use
+``CREATE INDEX CONCURRENTLY`` so they don't block writes.
+
+The app runs ``upgrade_once()`` from its lifespan unless
+SCHEMA_UPGRADE_ON_STARTUP is off, in which case deploys run, from
+src/fastapi_shopping:
+
+    python -m migrations upgrade
+    python -m migrations status
+"""
+
+import argparse
+import datetime
+import logging
+from contextlib import contextmanager
+from typing import Callable, List, Tuple
+
+import cart_store
+import search
+import sharding
+from sqlalchemy import (
+    Column,
+    DateTime,
+    Index,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    func,
+    insert,
+    inspect,
+    select,
+    text,
+)
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.schema import CreateIndex
+from sqlmodel import SQLModel
+
+logger = logging.getLogger(__name__)
+
+schema_version = Table(
+    "schema_version",
+    MetaData(),
+    Column("version", Integer, primary_key=True),
+    Column("description", String, nullable=False),
+    Column("applied_at", DateTime, nullable=False),
+)
+
+
+def _find_index(name: str):
+    for table in SQLModel.metadata.tables.values():
+        for index in table.indexes:
+            if index.name == name:
+                return index
+    raise KeyError(name)
+
+
+class MigrationError(Exception):
+    """The existing data doesn't allow a migration to be applied."""
+
+
+def check_unique(engine: Engine, index: Index):
+    """Raise MigrationError if rows already break the unique ``index``."""
+    columns = list(index.columns)
+    with engine.connect() as conn:
+        duplicates = conn.execute(
+            select(*columns, func.count())
+            .group_by(*columns)
+            .having(func.count() > 1)
+            .limit(10)
+        ).all()
+    if duplicates:
+        names = ", ".join(column.name for column in columns)
+        examples = "; ".join(
+            f"{', '.join(map(repr, row[:-1]))} ({row[-1]} rows)" for row in duplicates
+        )
+        raise MigrationError(
+            f"Can't create unique index {index.name}: {index.table.name} has "
+            f"duplicate {names}, e.g. {examples}. Resolve them and upgrade again."
+        )
+
+
+def create_index(engine: Engine, name: str):
+    """
+    Build a model-declared index if it doesn't exist yet. A unique index is
+    checked against the existing rows first.
+    """
+    index = _find_index(name)
+    if index.unique:
+        check_unique(engine, index)
+    ddl = str(CreateIndex(index, if_not_exists=True).compile(dialect=engine.dialect))
+    if engine.dialect.name == "postgresql":
+        # CONCURRENTLY can't run inside a transaction block
+        ddl = ddl.replace(" INDEX ", " INDEX CONCURRENTLY ", 1)
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            conn.exec_driver_sql(ddl)
+    else:
+        with engine.begin() as conn:
+            conn.exec_driver_sql(ddl)
+
+
+def create_indexes(*names: str) -> Callable[[Engine], None]:
+    def apply(engine: Engine):
+        for name in names:
+            create_index(engine, name)
+
+    return apply
+
+
+# (version, description, apply). Append only; never edit a released entry.
+MIGRATIONS: List[Tuple[int, str, Callable[[Engine], None]]] = [
+    (
+        1,
+        "Index hot lookup columns",
+        create_indexes(
+            "ix_users_email",
+            "ix_carts_user_id",
+            "ix_cart_items_cart_id_product_id",
+            "ix_orders_payment_intent_id",
+            "ix_order_items_order_id",
+            "ix_products_category_id",
+            "ix_products_price_id",
+            "ix_products_name_id",
+            "ix_stock_reservations_order_id_status",
+            "ix_stock_reservations_status_expires_at",
+        ),
+    ),
+    (2, "Full-text index on product names and descriptions", search.migrate),
+    (
+        3,
+        "Index webhook events",
+        create_indexes(
+            "ix_webhook_events_event_id",
+            "ix_webhook_events_status_id",
+            "ix_webhook_events_payment_intent_id_status",
+        ),
+    ),
+    (4, "Keep cart subtotals and item counts on carts", cart_store.migrate),
+]
+
+
+def applied_versions(engine: Engine) -> List[int]:
+    with engine.begin() as conn:
+        schema_version.create(conn, checkfirst=True)
+        return list(conn.execute(select(schema_version.c.version)).scalars())
+
+
+# pg_advisory_lock key for schema upgrades
+SCHEMA_LOCK_KEY = 0x73686F70
+
+
+@contextmanager
+def schema_lock(engine: Engine):
+    """
+    Hold a lock across processes while migrating ``engine``: a PostgreSQL
+    advisory lock, or an flock on a file next to a SQLite database. Other
+    databases, and in-memory SQLite, aren't locked.
+    """
+    if engine.dialect.name == "postgresql":
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            conn.execute(
+                text("SELECT pg_advisory_lock(:key)"), {"key": SCHEMA_LOCK_KEY}
+            )
+            try:
+                yield
+            finally:
+                conn.execute(
+                    text("SELECT pg_advisory_unlock(:key)"), {"key": SCHEMA_LOCK_KEY}
+                )
+        return
+
+    database = make_url(str(engine.url)).database
+    try:
+        import fcntl
+    except ImportError:
+        fcntl = None
+    if (
+        engine.dialect.name != "sqlite"
+        or database in (None, "", ":memory:")
+        or not fcntl
+    ):
+        yield
+        return
+    with open(f"{database}.migrate-lock", "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def is_current(engine: Engine) -> bool:
+    """Whether every model table exists and every migration is applied."""
+    tables = set(inspect(engine).get_table_names())
+    if schema_version.name not in tables or not set(SQLModel.metadata.tables) <= tables:
+        return False
+    return {version for version, _, _ in MIGRATIONS} <= set(applied_versions(engine))
+
+
+def upgrade_once(engine: Engine) -> List[int]:
+    """
+    upgrade() for app startup. A current schema is detected with two
+    queries and no lock; otherwise one process upgrades while the others
+    wait on schema_lock() and then find nothing left to do.
+    """
+    if is_current(engine):
+        return []
+    with schema_lock(engine):
+        return upgrade(engine)
+
+
+def upgrade_shards(shard_map: sharding.ShardMap) -> List[int]:
+    """
+    Create the shard directory and the sharded tables on every shard that
+    lacks them; returns the shards created.
+    """
+    if not inspect(shard_map.global_engine).has_table(sharding.user_shards.name):
+        with schema_lock(shard_map.global_engine):
+            sharding.user_shards.create(shard_map.global_engine, checkfirst=True)
+    created = []
+    for shard, shard_engine in enumerate(shard_map.engines):
+        if inspect(shard_engine).has_table("orders"):
+            continue
+        with schema_lock(shard_engine):
+            if sharding.create_schema(shard_engine, shard):
+                created.append(shard)
+    return created
+
+
+def upgrade(engine: Engine) -> List[int]:
+    """Bring the schema at ``engine`` up to date; returns the versions applied."""
+    SQLModel.metadata.create_all(engine)
+    applied = set(applied_versions(engine))
+    newly_applied = []
+    for version, description, apply in MIGRATIONS:
+        if version in applied:
+            continue
+        logger.info("Applying migration %d: %s", version, description)
+        apply(engine)
+        try:
+            with engine.begin() as conn:
+                conn.execute(
+                    insert(schema_version).values(
+                        version=version,
+                        description=description,
+                        applied_at=datetime.datetime.utcnow(),
+                    )
+                )
+        except IntegrityError:
+            # Another process recorded it first; the work was idempotent
+            continue
+        newly_applied.append(version)
+    return newly_applied
+
+
+def main():
+    import models  # noqa: F401  registers the tables
+    from app.config import app_config
+    from db import create_db_engine
+
+    parser = argparse.ArgumentParser(description="Manage the database schema")
+    parser.add_argument("command", choices=["upgrade", "status"])
+    parser.add_argument("--url", default=app_config.DATABASE_URL)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    engine = create_db_engine(args.url)
+    if args.command == "upgrade":
+        applied = upgrade(engine)
+        print(f"Applied {len(applied)} migration(s)")
+        if sharding.shard_map is not None:
+            created = upgrade_shards(sharding.shard_map)
+            print(f"Created the tables of {len(created)} shard(s)")
+    else:
+        applied = set(applied_versions(engine))
+        for version, description, _ in MIGRATIONS:
+            state = "applied" if version in applied else "pending"
+            print(f"{version:4d} {state:8s} {description}")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,13 +2,14 @@ from dataclasses import field
 from datetime import datetime
 from typing import List, Optional
 
-from fquery.sqlmodel import SQL_PK, foreign_key, many_to_one, one_to_many, sqlmodel
+from fquery.sqlmodel import SQL_PK, foreign_key, many_to_one, one_to_many
+from schema import indexed, sqlmodel
 
 
 @sqlmodel
 class User:
     id: Optional[int] = field(default=None, **SQL_PK)
-    email: str
+    email: str = indexed(unique=True)
     hashed_password: str
     is_admin: bool = False
     orders: List["Order"] = one_to_many()
@@ -24,6 +25,9 @@ class Category:
 
 @sqlmodel
 class Product:
+    # category_id filters; (price, id) and (name, id) back the sorted listings
+    __indexes__ = (("category_id",), ("price", "id"), ("name", "id"))
+
     id: Optional[int] = field(default=None, **SQL_PK)
     name: str
     description: str
@@ -38,7 +42,7 @@ class Order:
     id: Optional[int] = field(default=None, **SQL_PK)
     status: str
     total_amount: float
-    payment_intent_id: str
+    payment_intent_id: str = indexed()
     payment_intent_status: str
     items: List["OrderItem"] = one_to_many()
     user: Optional[User] = many_to_one("user.id")
@@ -47,6 +51,8 @@ class Order:
 
 @sqlmodel
 class OrderItem:
+    __indexes__ = (("order_id",),)
+
     id: Optional[int] = field(default=None, **SQL_PK)
     quantity: int
     price: float
@@ -56,16 +62,57 @@ class OrderItem:
 
 @sqlmodel
 class Cart:
+    __indexes__ = (("user_id",),)
+
     id: Optional[int] = field(default=None, **SQL_PK)
     user: Optional[User] = foreign_key("users.id")
     created_at: datetime = field(default_factory=datetime.utcnow)
+    # Maintained by every cart write; see cart_store.py
+    subtotal: float = 0.0
+    item_count: int = 0
     items: List["CartItem"] = one_to_many()
 
 
 @sqlmodel
 class CartItem:
+    __indexes__ = (("cart_id", "product_id"),)
+
     id: Optional[int] = field(default=None, **SQL_PK)
     quantity: int
     cart_id: Optional[int] = field(default=None, metadata={"foreign_key": "cart.id"})
     cart: Optional[Cart] = many_to_one("cart.id", back_populates="items")
     product: Optional[Product] = foreign_key("products.id")
+
+
+@sqlmodel
+class StockReservation:
+    __indexes__ = (("order_id", "status"), ("status", "expires_at"))
+
+    id: Optional[int] = field(default=None, **SQL_PK)
+    order_id: int
+    product_id: int
+    quantity: int
+    # held -> committed, or held -> released (cancelled or expired)
+    status: str = "held"
+    expires_at: datetime
+
+
+@sqlmodel
+class WebhookEvent:
+    # Claiming walks pending events in id order; per-intent ordering looks
+    # up older unfinished events of the same intent
+    __indexes__ = (("status", "id"), ("payment_intent_id", "status"))
+
+    id: Optional[int] = field(default=None, **SQL_PK)
+    # Stripe's event id; a duplicate delivery fails this unique index
+    event_id: str = indexed(unique=True)
+    type: str
+    payment_intent_id: Optional[str] = None
+    payload: str
+    # pending -> processing -> done, or back to pending to retry, or failed
+    status: str = "pending"
+    attempts: int = 0
+    # When a pending event may run next, or when a processing lease expires
+    next_attempt_at: datetime = field(default_factory=datetime.utcnow)
+    last_error: Optional[str] = None
+    created_at: datetime = field(default_factory=datetime.utcnow)
@@ -0,0 +1,69 @@
+"""
+Keyset (cursor) pagination.
+
+A cursor is an opaque, URL safe token holding the sort key of the last row
+on the previous page. The next page starts strictly after that key, so its
+cost doesn't grow with page depth the way OFFSET does. The sort key always
+ends with the primary key to make the order total.
+"""
+
+import base64
+import json
+from typing import Any, List, Optional, Sequence, Tuple
+
+from fastapi import HTTPException
+from sqlalchemy import tuple_
+from sqlalchemy.orm import Query
+
+
+def encode_cursor(sort: str, key: Sequence[Any]) -> str:
+    raw = json.dumps({"s": sort, "k": list(key)}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, sort: str, length: int) -> List[Any]:
+    """The sort key in ``cursor``, which must hold ``length`` scalar values."""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        data = json.loads(base64.urlsafe_b64decode(padded))
+        key = data["k"]
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if not (
+        isinstance(key, list)
+        and len(key) == length
+        and all(isinstance(value, (str, int, float)) for value in key)
+    ):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if data.get("s") != sort:
+        raise HTTPException(
+            status_code=400, detail="Cursor was issued for another sort"
+        )
+    return key
+
+
+def keyset_page(
+    query: Query,
+    sort: str,
+    columns: Sequence,
+    cursor: Optional[str],
+    limit: int,
+    offset: int = 0,
+) -> Tuple[list, Optional[str]]:
+    """
+    Return one page of ``query`` ordered by ``columns``, and the cursor for
+    the next page (None on the last page). ``offset`` is only applied to the
+    first page, for clients that still page with skip.
+    """
+    query = query.order_by(*columns)
+    if cursor:
+        key = decode_cursor(cursor, sort, len(columns))
+        query = query.filter(tuple_(*columns) > tuple_(*key))
+    elif offset:
+        query = query.offset(offset)
+    rows = query.limit(limit).all()
+    next_cursor = None
+    if rows and len(rows) == limit:
+        last = rows[-1]
+        next_cursor = encode_cursor(sort, [getattr(last, c.key) for c in columns])
+    return rows, next_cursor
@@ -0,0 +1,116 @@
+import asyncio
+import os
+import threading
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
+from typing import Optional
+
+from app.config import app_config
+from fastapi import HTTPException, status
+
+
+# Password hashing. passlib is imported on first use, which also happens in
+# each process pool worker rather than in the parent.
+@lru_cache(maxsize=None)
+def pwd_context():
+    from passlib.context import CryptContext
+
+    return CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+
+def _verify(plain_password, hashed_password):
+    return pwd_context().verify(plain_password, hashed_password)
+
+
+def _hash(password):
+    return pwd_context().hash(password)
+
+
+def _lower_priority(niceness: int):
+    os.nice(niceness)
+
+
+class HashingPool:
+    """
+    Runs bcrypt off the event loop on a bounded thread or process pool.
+
+    At most ``workers + queue_depth`` calls may be pending; further calls are
+    rejected with a 503 so a login storm cannot queue unbounded work. The
+    "inline" executor keeps the old behaviour of hashing on the calling thread.
+    """
+
+    def __init__(
+        self,
+        executor: str = "thread",
+        workers: int = 0,
+        queue_depth: int = 64,
+        niceness: int = 0,
+    ):
+        if executor not in ("inline", "thread", "process"):
+            raise ValueError(f"Unknown password hash executor: {executor}")
+        self.executor = executor
+        # Leave a core for the event loop so hashing gets a fair share of CPU
+        # without starving request handling
+        self.workers = workers or max(1, (os.cpu_count() or 2) - 1)
+        self.queue_depth = queue_depth
+        self.niceness = niceness
+        self.pending = 0
+        self.rejected = 0
+        self._executor: Optional[Executor] = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self) -> Executor:
+        if self._executor is None:
+            if self.executor == "process":
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    initializer=_lower_priority if self.niceness else None,
+                    initargs=(self.niceness,) if self.niceness else (),
+                )
+            else:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix="bcrypt"
+                )
+        return self._executor
+
+    async def run(self, fn, *args):
+        if self.executor == "inline":
+            return fn(*args)
+
+        with self._lock:
+            if self.pending >= self.workers + self.queue_depth:
+                self.rejected += 1
+                raise HTTPException(
+                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                    detail="Too many concurrent authentication requests",
+                    headers={"Retry-After": "1"},
+                )
+            self.pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._get_executor(), fn, *args)
+        finally:
+            with self._lock:
+                self.pending -= 1
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+
+hashing_pool = HashingPool(
+    executor=app_config.PASSWORD_HASH_EXECUTOR,
+    workers=app_config.PASSWORD_HASH_WORKERS,
+    queue_depth=app_config.PASSWORD_HASH_QUEUE_DEPTH,
+    niceness=app_config.PASSWORD_HASH_NICENESS,
+)
+
+
+# Authentication utilities
+async def verify_password(plain_password, hashed_password):
+    return await hashing_pool.run(_verify, plain_password, hashed_password)
+
+
+async def get_password_hash(password):
+    return await hashing_pool.run(_hash, password)
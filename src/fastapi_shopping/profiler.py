@@ -0,0 +1,226 @@
+"""
+Opt-in statistical profiler for live traffic.
+
+While enabled, ProfilerMiddleware picks PROFILER_SAMPLE_RATE of requests.
+As long as one of them is in flight, a background thread snapshots every
+thread's Python stack each PROFILER_INTERVAL_SECONDS. Snapshots that
+belong to a sampled request are aggregated per route into collapsed stacks
+("frame;frame;frame count"), the input format of flamegraph.pl and
+speedscope.
+
+A snapshot belongs to a request when:
+- it's on the event loop and passes through the request's middleware frame;
+- it's on a run_db() worker started by the request;
+- it's on a worker thread running a sync endpoint of a route with a sampled
+  request in flight. This one is approximate: a concurrent unsampled
+  request to the same route is attributed too.
+"""
+
+import inspect
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from contextvars import ContextVar
+from functools import wraps
+from typing import Dict, Optional
+
+from app.config import app_config
+
+# (method, scope) of the sampled request being served, if any
+_request: ContextVar[Optional[tuple]] = ContextVar("profiled_request", default=None)
+
+
+def _route_name(method: str, scope: dict) -> str:
+    return f"{method} {getattr(scope.get('route'), 'path', 'unrouted')}"
+
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return (
+        f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+    )
+
+
+class SamplingProfiler:
+    def __init__(
+        self,
+        enabled: bool = False,
+        sample_rate: float = 0.01,
+        interval: float = 0.005,
+        max_stacks: int = 10000,
+    ):
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+        self.interval = interval
+        self.max_stacks = max_stacks
+        self.samples = 0
+        # Samples whose stack was new once max_stacks distinct stacks were kept
+        self.dropped = 0
+        self.stacks: Dict[str, Counter] = {}
+        # Middleware frame of each sampled request in flight -> (method, scope)
+        self._requests: Dict[object, tuple] = {}
+        # run_db() worker thread id -> (method, scope)
+        self._threads: Dict[int, tuple] = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = False
+        self._thread: Optional[threading.Thread] = None
+
+    def should_sample(self) -> bool:
+        return self.enabled and random.random() < self.sample_rate
+
+    def begin(self, frame, method: str, scope: dict):
+        with self._lock:
+            self._requests[frame] = (method, scope)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="profiler", daemon=True
+                )
+                self._thread.start()
+            self._wake.set()
+
+    def end(self, frame):
+        with self._lock:
+            self._requests.pop(frame, None)
+            if not self._requests:
+                self._wake.clear()
+
+    def tagged(self, fn):
+        """
+        Wrap ``fn``, about to run on a worker thread, so its samples count
+        toward the current request. A no-op outside sampled requests.
+        """
+        request = _request.get()
+        if request is None:
+            return fn
+
+        @wraps(fn)
+        def run(*args, **kwargs):
+            thread_id = threading.get_ident()
+            self._threads[thread_id] = request
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self._threads.pop(thread_id, None)
+
+        return run
+
+    def sample(self):
+        """Record one snapshot of every thread serving a sampled request."""
+        with self._lock:
+            requests = dict(self._requests)
+            threads = dict(self._threads)
+        # Sync endpoint code -> route name, for the routes matched so far.
+        # Async endpoints run on the event loop, under the middleware frame.
+        endpoints = {}
+        for method, scope in requests.values():
+            endpoint = getattr(scope.get("route"), "endpoint", None)
+            if inspect.isfunction(endpoint) and not inspect.iscoroutinefunction(
+                endpoint
+            ):
+                endpoints[endpoint.__code__] = _route_name(method, scope)
+        me = threading.get_ident()
+
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == me:
+                continue
+            route, stack = None, []
+            if thread_id in threads:
+                route = _route_name(*threads[thread_id])
+            while frame is not None:
+                if frame in requests:
+                    route = _route_name(*requests[frame])
+                    break
+                if route is None and frame.f_code in endpoints:
+                    route = endpoints[frame.f_code]
+                stack.append(_frame_name(frame))
+                frame = frame.f_back
+            if route is not None:
+                self._record(route, ";".join(reversed(stack)))
+
+    def _record(self, route: str, stack: str):
+        with self._lock:
+            self.samples += 1
+            counter = self.stacks.setdefault(route, Counter())
+            if stack not in counter and self._stack_count() >= self.max_stacks:
+                self.dropped += 1
+                return
+            counter[stack] += 1
+
+    def _stack_count(self) -> int:
+        return sum(len(counter) for counter in self.stacks.values())
+
+    def _run(self):
+        while not self._stopped:
+            self._wake.wait()
+            if self._stopped:
+                return
+            self.sample()
+            time.sleep(self.interval)
+
+    def collapsed(self, route: Optional[str] = None) -> str:
+        """
+        The aggregated stacks, each rooted at its route, one "stack count"
+        per line. ``route`` keeps a single route, e.g. "POST /user/token".
+        """
+        with self._lock:
+            lines = [
+                f"{name};{stack} {count}" if stack else f"{name} {count}"
+                for name, counter in sorted(self.stacks.items())
+                if route is None or name == route
+                for stack, count in counter.most_common()
+            ]
+        return "".join(line + "\n" for line in lines)
+
+    def clear(self):
+        with self._lock:
+            self.stacks.clear()
+            self.samples = 0
+            self.dropped = 0
+
+    def stop(self):
+        self._stopped = True
+        self._wake.set()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "sample_rate": self.sample_rate,
+                "samples": self.samples,
+                "dropped": self.dropped,
+                "stacks": self._stack_count(),
+                "in_flight": len(self._requests),
+            }
+
+
+profiler = SamplingProfiler(
+    enabled=app_config.PROFILER_ENABLED,
+    sample_rate=app_config.PROFILER_SAMPLE_RATE,
+    interval=app_config.PROFILER_INTERVAL_SECONDS,
+    max_stacks=app_config.PROFILER_MAX_STACKS,
+)
+
+
+class ProfilerMiddleware:
+    """ASGI middleware choosing which requests ``profiler`` samples."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not profiler.should_sample():
+            await self.app(scope, receive, send)
+            return
+
+        frame = sys._getframe()
+        token = _request.set((scope["method"], scope))
+        profiler.begin(frame, scope["method"], scope)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            profiler.end(frame)
+            _request.reset(token)
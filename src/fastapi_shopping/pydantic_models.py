@@ -1,7 +1,7 @@
 import datetime
-from typing import List, Optional
+from typing import List, Literal, Optional
 
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict, Field, model_validator
 
 
 # Pydantic Models
@@ -17,8 +17,7 @@ class UserOut(UserBase):
     id: int
     is_admin: bool
 
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)
 
 
 class CategoryBase(BaseModel):
@@ -33,8 +32,7 @@ class CategoryCreate(CategoryBase):
 class CategoryOut(CategoryBase):
     id: int
 
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)
 
 
 class ProductBase(BaseModel):
@@ -49,12 +47,29 @@ class ProductCreate(ProductBase):
     pass
 
 
+class ProductUpdate(BaseModel):
+    name: Optional[str] = None
+    description: Optional[str] = None
+    price: Optional[float] = None
+    stock: Optional[int] = None
+    category_id: Optional[int] = None
+
+
 class ProductOut(ProductBase):
     id: int
 
-    class Config:
-        orm_mode = True
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
+
+
+class RowError(BaseModel):
+    row: int
+    error: str
+
+
+class ImportResult(BaseModel):
+    inserted: int
+    failed: int
+    errors: List[RowError]
 
 
 class OrderItemBase(BaseModel):
@@ -73,8 +88,7 @@ class OrderOut(BaseModel):
     created_at: datetime.datetime
     items: List[OrderItemBase]
 
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)
 
 
 # payments related
@@ -83,19 +97,52 @@ class CartItemCreate(BaseModel):
     quantity: int
 
 
+class CartItemChange(BaseModel):
+    """One line of a batch cart update; ``set`` to 0 removes the line."""
+
+    op: Literal["add", "set", "remove"] = "add"
+    product_id: int
+    quantity: int = Field(0, ge=0)
+
+    @model_validator(mode="after")
+    def check_quantity(self):
+        if self.op == "add" and self.quantity == 0:
+            raise ValueError("add needs a positive quantity")
+        return self
+
+
 class CartItemOut(BaseModel):
     product_id: int
     quantity: int
     product: ProductOut
 
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)
 
 
 class CartOut(BaseModel):
     id: int
     items: List[CartItemOut]
     total: float
+    item_count: int
+
+    model_config = ConfigDict(from_attributes=True)
+
+
+class CartSummary(BaseModel):
+    id: int
+    total: float
+    item_count: int
+
+
+class ProfilerSettings(BaseModel):
+    enabled: bool
+    sample_rate: Optional[float] = Field(default=None, gt=0, le=1)
+
 
-    class Config:
-        orm_mode = True
+class ProfilerStats(BaseModel):
+    enabled: bool
+    sample_rate: float
+    samples: int
+    dropped: int
+    stacks: int
+    in_flight: int
@@ -0,0 +1,74 @@
+import datetime
+from typing import List, Optional
+
+import sharding
+from auth import get_current_admin
+from db import get_read_db
+from fastapi import APIRouter, Depends, HTTPException, Query, Response
+from fastapi.responses import PlainTextResponse
+from pagination import decode_cursor, encode_cursor
+from profiler import profiler
+from pydantic_models import OrderOut, ProfilerSettings, ProfilerStats
+from sqlalchemy.orm import Session
+
+router = APIRouter(prefix="/admin", dependencies=[Depends(get_current_admin)])
+
+
+@router.get("/profile", response_class=PlainTextResponse)
+def download_profile(route: Optional[str] = None):
+    """
+    The sampled stacks in collapsed format, for flamegraph.pl or speedscope.
+    ``route`` keeps a single route, e.g. "POST /cart/cart/checkout/".
+    """
+    return PlainTextResponse(
+        profiler.collapsed(route),
+        headers={"Content-Disposition": 'attachment; filename="profile.folded"'},
+    )
+
+
+@router.get("/profile/stats", response_model=ProfilerStats)
+def get_profile_stats():
+    return profiler.stats()
+
+
+@router.put("/profile", response_model=ProfilerStats)
+def update_profiler(settings: ProfilerSettings):
+    profiler.enabled = settings.enabled
+    if settings.sample_rate is not None:
+        profiler.sample_rate = settings.sample_rate
+    return profiler.stats()
+
+
+@router.delete("/profile", response_model=ProfilerStats)
+def clear_profile():
+    profiler.clear()
+    return profiler.stats()
+
+
+@router.get("/orders", response_model=List[OrderOut])
+def list_orders(
+    response: Response,
+    db: Session = Depends(get_read_db),
+    status: Optional[str] = None,
+    user_id: Optional[int] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=200),
+):
+    """
+    Orders of every user, newest first, merged across the shards. Pass the
+    X-Next-Cursor header of a page as ``cursor`` to fetch the next.
+    """
+    before = None
+    if cursor:
+        try:
+            created_at, order_id = decode_cursor(cursor, "orders", 2)
+            before = (datetime.datetime.fromisoformat(created_at), int(order_id))
+        except (ValueError, TypeError):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+    orders = sharding.list_orders(db, status, user_id, before, limit)
+    if len(orders) == limit:
+        last = orders[-1]
+        response.headers["X-Next-Cursor"] = encode_cursor(
+            "orders", [last.created_at.isoformat(), last.id]
+        )
+    return orders
@@ -1,142 +1,302 @@
-import stripe
+import datetime
+import hashlib
+import logging
+import math
+from typing import Dict, List, Optional
+
+import inventory
+import sharding
+from app.config import app_config
 from auth import get_current_user
-from db import get_db
-from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException
-from models import Cart, CartItem, Order, OrderItem, Product, User
-from pydantic_models import CartItemCreate, CartItemOut, CartOut, ProductOut
+from cart_store import ADD, REMOVE, CartChange, get_cart_store
+from db import get_read_session, get_session, run_db
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Response
+from gateway import (
+    GatewayUnavailable,
+    PaymentError,
+    PaymentGateway,
+    get_payment_gateway,
+)
+from models import Order, OrderItem, Product, User
+from pydantic_models import CartItemChange, CartItemCreate, CartOut, CartSummary
+from sqlalchemy import insert, select
 from sqlalchemy.orm import Session
 
+logger = logging.getLogger(__name__)
+
 router = APIRouter(prefix="/cart")
 
 
+# Database work for the handlers below. These run through run_db() so they
+# never block the event loop. Cart contents go through the configured cart
+# store (see cart_store.py).
+def _change_cart(db: Session, user_id: int, changes: List[CartChange]):
+    # Check that every product exists and has enough stock, and get the
+    # prices the cart totals move by, in one query
+    ProductQ = Product.__sqlmodel__
+    rows = db.execute(
+        select(ProductQ.id, ProductQ.price, ProductQ.stock).where(
+            ProductQ.id.in_({c.product_id for c in changes})
+        )
+    ).all()
+    prices = {product_id: price for product_id, price, _ in rows}
+    stock = {product_id: stock for product_id, _, stock in rows}
+    for change in changes:
+        if change.op == REMOVE:
+            continue
+        if change.product_id not in stock:
+            raise HTTPException(
+                status_code=404, detail=f"Product {change.product_id} not found"
+            )
+        if stock[change.product_id] < change.quantity:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Not enough stock for product {change.product_id}",
+            )
+
+    get_cart_store().apply(db, user_id, changes, prices)
+
+
+def _add_to_cart(db: Session, user_id: int, item: CartItemCreate):
+    _change_cart(db, user_id, [CartChange(ADD, item.product_id, item.quantity)])
+
+
+def _get_cart(db: Session, user_id: int) -> Optional[bytes]:
+    """The user's cart as CartOut JSON."""
+    return get_cart_store().get_json(db, user_id)
+
+
+def _get_cart_summary(db: Session, user_id: int):
+    return get_cart_store().get_totals(db, user_id)
+
+
+def _reserve_cart(db: Session, user_id: int):
+    OrderItemQ = OrderItem.__sqlmodel__
+    OrderQ = Order.__sqlmodel__
+    ProductQ = Product.__sqlmodel__
+    sharding.route(db, user_id)
+    cart = get_cart_store().get(db, user_id)
+    if not cart or not cart.items:
+        raise HTTPException(status_code=404, detail="Cart is empty")
+    products = db.execute(
+        select(ProductQ.id, ProductQ.price, ProductQ.stock).where(
+            ProductQ.id.in_(cart.items)
+        )
+    ).all()
+
+    # Charge current prices, whatever the cart's running subtotal says
+    total = 0
+    quantities = {}
+    prices = {}
+    for product_id, price, stock in products:
+        quantity = cart.items[product_id]
+        if stock < quantity:
+            raise HTTPException(
+                status_code=400, detail=f"Insufficient stock for product {product_id}"
+            )
+        total += price * quantity
+        quantities[product_id] = quantity
+        prices[product_id] = price
+    if not quantities:
+        raise HTTPException(status_code=404, detail="Cart is empty")
+    if abs(total - cart.subtotal) >= 0.005:
+        logger.info(
+            "Cart %s subtotal %.2f reconciled to %.2f at checkout",
+            cart.id,
+            cart.subtotal,
+            total,
+        )
+
+    # A retried or doubly submitted checkout of the same cart pays for the
+    # order the first one created
+    pending = _pending_order(db, user_id, quantities, total)
+    if pending is not None:
+        order_id, created_at = pending
+        db.rollback()
+        return order_id, total, _idempotency_key(order_id, created_at)
+
+    # Create a pending order, then all of its items in a single executemany
+    order = OrderQ(
+        user_id=user_id,
+        status="pending",
+        total_amount=total,
+        payment_intent_status="pending",
+    )
+    db.add(order)
+    db.flush()
+    order_id = order.id
+    db.execute(
+        insert(OrderItemQ),
+        [
+            {
+                "order_id": order_id,
+                "product_id": product_id,
+                "quantity": quantity,
+                "price": prices[product_id],
+            }
+            for product_id, quantity in quantities.items()
+        ],
+    )
+
+    # Hold the stock until the payment succeeds or the reservation expires
+    try:
+        inventory.reserve(db, order_id, quantities)
+    except inventory.InsufficientStock:
+        db.rollback()
+        raise HTTPException(status_code=409, detail="Insufficient stock, try again")
+
+    idempotency_key = _idempotency_key(order_id, order.created_at)
+    db.commit()
+    return order_id, total, idempotency_key
+
+
+def _pending_order(db: Session, user_id: int, quantities: dict, total: float):
+    """
+    The (id, created_at) of the user's pending order, not yet given a payment
+    intent, for exactly ``quantities`` at ``total``; None if there is none.
+    """
+    OrderQ = Order.__sqlmodel__
+    OrderItemQ = OrderItem.__sqlmodel__
+    rows = db.execute(
+        select(OrderQ.id, OrderQ.created_at, OrderItemQ.product_id, OrderItemQ.quantity)
+        .join(OrderItemQ, OrderItemQ.order_id == OrderQ.id)
+        .where(
+            OrderQ.user_id == user_id,
+            OrderQ.status == "pending",
+            OrderQ.payment_intent_id.is_(None),
+            OrderQ.total_amount == total,
+        )
+    ).all()
+    orders: Dict[tuple, dict] = {}
+    for order_id, created_at, product_id, quantity in rows:
+        orders.setdefault((order_id, created_at), {})[product_id] = quantity
+    for order, items in orders.items():
+        if items == quantities:
+            return order
+    return None
+
+
+def _idempotency_key(order_id: int, created_at: datetime.datetime) -> str:
+    """
+    One key per order, so the provider creates one intent for it however
+    often its checkout is retried. The creation time keeps the key unique
+    should the database ever hand out the id again.
+    """
+    raw = f"{order_id}:{created_at.isoformat()}"
+    return "checkout-" + hashlib.sha256(raw.encode()).hexdigest()
+
+
+def _cancel_order(db: Session, user_id: int, order_id: int):
+    OrderQ = Order.__sqlmodel__
+    sharding.route(db, user_id)
+    inventory.release(db, order_id)
+    db.query(OrderQ).filter(OrderQ.id == order_id).update({"status": "cancelled"})
+    db.commit()
+
+
+def _confirm_order(db: Session, user_id: int, order_id: int, intent_id: str):
+    OrderQ = Order.__sqlmodel__
+    sharding.route(db, user_id)
+    db.query(OrderQ).filter(OrderQ.id == order_id).update(
+        {"payment_intent_id": intent_id}
+    )
+    get_cart_store().clear(db, user_id)
+    db.commit()
+
+
 # Add these new endpoints
 @router.post("/cart/items/", response_model=CartOut)
 async def add_to_cart(
     item: CartItemCreate,
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_session),
     current_user: User = Depends(get_current_user),
 ):
-    # Get or create cart
-    CartQ = Cart.__sqlmodel__
-    cart = db.query(CartQ).filter(CartQ.user_id == current_user.id).first()
-    if not cart:
-        cart = CartQ(user_id=current_user.id)
-        db.add(cart)
-        db.commit()
-
-    # Check if product exists and has enough stock
-    ProductQ = Product.__sqlmodel__
-    product = db.query(ProductQ).filter(ProductQ.id == item.product_id).first()
-    if not product:
-        raise HTTPException(status_code=404, detail="Product not found")
-    if product.stock < item.quantity:
-        raise HTTPException(status_code=400, detail="Not enough stock")
-
-    # Add or update cart item
-    CartItemQ = CartItem.__sqlmodel__
-    cart_item = (
-        db.query(CartItemQ)
-        .filter(CartItemQ.cart_id == cart.id, CartItemQ.product_id == item.product_id)
-        .first()
-    )
+    await run_db(db, _add_to_cart, current_user.id, item)
+    return await get_cart(db, current_user)
 
-    if cart_item:
-        cart_item.quantity += item.quantity
-    else:
-        cart_item = CartItemQ(
-            cart_id=cart.id, product_id=item.product_id, quantity=item.quantity
-        )
-        db.add(cart_item)
 
-    db.commit()
+@router.post("/cart/items/batch", response_model=CartOut)
+async def change_cart(
+    changes: List[CartItemChange],
+    db: Session = Depends(get_session),
+    current_user: User = Depends(get_current_user),
+):
+    """
+    Add, set or remove several cart lines at once. The changes apply in
+    order and all together: if any product is missing or short on stock,
+    none of them are made.
+    """
+    if len(changes) > app_config.CART_BATCH_MAX_CHANGES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {app_config.CART_BATCH_MAX_CHANGES} changes per batch",
+        )
+    if changes:
+        await run_db(
+            db,
+            _change_cart,
+            current_user.id,
+            [CartChange(c.op, c.product_id, c.quantity) for c in changes],
+        )
     return await get_cart(db, current_user)
 
 
 @router.get("/cart/", response_model=CartOut)
 async def get_cart(
-    db: Session = Depends(get_db), current_user: User = Depends(get_current_user)
+    db: Session = Depends(get_read_session),
+    current_user: User = Depends(get_current_user),
 ):
-    CartQ = Cart.__sqlmodel__
-    cart = db.query(CartQ).filter(CartQ.user_id == current_user.id).first()
-    if not cart:
+    cart = await run_db(db, _get_cart, current_user.id)
+    if cart is None:
         raise HTTPException(status_code=404, detail="Cart not found")
+    return Response(content=cart, media_type="application/json")
 
-    # Calculate total
-    total = 0
-    for item in cart.items:
-        total += item.product.price * item.quantity
-
-    return CartOut(
-        id=cart.id,
-        items=[
-            CartItemOut(
-                product_id=item.product_id,
-                quantity=item.quantity,
-                product=ProductOut.from_orm(item.product),
-            )
-            for item in cart.items
-        ],
-        total=total,
+
+@router.get("/cart/summary", response_model=CartSummary)
+async def get_cart_summary(
+    db: Session = Depends(get_read_session),
+    current_user: User = Depends(get_current_user),
+):
+    """The cart's total and item count, read without loading its items."""
+    totals = await run_db(db, _get_cart_summary, current_user.id)
+    if totals is None:
+        raise HTTPException(status_code=404, detail="Cart not found")
+    return CartSummary(
+        id=totals.id, total=totals.subtotal, item_count=totals.item_count
     )
 
 
 @router.post("/cart/checkout/")
 async def checkout(
     background_tasks: BackgroundTasks,
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_session),
     current_user: User = Depends(get_current_user),
+    gateway: PaymentGateway = Depends(get_payment_gateway),
 ):
-    CartQ = Cart.__sqlmodel__
-    OrderItemQ = OrderItem.__sqlmodel__
-    OrderQ = Order.__sqlmodel__
-    cart = db.query(CartQ).filter(CartQ.user_id == current_user.id).first()
-    if not cart or not cart.items:
-        raise HTTPException(status_code=404, detail="Cart is empty")
-
-    # Calculate total
-    total = 0
-    order_items = []
-    for cart_item in cart.items:
-        product = cart_item.product
-        if product.stock < cart_item.quantity:
-            raise HTTPException(
-                status_code=400, detail=f"Insufficient stock for product {product.id}"
-            )
-        total += product.price * cart_item.quantity
-        order_items.append(
-            OrderItemQ(
-                product_id=product.id, quantity=cart_item.quantity, price=product.price
-            )
-        )
+    order_id, total, idempotency_key = await run_db(db, _reserve_cart, current_user.id)
 
-    # Create Stripe payment intent
+    # Create the payment intent without blocking the event loop. Metadata
+    # must not vary between retries of one order: Stripe rejects a reused
+    # idempotency key sent with different parameters. The order id lets the
+    # webhook find the order before _confirm_order has linked the intent.
     try:
-        intent = stripe.PaymentIntent.create(
+        intent = await gateway.create_payment_intent(
             amount=int(total * 100),  # Convert to cents
             currency="usd",
-            metadata={"user_id": current_user.id},
+            metadata={"user_id": str(current_user.id), "order_id": str(order_id)},
+            idempotency_key=idempotency_key,
+        )
+    except GatewayUnavailable as e:
+        await run_db(db, _cancel_order, current_user.id, order_id)
+        raise HTTPException(
+            status_code=503,
+            detail=str(e),
+            headers={"Retry-After": str(math.ceil(e.retry_after))},
         )
-    except stripe.error.StripeError as e:
+    except PaymentError as e:
+        await run_db(db, _cancel_order, current_user.id, order_id)
         raise HTTPException(status_code=400, detail=str(e))
 
-    # Create order
-    order_items = [o for o in order_items]
-    order = OrderQ(
-        user_id=current_user.id,
-        status="pending",
-        total_amount=total,
-        items=order_items,
-        payment_intent_id=intent.id,
-        payment_intent_status="pending",
-    )
-
-    db.add(order)
-
-    # Clear cart
-    for item in cart.items:
-        db.delete(item)
-    db.delete(cart)
-
-    db.commit()
+    await run_db(db, _confirm_order, current_user.id, order_id, intent.id)
 
-    return {"client_secret": intent.client_secret, "order_id": order.id}
+    return {"client_secret": intent.client_secret, "order_id": order_id}
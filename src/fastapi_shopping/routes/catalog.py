@@ -1,52 +1,256 @@
-from typing import List
+from typing import List, Literal, Optional
 
-from db import get_db
-from fastapi import APIRouter, Depends, HTTPException
+import catalog_io
+from app.config import app_config
+from auth import get_current_admin
+from cart_store import get_cart_store
+from catalog_cache import (
+    cache_key,
+    catalog_cache,
+    invalidate_categories,
+    invalidate_products,
+)
+from db import get_db, get_read_db, get_session, run_db
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
 from models import Category, Product
-from pydantic_models import CategoryCreate, CategoryOut, ProductCreate, ProductOut
+from pagination import keyset_page
+from pydantic_models import (
+    CategoryCreate,
+    CategoryOut,
+    ImportResult,
+    ProductCreate,
+    ProductOut,
+    ProductUpdate,
+)
+from search import search_products
+from serialization import columns_for, dump, dump_rows
 from sqlalchemy.orm import Session
 
 router = APIRouter(prefix="/catalog")
 
 
+# Reads select row tuples and return the serialized JSON directly (see
+# serialization.py), skipping response_model validation.
+def _cached(key: str, load) -> Response:
+    return Response(
+        content=catalog_cache.get_or_load(key, load), media_type="application/json"
+    )
+
+
+# Paginated listings also cache their next cursor, returned in X-Next-Cursor
+def _cached_page(key: str, load) -> Response:
+    def load_page():
+        body, next_cursor = load()
+        return (next_cursor or "").encode() + b"\n" + body
+
+    next_cursor, body = catalog_cache.get_or_load(key, load_page).split(b"\n", 1)
+    response = Response(content=body, media_type="application/json")
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor.decode()
+    return response
+
+
 # Category endpoints
 @router.post("/categories/", response_model=CategoryOut)
 def create_category(category: CategoryCreate, db: Session = Depends(get_db)):
     db_category = Category(**category.dict()).sqlmodel()
     db.add(db_category)
+    invalidate_categories(db)
     db.commit()
     db.refresh(db_category)
     return db_category
 
 
 @router.get("/categories/", response_model=List[CategoryOut])
-def get_categories(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    CategoryQ = Category.__sqlmodel__
-    categories = db.query(CategoryQ).offset(skip).limit(limit).all()
-    return categories
+def get_categories(
+    skip: int = 0,
+    limit: int = 100,
+    cursor: Optional[str] = None,
+    db: Session = Depends(get_read_db),
+):
+    def load():
+        CategoryQ = Category.__sqlmodel__
+        categories, next_cursor = keyset_page(
+            db.query(*columns_for(CategoryOut, CategoryQ)),
+            "id",
+            [CategoryQ.id],
+            cursor,
+            limit,
+            offset=skip,
+        )
+        return dump_rows(CategoryOut, categories), next_cursor
+
+    return _cached_page(cache_key("categories", skip, limit, cursor), load)
 
 
 # Product endpoints
 @router.post("/products/", response_model=ProductOut)
 def create_product(product: ProductCreate, db: Session = Depends(get_db)):
-    db_product = Product(**product.dict()).sqlmodel()
+    # The dataclass __init__ doesn't know the generated category_id column
+    db_product = Product.__sqlmodel__(**product.model_dump())
     db.add(db_product)
+    invalidate_products(db)
     db.commit()
     db.refresh(db_product)
     return db_product
 
 
 @router.get("/products/", response_model=List[ProductOut])
-def get_products(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    ProductQ = Product.__sqlmodel__
-    products = db.query(ProductQ).offset(skip).limit(limit).all()
-    return products
+def get_products(
+    skip: int = 0,
+    limit: int = 100,
+    cursor: Optional[str] = None,
+    sort: Literal["id", "price", "name"] = "id",
+    db: Session = Depends(get_read_db),
+):
+    """
+    List products ordered by ``sort``. Pass the X-Next-Cursor header of one
+    page as ``cursor`` to fetch the next; ``skip`` is kept for old clients
+    but gets slower with depth.
+    """
+
+    def load():
+        ProductQ = Product.__sqlmodel__
+        columns = {
+            "id": [ProductQ.id],
+            "price": [ProductQ.price, ProductQ.id],
+            "name": [ProductQ.name, ProductQ.id],
+        }[sort]
+        products, next_cursor = keyset_page(
+            db.query(*columns_for(ProductOut, ProductQ)),
+            sort,
+            columns,
+            cursor,
+            limit,
+            offset=skip,
+        )
+        return dump_rows(ProductOut, products), next_cursor
+
+    return _cached_page(cache_key("products", sort, skip, limit, cursor), load)
+
+
+@router.post(
+    "/products/import",
+    response_model=ImportResult,
+    dependencies=[Depends(get_current_admin)],
+)
+async def import_products(
+    request: Request,
+    format: Optional[Literal["ndjson", "csv"]] = None,
+    db: Session = Depends(get_session),
+):
+    """
+    Bulk-create products from an NDJSON or CSV body (with a header row),
+    streamed and inserted in batches. ``format`` defaults from Content-Type.
+    Invalid rows are skipped and reported; valid rows are kept.
+    """
+    if format is None:
+        content_type = request.headers.get("content-type", "")
+        format = "csv" if content_type.startswith("text/csv") else "ndjson"
+
+    inserted, failed, errors = 0, 0, []
+    lines = catalog_io.iter_lines(request.stream())
+    async for batch in catalog_io.iter_batches(
+        lines, format, app_config.CATALOG_IMPORT_BATCH_SIZE
+    ):
+        batch_inserted, batch_errors = await run_db(db, catalog_io.import_batch, batch)
+        inserted += batch_inserted
+        failed += len(batch_errors)
+        errors.extend(
+            batch_errors[: app_config.CATALOG_IMPORT_MAX_ERRORS - len(errors)]
+        )
+    return ImportResult(inserted=inserted, failed=failed, errors=errors)
+
+
+@router.get("/products/export")
+def export_products(
+    format: Literal["ndjson", "csv"] = "ndjson", db: Session = Depends(get_read_db)
+):
+    # The dependency's session is closed before the body streams, so the
+    # export reads through a session of its own on the same database
+    bind = db.get_bind()
+
+    def rows():
+        export_db = Session(bind=bind)
+        try:
+            yield from catalog_io.export_products(export_db, format)
+        finally:
+            export_db.close()
+
+    return StreamingResponse(rows(), media_type=catalog_io.MEDIA_TYPES[format])
 
 
 @router.get("/products/{product_id}", response_model=ProductOut)
-def get_product(product_id: int, db: Session = Depends(get_db)):
+def get_product(product_id: int, db: Session = Depends(get_read_db)):
+    def load():
+        ProductQ = Product.__sqlmodel__
+        product = (
+            db.query(*columns_for(ProductOut, ProductQ))
+            .filter(ProductQ.id == product_id)
+            .first()
+        )
+        if product is None:
+            raise HTTPException(status_code=404, detail="Product not found")
+        return dump(ProductOut, product._asdict())
+
+    return _cached(cache_key("product", product_id), load)
+
+
+@router.patch(
+    "/products/{product_id}",
+    response_model=ProductOut,
+    dependencies=[Depends(get_current_admin)],
+)
+def update_product(
+    product_id: int, changes: ProductUpdate, db: Session = Depends(get_db)
+):
     ProductQ = Product.__sqlmodel__
-    product = db.query(ProductQ).filter(ProductQ.id == product_id).first()
+    product = db.get(ProductQ, product_id)
     if product is None:
         raise HTTPException(status_code=404, detail="Product not found")
+    old_price = product.price
+    for name, value in changes.model_dump(exclude_unset=True).items():
+        setattr(product, name, value)
+    if product.price != old_price:
+        get_cart_store().reprice(db, product_id, old_price, product.price)
+    invalidate_products(db, [product_id])
+    db.commit()
+    db.refresh(product)
     return product
+
+
+@router.get("/search", response_model=List[ProductOut])
+def search(
+    q: str = Query(min_length=1),
+    category_id: Optional[int] = None,
+    min_price: Optional[float] = None,
+    max_price: Optional[float] = None,
+    limit: int = Query(20, ge=1, le=100),
+    offset: int = Query(0, ge=0),
+    db: Session = Depends(get_read_db),
+):
+    """
+    Products whose name or description contains every word of ``q``, best
+    matches first. The last word also matches as a prefix.
+
+    If SEARCH_MAX_CANDIDATES is set, only that many of the newest matching
+    products are ranked and paging past them is a 400.
+    """
+    if db.get_bind().dialect.name != "sqlite":
+        raise HTTPException(status_code=501, detail="Search requires SQLite FTS5")
+    cap = app_config.SEARCH_MAX_CANDIDATES
+    if cap and offset >= cap:
+        raise HTTPException(
+            status_code=400,
+            detail=(
+                f"Search ranks only the newest {cap} "
+                "matches; narrow the query instead of paging further"
+            ),
+        )
+    products = search_products(
+        db, q, category_id, min_price, max_price, limit=limit, offset=offset
+    )
+    return Response(
+        content=dump_rows(ProductOut, products), media_type="application/json"
+    )
@@ -0,0 +1,24 @@
+import metrics
+from auth import user_cache
+from catalog_cache import catalog_cache
+from db import engine, pool_stats
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+
+router = APIRouter()
+
+
+@router.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+def get_metrics():
+    """Request, SQL, connection pool and cache metrics for Prometheus to scrape."""
+    return PlainTextResponse(
+        metrics.registry.render()
+        + metrics.render_gauges("db_pool", pool_stats(engine), "Connection pool.")
+        + metrics.render_gauges(
+            "user_cache", user_cache.stats(), "Authenticated user cache."
+        )
+        + metrics.render_labelled_gauges(
+            "catalog_cache", "family", catalog_cache.stats(), "Catalog cache."
+        ),
+        media_type="text/plain; version=0.0.4",
+    )
@@ -1,8 +1,11 @@
-from db import get_db
+import inventory
+import sharding
+from db import get_db, get_read_db
 from fastapi import APIRouter, Depends, HTTPException
 from models import Order, OrderItem, Product
 from pydantic_models import OrderCreate, OrderOut
-from sqlalchemy.orm import Session
+from sqlalchemy import insert
+from sqlalchemy.orm import Session, selectinload
 
 router = APIRouter(prefix="/catalog")
 
@@ -10,47 +13,77 @@ router = APIRouter(prefix="/catalog")
 # Order endpoints
 @router.post("/orders/", response_model=OrderOut)
 def create_order(order: OrderCreate, db: Session = Depends(get_db)):
-    # Calculate total amount and create order
-    total_amount = 0
-    order_items = []
+    ProductQ = Product.__sqlmodel__
+    OrderItemQ = OrderItem.__sqlmodel__
+    OrderQ = Order.__sqlmodel__
 
+    # Merge duplicate lines for the same product
+    quantities = {}
     for item in order.items:
-        ProductQ = Product.__sqlmodel__
-        product = db.query(ProductQ).filter(ProductQ.id == item.product_id).first()
+        quantities[item.product_id] = quantities.get(item.product_id, 0) + item.quantity
+
+    # Fetch every referenced product in one query
+    products = {
+        product.id: product
+        for product in db.query(ProductQ).filter(ProductQ.id.in_(quantities)).all()
+    }
+
+    # Calculate total amount
+    total_amount = 0
+    for product_id, quantity in quantities.items():
+        product = products.get(product_id)
         if not product:
             raise HTTPException(
-                status_code=404, detail=f"Product {item.product_id} not found"
+                status_code=404, detail=f"Product {product_id} not found"
             )
-        if product.stock < item.quantity:
+        if product.stock < quantity:
             raise HTTPException(
                 status_code=400,
-                detail=f"Insufficient stock for product {item.product_id}",
+                detail=f"Insufficient stock for product {product_id}",
             )
+        total_amount += product.price * quantity
 
-        total_amount += product.price * item.quantity
-        order_items.append(
-            OrderItem(
-                product_id=item.product_id, quantity=item.quantity, price=product.price
-            ).sqlmodel()
-        )
-
-        # Update stock
-        product.stock -= item.quantity
-
-    db_order = Order(
-        status="pending", total_amount=total_amount, items=order_items
-    ).sqlmodel()
-
+    # Orders without a user are kept on the first shard
+    sharding.route(db, None)
+    db_order = OrderQ(status="pending", total_amount=total_amount)
     db.add(db_order)
+    db.flush()
+    order_id = db_order.id
+    db.execute(
+        insert(OrderItemQ),
+        [
+            {
+                "order_id": order_id,
+                "product_id": product_id,
+                "quantity": quantity,
+                "price": products[product_id].price,
+            }
+            for product_id, quantity in quantities.items()
+        ],
+    )
+
+    # Orders placed here need no payment, so the stock is taken for good
+    try:
+        inventory.reserve(db, order_id, quantities)
+    except inventory.InsufficientStock:
+        db.rollback()
+        raise HTTPException(status_code=409, detail="Insufficient stock, try again")
+    inventory.commit(db, order_id)
     db.commit()
-    db.refresh(db_order)
-    return db_order
+    return get_order(order_id, db)
 
 
 @router.get("/orders/{order_id}", response_model=OrderOut)
-def get_order(order_id: int, db: Session = Depends(get_db)):
+def get_order(order_id: int, db: Session = Depends(get_read_db)):
     OrderQ = Order.__sqlmodel__
-    order = db.query(OrderQ).filter(OrderQ.id == order_id).first()
+    if not sharding.route_to_order(db, order_id):
+        raise HTTPException(status_code=404, detail="Order not found")
+    order = (
+        db.query(OrderQ)
+        .options(selectinload(OrderQ.items))
+        .filter(OrderQ.id == order_id)
+        .first()
+    )
     if order is None:
         raise HTTPException(status_code=404, detail="Order not found")
     return order
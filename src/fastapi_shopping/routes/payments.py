@@ -1,49 +1,40 @@
-import stripe
-from db import get_db
-from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Request
-from models import Order
+import webhooks
+from app.config import app_config
+from db import SessionLocal, get_session, run_db
+from fastapi import APIRouter, Depends, HTTPException, Request
 from sqlalchemy.orm import Session
 
 router = APIRouter(prefix="/payments")
 
-# Initialize Stripe
-stripe.api_key = "your_stripe_secret_key"
+# Started and stopped by the app lifespan
+webhook_processor = webhooks.WebhookProcessor(SessionLocal)
 
 
 @router.post("/webhook/stripe")
-async def stripe_webhook(
-    request: Request, background_tasks: BackgroundTasks, db: Session = Depends(get_db)
-):
+async def stripe_webhook(request: Request, db: Session = Depends(get_session)):
+    """
+    Verify and record the event, then acknowledge it. The event is handled
+    by the webhook workers; a duplicate delivery is acknowledged and dropped.
+    """
+    # Imported here: the stripe package takes longer to import than the rest
+    # of the app, and only this endpoint needs it
+    import stripe
+
     payload = await request.body()
     sig_header = request.headers.get("stripe-signature")
 
     try:
         event = stripe.Webhook.construct_event(
-            payload, sig_header, "your_stripe_webhook_secret"
+            payload, sig_header, app_config.STRIPE_WEBHOOK_SECRET
         )
     except ValueError:
         raise HTTPException(status_code=400, detail="Invalid payload")
     except stripe.error.SignatureVerificationError:
         raise HTTPException(status_code=400, detail="Invalid signature")
 
-    if event["type"] == "payment_intent.succeeded":
-        payment_intent = event["data"]["object"]
-        OrderQ = Order.__sqlmodel__
-        order = (
-            db.query(OrderQ)
-            .filter(OrderQ.payment_intent_id == payment_intent["id"])
-            .first()
-        )
-
-        if order:
-            order.payment_status = "paid"
-            order.status = "paid"
-
-            # Update product stock
-            for item in order.items:
-                product = item.product
-                product.stock -= item.quantity
-
-            db.commit()
-
+    event = event.to_dict() if hasattr(event, "to_dict") else dict(event)
+    if "id" not in event or "type" not in event:
+        raise HTTPException(status_code=400, detail="Invalid payload")
+    if await run_db(db, webhooks.record_event, event):
+        webhook_processor.notify()
     return {"status": "success"}
@@ -1,52 +1,53 @@
-import datetime
-from datetime import timedelta
-
-import jwt
-from app.config import app_config
-from db import get_db
+from auth import invalidate_user
+from db import get_session, run_db
 from fastapi import APIRouter, Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from models import User
-from passlib.context import CryptContext
+from passwords import get_password_hash, verify_password
 from pydantic_models import UserCreate, UserOut
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
+from tokens import create_access_token
 
 router = APIRouter(prefix="/user")
 
-# Password hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
 
-# Authentication utilities
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
-
-
-def get_password_hash(password):
-    return pwd_context.hash(password)
+# Authentication endpoints
+def _find_user(db: Session, email: str):
+    UserQ = User.__sqlmodel__
+    user = (
+        db.query(UserQ.id, UserQ.email, UserQ.hashed_password)
+        .filter(UserQ.email == email)
+        .first()
+    )
+    # Hand the connection back before the caller waits on bcrypt, which can
+    # take longer than the pool timeout when many logins queue up
+    db.rollback()
+    return user
 
 
-def create_access_token(data: dict):
-    to_encode = data.copy()
-    expire = datetime.datetime.utcnow() + timedelta(
-        minutes=app_config.ACCESS_TOKEN_EXPIRE_MINUTES
-    )
-    to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(
-        to_encode, app_config.SECRET_KEY, algorithm=app_config.ALGORITHM
-    )
-    return encoded_jwt
+def _add_user(db: Session, email: str, hashed_password: str):
+    db_user = User(email=email, hashed_password=hashed_password).sqlmodel()
+    db.add(db_user)
+    try:
+        db.commit()
+    except IntegrityError:
+        # A concurrent sign-up with the same email got there first
+        db.rollback()
+        raise HTTPException(status_code=400, detail="Email already registered")
+    db.refresh(db_user)
+    return db_user
 
 
-# Authentication endpoints
 @router.post("/token")
 async def login(
-    form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)
+    form_data: OAuth2PasswordRequestForm = Depends(),
+    db: Session = Depends(get_session),
 ):
-    UserQ = User.__sqlmodel__
-    user = db.query(UserQ).filter(UserQ.email == form_data.username).first()
-    if not user or not verify_password(form_data.password, user.hashed_password):
+    user = await run_db(db, _find_user, form_data.username)
+    if not user or not await verify_password(form_data.password, user.hashed_password):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect email or password",
@@ -58,14 +59,10 @@ async def login(
 
 # User endpoints
 @router.post("/users/", response_model=UserOut)
-def create_user(user: UserCreate, db: Session = Depends(get_db)):
-    UserQ = User.__sqlmodel__
-    db_user = db.query(UserQ).filter(UserQ.email == user.email).first()
-    if db_user:
+async def create_user(user: UserCreate, db: Session = Depends(get_session)):
+    if await run_db(db, _find_user, user.email):
         raise HTTPException(status_code=400, detail="Email already registered")
-    hashed_password = get_password_hash(user.password)
-    db_user = User(email=user.email, hashed_password=hashed_password).sqlmodel()
-    db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
+    hashed_password = await get_password_hash(user.password)
+    db_user = await run_db(db, _add_user, user.email, hashed_password)
+    invalidate_user(db_user.email)
     return db_user
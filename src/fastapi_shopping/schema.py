@@ -0,0 +1,49 @@
+"""
+Index declarations for fquery models.
+
+fquery's ``@sqlmodel`` maps dataclass fields to columns but has no notion of
+indexes. The ``sqlmodel`` decorator here wraps it and adds an index for
+every field declared with ``indexed()`` and for every column tuple listed in
+the class's ``__indexes__``, e.g.
+
+    @sqlmodel
+    class CartItem:
+        __indexes__ = (("cart_id", "product_id"),)
+        ...
+
+Generated foreign key columns (``<relationship>_id``) can be indexed
+through ``__indexes__``. Indexes are named ``ix_<table>_<columns>``.
+"""
+
+from dataclasses import MISSING, field, fields
+
+from fquery.sqlmodel import sqlmodel as fquery_sqlmodel
+from sqlalchemy import Index
+
+
+def indexed(unique: bool = False, default=MISSING):
+    """A column with an index, optionally a unique one."""
+    # fquery's own "unique" flag drops the column type, so use a separate key
+    return field(default=default, metadata={"SQL": {"index": {"unique": unique}}})
+
+
+def index_name(table_name: str, columns) -> str:
+    return "_".join(["ix", table_name, *columns])
+
+
+def sqlmodel(cls):
+    cls = fquery_sqlmodel(cls)
+    table = cls.__sqlmodel__.__table__
+    declared = [
+        ((f.name,), f.metadata["SQL"]["index"]["unique"])
+        for f in fields(cls)
+        if "index" in f.metadata.get("SQL", {})
+    ]
+    declared += [(tuple(columns), False) for columns in getattr(cls, "__indexes__", ())]
+    for columns, unique in declared:
+        Index(
+            index_name(table.name, columns),
+            *[table.c[column] for column in columns],
+            unique=unique,
+        )
+    return cls
@@ -0,0 +1,164 @@
+"""
+Full-text product search on SQLite FTS5.
+
+``products_fts`` is an external-content FTS5 index over the name,
+description and category of ``products``: it stores only the inverted
+index, and triggers keep it in step with every insert, delete and update of
+those columns. Stock and price updates don't touch it. The category is
+indexed so filtering on it is an index intersection rather than a lookup
+per match.
+
+Every match is ranked with bm25, weighting name matches above description
+matches. Ranking costs a few microseconds per matching row, so a common
+word in a very large catalog can be slow. Deployments that would rather
+trade recall for latency can set SEARCH_MAX_CANDIDATES to rank only the
+newest matches (after filters); older ones are then never returned.
+"""
+
+import re
+from typing import List, Optional
+
+from app.config import app_config
+from models import Product
+from pydantic_models import ProductOut
+from serialization import columns_for
+from sqlalchemy import column, event, table
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.orm import Session
+
+# Relative bm25 weights of the name and description columns. category_id
+# is only ever used as a filter.
+NAME_WEIGHT = 10.0
+DESCRIPTION_WEIGHT = 1.0
+
+FTS_DDL = [
+    # prefix='2 3' keeps short prefix queries ("la*", "lap*") index lookups
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5(
+        name, description, category_id, content='products', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+    )
+    """,
+    f"""
+    INSERT INTO products_fts(products_fts, rank)
+    VALUES ('rank', 'bm25({NAME_WEIGHT}, {DESCRIPTION_WEIGHT}, 0)')
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS products_fts_insert AFTER INSERT ON products
+    BEGIN
+        INSERT INTO products_fts(rowid, name, description, category_id)
+        VALUES (new.id, new.name, new.description, new.category_id);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS products_fts_delete AFTER DELETE ON products
+    BEGIN
+        INSERT INTO products_fts(products_fts, rowid, name, description, category_id)
+        VALUES ('delete', old.id, old.name, old.description, old.category_id);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS products_fts_update
+    AFTER UPDATE OF name, description, category_id ON products
+    BEGIN
+        INSERT INTO products_fts(products_fts, rowid, name, description, category_id)
+        VALUES ('delete', old.id, old.name, old.description, old.category_id);
+        INSERT INTO products_fts(rowid, name, description, category_id)
+        VALUES (new.id, new.name, new.description, new.category_id);
+    END
+    """,
+]
+
+products_fts = table(
+    "products_fts", column("products_fts"), column("rowid"), column("rank")
+)
+
+
+def create_search_index(conn: Connection, rebuild: bool = False):
+    for ddl in FTS_DDL:
+        conn.exec_driver_sql(ddl)
+    if rebuild:
+        # Index rows that were written before the triggers existed
+        conn.exec_driver_sql(
+            "INSERT INTO products_fts(products_fts) VALUES ('rebuild')"
+        )
+
+
+def migrate(engine: Engine):
+    if engine.dialect.name == "sqlite":
+        with engine.begin() as conn:
+            create_search_index(conn, rebuild=True)
+
+
+@event.listens_for(Product.__sqlmodel__.__table__, "after_create")
+def _create_with_products(target, connection: Connection, **kw):
+    if connection.dialect.name == "sqlite":
+        create_search_index(connection)
+
+
+@event.listens_for(Product.__sqlmodel__.__table__, "before_drop")
+def _drop_with_products(target, connection: Connection, **kw):
+    if connection.dialect.name == "sqlite":
+        connection.exec_driver_sql("DROP TABLE IF EXISTS products_fts")
+
+
+def match_expression(text: str, category_id: Optional[int] = None) -> Optional[str]:
+    """
+    Turn free text into an FTS5 query: every word must match the name or
+    description and the last one may be a prefix, so results narrow as the
+    user types. Returns None when there is nothing to search for.
+    """
+    words = re.findall(r"\w+", text)
+    if not words:
+        return None
+    terms = [f'"{word}"' for word in words]
+    terms[-1] += "*"
+    match = "{name description} : (" + " ".join(terms) + ")"
+    if category_id is not None:
+        match += f' AND category_id : "{int(category_id)}"'
+    return match
+
+
+def search_products(
+    db: Session,
+    text: str,
+    category_id: Optional[int] = None,
+    min_price: Optional[float] = None,
+    max_price: Optional[float] = None,
+    limit: int = 20,
+    offset: int = 0,
+    max_candidates: Optional[int] = None,
+) -> List:
+    """
+    Matching products, as rows of the ProductOut columns. ``max_candidates``
+    defaults to SEARCH_MAX_CANDIDATES; 0 ranks every match.
+    """
+    match = match_expression(text, category_id)
+    if match is None:
+        return []
+    if max_candidates is None:
+        max_candidates = app_config.SEARCH_MAX_CANDIDATES
+    ProductQ = Product.__sqlmodel__
+    query = (
+        db.query(*columns_for(ProductOut, ProductQ))
+        .join(products_fts, products_fts.c.rowid == ProductQ.id)
+        .filter(products_fts.c.products_fts.match(match))
+    )
+    if min_price is not None:
+        query = query.filter(ProductQ.price >= min_price)
+    if max_price is not None:
+        query = query.filter(ProductQ.price <= max_price)
+
+    if max_candidates:
+        # Rowid of the oldest candidate; FTS5 walks matches in rowid order
+        # without ranking, so this is cheap.
+        oldest = (
+            query.with_entities(products_fts.c.rowid)
+            .order_by(products_fts.c.rowid.desc())
+            .offset(max_candidates - 1)
+            .limit(1)
+            .scalar()
+        )
+        if oldest is not None:
+            query = query.filter(products_fts.c.rowid >= oldest)
+    return query.order_by(products_fts.c.rank).offset(offset).limit(limit).all()
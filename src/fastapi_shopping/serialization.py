@@ -0,0 +1,64 @@
+"""
+Serialize query rows straight to JSON bytes.
+
+Returning ORM objects from a handler costs two passes: FastAPI validates
+them against ``response_model`` (building a pydantic model per row, reading
+every attribute through the ORM) and then serializes the result. Rows read
+from our own database are already valid, so list endpoints instead select
+just the columns a response model declares, as plain row tuples, and dump
+them through a TypeAdapter over a TypedDict mirror of the model. TypedDict
+serialization in pydantic-core doesn't validate or build models.
+
+``response_model`` stays on the routes for the OpenAPI schema.
+"""
+
+import functools
+import types
+from typing import Any, Dict, Iterable, List, Union, get_args, get_origin
+
+from pydantic import BaseModel, TypeAdapter
+from typing_extensions import TypedDict
+
+# ``X | Y`` annotations only exist from Python 3.10
+_UNION_TYPES = (Union, getattr(types, "UnionType", Union))
+
+
+@functools.cache
+def typed_dict(model: type) -> type:
+    """A TypedDict with the fields of ``model``, nested models included."""
+    return TypedDict(
+        f"{model.__name__}Dict",
+        {name: _plain(f.annotation) for name, f in model.model_fields.items()},
+    )
+
+
+def _plain(annotation):
+    if isinstance(annotation, type) and issubclass(annotation, BaseModel):
+        return typed_dict(annotation)
+    origin = get_origin(annotation)
+    if origin is None:
+        return annotation
+    args = tuple(_plain(arg) for arg in get_args(annotation))
+    if origin in _UNION_TYPES:
+        return Union[args]
+    return origin[args]
+
+
+@functools.cache
+def adapter(model: type, many: bool = False) -> TypeAdapter:
+    shape = typed_dict(model)
+    return TypeAdapter(List[shape] if many else shape)
+
+
+def columns_for(model: type, entity) -> list:
+    """The ``entity`` columns that ``model`` serializes, in field order."""
+    return [getattr(entity, name) for name in model.model_fields]
+
+
+def dump(model: type, value: Dict[str, Any]) -> bytes:
+    return adapter(model).dump_json(value)
+
+
+def dump_rows(model: type, rows: Iterable) -> bytes:
+    """Serialize rows selected with columns_for(model, ...) as a JSON list."""
+    return adapter(model, many=True).dump_json([row._asdict() for row in rows])
@@ -0,0 +1,597 @@
+"""
+Horizontal sharding of carts and orders by user id.
+
+With SHARD_URLS set, the carts, cart_items, orders and order_items tables
+live on N shard databases, while users, the catalog, stock reservations and
+webhook events stay on DATABASE_URL, the global database. All of a user's
+rows live on one shard: their home, ``jump_hash(user_id, N)``, unless the
+``user_shards`` directory on the global database places them elsewhere.
+Orders placed without a user live on shard 0.
+
+Sessions are RoutingSessions (see db.py). Code touching sharded tables
+first calls ``route(db, user_id)``, or ``route_to_order()`` when all it has
+is an order id, to point the session's sharded tables at that shard. One
+session may write to a shard and the global database together, but its
+commit isn't atomic across them: a crash in between can leave a stock
+reservation without its order, which the reservation sweeper releases once
+it expires.
+
+Order ids are unique across shards: shard k numbers its orders from
+(k + 1) * ORDER_ID_SPAN, so an order id tells which shard created it.
+Orders keep their id when their user moves.
+
+Rebalancing runs alongside live traffic. From src/fastapi_shopping, with
+SHARD_URLS set to the current shards:
+
+    python -m sharding pin --shards 4   # right before deploying 4 shards
+    python -m sharding rebalance        # after the deploy
+    python -m sharding move 42 3        # move user 42 to shard 3
+    python -m sharding status
+
+``pin`` adds directory entries keeping every user whose home changes with
+the new shard count where they are now. ``rebalance`` then moves them to
+their new home a batch at a time: the batch is marked as moving, and once
+every process has seen that (SHARD_DIRECTORY_CACHE_SECONDS, plus a grace
+period for requests in flight) their rows are copied to the target, the
+directory is updated and the source rows deleted. Only those users'
+requests fail meanwhile, with a 503 and Retry-After. A user who signs up
+between ``pin`` and the deploy and fills a cart in that window keeps it on
+the old shard, unseen.
+"""
+
+import argparse
+import heapq
+import itertools
+import math
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from app.config import app_config
+from cache import TTLCache
+from db import create_db_engine, engine
+from fastapi import HTTPException
+from models import Cart, CartItem, Order, OrderItem, User
+from pydantic_models import OrderOut
+from sqlalchemy import (
+    Column,
+    Index,
+    Integer,
+    MetaData,
+    Table,
+    delete,
+    func,
+    insert,
+    inspect,
+    select,
+    text,
+    tuple_,
+    update,
+)
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.orm import Session, selectinload
+
+SHARDED_MODELS = (Cart, CartItem, Order, OrderItem)
+ORDER_ID_SPAN = 10**12
+
+# Users placed on a shard other than their home, or soon to be (see pin()).
+# ``moving_to`` is set while they're being moved from ``shard``.
+user_shards = Table(
+    "user_shards",
+    MetaData(),
+    Column("user_id", Integer, primary_key=True),
+    Column("shard", Integer, nullable=False),
+    Column("moving_to", Integer, nullable=True),
+)
+
+
+class UserMoving(HTTPException):
+    """The user's rows are being moved between shards."""
+
+    def __init__(self, retry_after: float):
+        super().__init__(
+            status_code=503,
+            detail="Your account is being moved, try again shortly",
+            headers={"Retry-After": str(math.ceil(retry_after))},
+        )
+
+
+def jump_hash(key: int, buckets: int) -> int:
+    """
+    Lamping and Veach's jump consistent hash. Going from n to n + 1 buckets
+    moves only 1/(n + 1) of the keys, all of them to the new bucket.
+    """
+    bucket, j = -1, 0
+    while j < buckets:
+        bucket = j
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        j = int((bucket + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return bucket
+
+
+class ShardMap:
+    def __init__(
+        self,
+        engines: List[Engine],
+        global_engine: Engine,
+        cache_seconds: float = 1.0,
+        cache_size: int = 100000,
+    ):
+        self.engines = engines
+        self.global_engine = global_engine
+        self.cache_seconds = cache_seconds
+        # user id -> (shard, moving_to)
+        self._directory = TTLCache(maxsize=cache_size, ttl=cache_seconds)
+
+    def home(self, user_id: Optional[int]) -> int:
+        return 0 if user_id is None else jump_hash(user_id, len(self.engines))
+
+    def lookup(self, user_id: Optional[int]) -> Tuple[int, Optional[int]]:
+        """The shard holding the user's rows, and the one they're moving to."""
+        if user_id is None:
+            return 0, None
+        entry = self._directory.get(user_id)
+        if entry is None:
+            with self.global_engine.connect() as conn:
+                row = conn.execute(
+                    select(user_shards.c.shard, user_shards.c.moving_to).where(
+                        user_shards.c.user_id == user_id
+                    )
+                ).first()
+            entry = tuple(row) if row else (self.home(user_id), None)
+            self._directory.set(user_id, entry)
+        return entry
+
+    def shard_for_user(self, user_id: Optional[int]) -> int:
+        shard, moving_to = self.lookup(user_id)
+        if moving_to is not None:
+            raise UserMoving(self.cache_seconds)
+        return shard
+
+    def shard_for_order(self, order_id: int) -> int:
+        """The shard that created ``order_id``."""
+        return min(max(order_id // ORDER_ID_SPAN - 1, 0), len(self.engines) - 1)
+
+    def forget(self, user_id: int):
+        self._directory.invalidate(user_id)
+
+
+shard_map: Optional[ShardMap] = None
+
+
+def enable(new_map: ShardMap):
+    global shard_map
+    shard_map = new_map
+    for model in SHARDED_MODELS:
+        model.__sqlmodel__.__table__.info["sharded"] = True
+
+
+def disable():
+    global shard_map
+    shard_map = None
+    for model in SHARDED_MODELS:
+        model.__sqlmodel__.__table__.info.pop("sharded", None)
+
+
+# Routing a session. All of these do nothing while sharding is off.
+def route(db: Session, user_id: Optional[int]) -> Optional[int]:
+    """Send ``db``'s sharded tables to the shard of ``user_id``; returns it."""
+    if shard_map is None:
+        return None
+    shard = shard_map.shard_for_user(user_id)
+    use_shard(db, shard)
+    return shard
+
+
+def use_shard(db: Session, shard: int):
+    db.info["shard_engine"] = shard_map.engines[shard]
+
+
+def _order_owner(condition, first: int) -> Tuple[bool, Optional[int]]:
+    """
+    Whether a shard, trying ``first`` first, has an order matching
+    ``condition``, and the user it belongs to.
+    """
+    OrderQ = Order.__sqlmodel__
+    shards = [first] + [k for k in range(len(shard_map.engines)) if k != first]
+    for shard in shards:
+        with shard_map.engines[shard].connect() as conn:
+            row = conn.execute(select(OrderQ.user_id).where(condition).limit(1)).first()
+        if row is not None:
+            return True, row[0]
+    return False, None
+
+
+def route_to_order(db: Session, order_id: int) -> bool:
+    """Route ``db`` to the shard holding ``order_id``; False if none has it."""
+    if shard_map is None:
+        return True
+    found, user_id = _order_owner(
+        Order.__sqlmodel__.id == order_id, shard_map.shard_for_order(order_id)
+    )
+    if found:
+        route(db, user_id)
+    return found
+
+
+def route_to_intent(
+    db: Session, payment_intent_id: str, user_id: Optional[int] = None
+) -> bool:
+    """
+    Route ``db`` to the shard holding the order paid by ``payment_intent_id``,
+    which is the shard of ``user_id`` when the caller knows the buyer.
+    """
+    if shard_map is None:
+        return True
+    if user_id is None:
+        found, user_id = _order_owner(
+            Order.__sqlmodel__.payment_intent_id == payment_intent_id, 0
+        )
+        if not found:
+            return False
+    route(db, user_id)
+    return True
+
+
+# Queries over every shard
+def _recent_orders(
+    shard_engine: Engine,
+    status: Optional[str],
+    user_id: Optional[int],
+    before: Optional[tuple],
+    limit: int,
+) -> List[OrderOut]:
+    OrderQ = Order.__sqlmodel__
+    with Session(shard_engine) as db:
+        query = db.query(OrderQ).options(selectinload(OrderQ.items))
+        if status is not None:
+            query = query.filter(OrderQ.status == status)
+        if user_id is not None:
+            query = query.filter(OrderQ.user_id == user_id)
+        if before is not None:
+            query = query.filter(tuple_(OrderQ.created_at, OrderQ.id) < tuple_(*before))
+        orders = (
+            query.order_by(OrderQ.created_at.desc(), OrderQ.id.desc())
+            .limit(limit)
+            .all()
+        )
+        return [OrderOut.model_validate(o, from_attributes=True) for o in orders]
+
+
+def list_orders(
+    db: Session,
+    status: Optional[str] = None,
+    user_id: Optional[int] = None,
+    before: Optional[tuple] = None,
+    limit: int = 50,
+) -> List[OrderOut]:
+    """
+    The newest orders, optionally those of one user or in one status, and
+    older than the (created_at, id) ``before``. Queries every shard at once
+    and merges their pages; without shards, queries ``db``'s database.
+    """
+    if shard_map is None:
+        engines = [db.get_bind()]
+    elif user_id is not None:
+        engines = [shard_map.engines[shard_map.shard_for_user(user_id)]]
+    else:
+        engines = shard_map.engines
+    with ThreadPoolExecutor(max_workers=len(engines)) as pool:
+        pages = list(
+            pool.map(
+                lambda e: _recent_orders(e, status, user_id, before, limit), engines
+            )
+        )
+    merged = heapq.merge(*pages, key=lambda o: (o.created_at, o.id), reverse=True)
+    return list(itertools.islice(merged, limit))
+
+
+# Schema
+def shard_metadata() -> MetaData:
+    """
+    The sharded tables and their indexes, without foreign keys: users and
+    products live on the global database.
+    """
+    metadata = MetaData()
+    for model in SHARDED_MODELS:
+        table = model.__sqlmodel__.__table__
+        copy = Table(
+            table.name,
+            metadata,
+            *[
+                Column(c.name, c.type, primary_key=c.primary_key, nullable=c.nullable)
+                for c in table.columns
+            ],
+            # Never reuse the ids below the shard's range, see create_schema()
+            sqlite_autoincrement=table.name == "orders",
+        )
+        for index in table.indexes:
+            Index(
+                index.name,
+                *[copy.c[c.name] for c in index.columns],
+                unique=index.unique,
+            )
+    return metadata
+
+
+def create_schema(shard_engine: Engine, shard: int) -> bool:
+    """
+    Create the sharded tables on shard ``shard`` and start its order ids at
+    (shard + 1) * ORDER_ID_SPAN. Returns False if they already existed.
+    """
+    if inspect(shard_engine).has_table("orders"):
+        return False
+    shard_metadata().create_all(shard_engine)
+    first_id = (shard + 1) * ORDER_ID_SPAN
+    with shard_engine.begin() as conn:
+        if shard_engine.dialect.name == "sqlite":
+            conn.execute(
+                text(
+                    "INSERT INTO sqlite_sequence (name, seq) SELECT 'orders', :seq "
+                    "WHERE NOT EXISTS "
+                    "(SELECT 1 FROM sqlite_sequence WHERE name = 'orders')"
+                ),
+                {"seq": first_id - 1},
+            )
+        else:
+            conn.execute(
+                text(
+                    "SELECT setval(pg_get_serial_sequence('orders', 'id'), :id, false)"
+                ),
+                {"id": first_id},
+            )
+    return True
+
+
+# Moving users between shards
+def _delete_user_rows(conn: Connection, user_id: int):
+    CartQ = Cart.__sqlmodel__
+    CartItemQ = CartItem.__sqlmodel__
+    OrderQ = Order.__sqlmodel__
+    OrderItemQ = OrderItem.__sqlmodel__
+    carts = select(CartQ.id).where(CartQ.user_id == user_id)
+    orders = select(OrderQ.id).where(OrderQ.user_id == user_id)
+    conn.execute(delete(CartItemQ).where(CartItemQ.cart_id.in_(carts)))
+    conn.execute(delete(CartQ).where(CartQ.user_id == user_id))
+    conn.execute(delete(OrderItemQ).where(OrderItemQ.order_id.in_(orders)))
+    conn.execute(delete(OrderQ).where(OrderQ.user_id == user_id))
+
+
+def _rows(conn: Connection, statement) -> List[dict]:
+    return [dict(row._mapping) for row in conn.execute(statement)]
+
+
+def _copy_user_rows(source: Connection, target: Connection, user_id: int):
+    """
+    Copy the user's carts and orders. Carts and all lines get new ids on the
+    target; orders keep theirs, which are unique across shards.
+    """
+    CartQ = Cart.__sqlmodel__.__table__
+    CartItemQ = CartItem.__sqlmodel__.__table__
+    OrderQ = Order.__sqlmodel__.__table__
+    OrderItemQ = OrderItem.__sqlmodel__.__table__
+
+    for cart in _rows(source, select(CartQ).where(CartQ.c.user_id == user_id)):
+        old_id = cart.pop("id")
+        new_id = target.execute(insert(CartQ).values(**cart)).inserted_primary_key[0]
+        items = _rows(source, select(CartItemQ).where(CartItemQ.c.cart_id == old_id))
+        for item in items:
+            del item["id"]
+            item["cart_id"] = new_id
+        if items:
+            target.execute(insert(CartItemQ), items)
+
+    orders = _rows(source, select(OrderQ).where(OrderQ.c.user_id == user_id))
+    if not orders:
+        return
+    # SQLite would continue numbering from the highest id inserted, which
+    # may be in another shard's range
+    sequence = None
+    if target.dialect.name == "sqlite":
+        sequence = target.execute(
+            text("SELECT seq FROM sqlite_sequence WHERE name = 'orders'")
+        ).scalar()
+    target.execute(insert(OrderQ), orders)
+    if sequence is not None:
+        target.execute(
+            text("UPDATE sqlite_sequence SET seq = :seq WHERE name = 'orders'"),
+            {"seq": sequence},
+        )
+    items = _rows(
+        source,
+        select(OrderItemQ).where(
+            OrderItemQ.c.order_id.in_([order["id"] for order in orders])
+        ),
+    )
+    for item in items:
+        del item["id"]
+    if items:
+        target.execute(insert(OrderItemQ), items)
+
+
+def move_users(moves: Dict[int, int], grace: float = 5.0) -> int:
+    """
+    Move each user id in ``moves`` to the shard it maps to; returns the
+    number of users whose rows were copied. Safe to run again after an
+    interruption. A crash after a user's directory update leaves unused
+    rows on the source, which are cleared if the user ever moves back.
+    """
+    directory = user_shards.c
+    sources = {}
+    with shard_map.global_engine.begin() as conn:
+        rows = {
+            row.user_id: row
+            for row in conn.execute(
+                select(user_shards).where(directory.user_id.in_(moves))
+            )
+        }
+        for user_id, target in moves.items():
+            row = rows.get(user_id)
+            sources[user_id] = row.shard if row else shard_map.home(user_id)
+            if row is None:
+                conn.execute(
+                    insert(user_shards).values(
+                        user_id=user_id, shard=sources[user_id], moving_to=target
+                    )
+                )
+            else:
+                conn.execute(
+                    update(user_shards)
+                    .where(directory.user_id == user_id)
+                    .values(moving_to=target)
+                )
+    # Wait for every process's cached directory to see the moves, and for
+    # requests that routed before that to finish
+    time.sleep(shard_map.cache_seconds + grace)
+
+    copied = 0
+    for user_id, target in moves.items():
+        source = sources[user_id]
+        if source != target:
+            with shard_map.engines[source].connect() as source_conn:
+                with shard_map.engines[target].begin() as target_conn:
+                    _delete_user_rows(target_conn, user_id)
+                    _copy_user_rows(source_conn, target_conn, user_id)
+            copied += 1
+        with shard_map.global_engine.begin() as conn:
+            if target == shard_map.home(user_id):
+                conn.execute(delete(user_shards).where(directory.user_id == user_id))
+            else:
+                conn.execute(
+                    update(user_shards)
+                    .where(directory.user_id == user_id)
+                    .values(shard=target, moving_to=None)
+                )
+        shard_map.forget(user_id)
+        if source != target:
+            with shard_map.engines[source].begin() as source_conn:
+                _delete_user_rows(source_conn, user_id)
+    return copied
+
+
+def move_user(user_id: int, target: int, grace: float = 5.0) -> bool:
+    return move_users({user_id: target}, grace) == 1
+
+
+def _batches(items: list, size: int):
+    for start in range(0, len(items), size):
+        end = start + size
+        yield items[start:end]
+
+
+def pin(shards: int, batch: int = 1000) -> int:
+    """
+    Before growing to ``shards`` shards: keep every user whose home changes
+    on the shard they're on now. Returns the number of users pinned.
+    """
+    UserQ = User.__sqlmodel__
+    with shard_map.global_engine.connect() as conn:
+        placed = set(conn.execute(select(user_shards.c.user_id)).scalars())
+        user_ids = conn.execute(select(UserQ.id).order_by(UserQ.id)).scalars().all()
+    rows = [
+        {"user_id": user_id, "shard": shard_map.home(user_id), "moving_to": None}
+        for user_id in user_ids
+        if user_id not in placed
+        and jump_hash(user_id, shards) != shard_map.home(user_id)
+    ]
+    for chunk in _batches(rows, batch):
+        with shard_map.global_engine.begin() as conn:
+            conn.execute(insert(user_shards), chunk)
+    return len(rows)
+
+
+def rebalance(batch: int = 100, grace: float = 5.0) -> int:
+    """
+    Move every user not on their home shard there, resuming interrupted
+    moves first. Returns the number of users moved.
+    """
+    with shard_map.global_engine.connect() as conn:
+        rows = conn.execute(
+            select(user_shards).order_by(user_shards.c.moving_to.is_(None))
+        ).all()
+    moves = {}
+    for row in rows:
+        if row.moving_to is not None:
+            moves[row.user_id] = row.moving_to
+        elif row.shard != shard_map.home(row.user_id):
+            moves[row.user_id] = shard_map.home(row.user_id)
+    return sum(
+        move_users({user_id: moves[user_id] for user_id in chunk}, grace)
+        for chunk in _batches(list(moves), batch)
+    )
+
+
+def status() -> List[str]:
+    CartQ = Cart.__sqlmodel__
+    OrderQ = Order.__sqlmodel__
+    lines = []
+    for shard, shard_engine in enumerate(shard_map.engines):
+        with shard_engine.connect() as conn:
+            carts = conn.execute(select(func.count()).select_from(CartQ)).scalar()
+            orders = conn.execute(select(func.count()).select_from(OrderQ)).scalar()
+        lines.append(f"shard {shard}: {carts} carts, {orders} orders")
+    with shard_map.global_engine.connect() as conn:
+        placed, moving = conn.execute(
+            select(func.count(), func.count(user_shards.c.moving_to))
+        ).one()
+    lines.append(f"directory: {placed} users placed, {moving} of them moving")
+    return lines
+
+
+if app_config.SHARD_URLS:
+    if app_config.DATABASE_ASYNC:
+        raise ValueError("SHARD_URLS requires DATABASE_ASYNC to be off")
+    enable(
+        ShardMap(
+            [create_db_engine(url) for url in app_config.SHARD_URLS],
+            engine,
+            cache_seconds=app_config.SHARD_DIRECTORY_CACHE_SECONDS,
+            cache_size=app_config.SHARD_DIRECTORY_CACHE_SIZE,
+        )
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the cart and order shards")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("status", help="rows per shard and users being moved")
+    pin_parser = commands.add_parser(
+        "pin", help="keep users in place before changing the shard count"
+    )
+    pin_parser.add_argument("--shards", type=int, required=True)
+    move_parser = commands.add_parser("move", help="move one user")
+    move_parser.add_argument("user_id", type=int)
+    move_parser.add_argument("shard", type=int)
+    rebalance_parser = commands.add_parser(
+        "rebalance", help="move every user to their home shard"
+    )
+    rebalance_parser.add_argument("--batch", type=int, default=100)
+    for command_parser in (move_parser, rebalance_parser):
+        command_parser.add_argument(
+            "--grace",
+            type=float,
+            default=5.0,
+            help="seconds allowed for requests in flight (default 5)",
+        )
+    args = parser.parse_args()
+
+    if shard_map is None:
+        sys.exit("SHARD_URLS is not set")
+    if args.command == "status":
+        print("\n".join(status()))
+    elif args.command == "pin":
+        if args.shards < len(shard_map.engines):
+            sys.exit("Shards can only be added")
+        print(f"Pinned {pin(args.shards)} user(s)")
+    elif args.command == "move":
+        if not 0 <= args.shard < len(shard_map.engines):
+            sys.exit(f"No shard {args.shard}")
+        move_user(args.user_id, args.shard, args.grace)
+        print(f"Moved user {args.user_id} to shard {args.shard}")
+    else:
+        print(f"Moved {rebalance(args.batch, args.grace)} user(s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+import datetime
+import hashlib
+import heapq
+import threading
+import time
+import uuid
+from datetime import timedelta
+from typing import Dict, List, Optional, Tuple
+
+import jwt
+from app.config import app_config
+from cache import TTLCache
+
+# Single JWT codec shared by token issuing (routes/user.py) and verification
+# (auth.py) so both sides agree on the wire format.
+InvalidTokenError = jwt.InvalidTokenError
+
+
+class RevocationListFull(RuntimeError):
+    """Raised when a revocation can't be recorded; the token stays valid."""
+
+
+class RevocationList:
+    """
+    Hashes of revoked tokens, each kept until its token expires.
+
+    Unlike a cache, entries are never evicted early: forgetting a revocation
+    would make the token valid again. Once ``maxsize`` unexpired tokens are
+    revoked, further revocations raise RevocationListFull.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._expiry: Dict[str, Optional[float]] = {}
+        # (expires_at, key) of the entries that expire, soonest first
+        self._heap: List[Tuple[float, str]] = []
+        self._lock = threading.Lock()
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            if key not in self._expiry:
+                return False
+            expires_at = self._expiry[key]
+            return expires_at is None or expires_at > time.time()
+
+    def __len__(self) -> int:
+        with self._lock:
+            self._purge()
+            return len(self._expiry)
+
+    def add(self, key: str, expires_at: Optional[float]):
+        with self._lock:
+            self._purge()
+            if key in self._expiry:
+                return
+            if len(self._expiry) >= self.maxsize:
+                raise RevocationListFull(
+                    f"{self.maxsize} unexpired tokens are already revoked"
+                )
+            self._expiry[key] = expires_at
+            if expires_at is not None:
+                heapq.heappush(self._heap, (expires_at, key))
+
+    def _purge(self):
+        now = time.time()
+        while self._heap and self._heap[0][0] <= now:
+            _, key = heapq.heappop(self._heap)
+            del self._expiry[key]
+
+
+# Decoded claims of verified tokens, keyed by the token hash
+token_cache = TTLCache(maxsize=app_config.TOKEN_CACHE_SIZE)
+# Hashes of revoked tokens
+revoked_tokens = RevocationList(maxsize=app_config.TOKEN_REVOCATION_LIST_SIZE)
+
+
+def _token_key(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def create_access_token(data: dict):
+    to_encode = data.copy()
+    expire = datetime.datetime.utcnow() + timedelta(
+        minutes=app_config.ACCESS_TOKEN_EXPIRE_MINUTES
+    )
+    # jti keeps tokens issued in the same second distinct for revocation
+    to_encode.update({"exp": expire, "jti": uuid.uuid4().hex})
+    encoded_jwt = jwt.encode(
+        to_encode, app_config.SECRET_KEY, algorithm=app_config.ALGORITHM
+    )
+    return encoded_jwt
+
+
+def decode_access_token(token: str) -> dict:
+    """
+    Verify a bearer token and return its claims.
+
+    Verified claims are memoized until the token expires, so repeated requests
+    with the same token skip the signature check. Raises InvalidTokenError.
+    """
+    key = _token_key(token)
+    if key in revoked_tokens:
+        raise InvalidTokenError("Token has been revoked")
+
+    payload = token_cache.get(key)
+    if payload is not None:
+        return payload
+
+    payload = jwt.decode(
+        token, app_config.SECRET_KEY, algorithms=[app_config.ALGORITHM]
+    )
+    token_cache.set(key, payload, expires_at=payload.get("exp"))
+    return payload
+
+
+def revoke_token(token: str):
+    """
+    Reject ``token`` from now on, even if its signature is still valid.
+    Raises RevocationListFull when the revocation can't be recorded.
+    """
+    try:
+        payload = jwt.decode(
+            token,
+            app_config.SECRET_KEY,
+            algorithms=[app_config.ALGORITHM],
+            options={"verify_exp": False},
+        )
+    except InvalidTokenError:
+        return
+    key = _token_key(token)
+    revoked_tokens.add(key, payload.get("exp"))
+    token_cache.invalidate(key)
@@ -0,0 +1,289 @@
+"""
+Queue-backed Stripe webhook processing.
+
+The endpoint only verifies the signature and records the event in
+``webhook_events``, keyed by Stripe's event id, so a duplicate delivery is
+rejected by the unique index and Stripe gets its 200 straight away. A pool
+of workers then claims events from the table:
+
+- Events for one payment intent run one at a time, oldest first: an event
+  is only claimable when no older event for its intent is still pending or
+  being processed.
+- A claim is a conditional UPDATE that also sets a lease. If a worker dies
+  mid-event, idle workers make the event pending again once the lease
+  expires.
+- A failing event is retried with exponential backoff and marked failed
+  after STRIPE_WEBHOOK_MAX_ATTEMPTS. That includes a payment whose order
+  can't be found, by intent id or by the order id in its metadata
+  (OrderNotFound).
+
+Handlers must be idempotent, since a lease can expire on a slow handler.
+"""
+
+import asyncio
+import datetime
+import json
+import logging
+import random
+from typing import Callable, Dict, Optional
+
+import inventory
+import sharding
+from app.config import app_config
+from models import Order, WebhookEvent
+from sqlalchemy import and_, exists, insert, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, aliased
+from starlette.concurrency import run_in_threadpool
+
+logger = logging.getLogger(__name__)
+
+PENDING = "pending"
+PROCESSING = "processing"
+DONE = "done"
+FAILED = "failed"
+
+
+class OrderNotFound(Exception):
+    """No order carries the payment intent, or not yet."""
+
+
+def _mark_order_paid(db: Session, event: dict):
+    OrderQ = Order.__sqlmodel__
+    payment_intent = event["data"]["object"]
+    payment_intent_id = payment_intent["id"]
+    # Checkout puts the buyer and the order in the intent's metadata
+    metadata = payment_intent.get("metadata", {})
+    user_id = metadata.get("user_id")
+    metadata_order_id = metadata.get("order_id")
+    routed = sharding.route_to_intent(
+        db, payment_intent_id, int(user_id) if user_id else None
+    )
+    if not routed and metadata_order_id:
+        routed = sharding.route_to_order(db, int(metadata_order_id))
+    # Retry an unknown intent rather than drop the payment
+    if not routed:
+        raise OrderNotFound(payment_intent_id)
+    order_id = (
+        db.query(OrderQ.id)
+        .filter(OrderQ.payment_intent_id == payment_intent_id)
+        .limit(1)
+        .scalar()
+    )
+    if order_id is None and metadata_order_id:
+        # The webhook beat checkout to linking the intent to the order
+        linked = (
+            db.query(OrderQ)
+            .filter(
+                OrderQ.id == int(metadata_order_id),
+                OrderQ.payment_intent_id.is_(None),
+            )
+            .update({"payment_intent_id": payment_intent_id})
+        )
+        if linked:
+            order_id = int(metadata_order_id)
+    if order_id is None:
+        raise OrderNotFound(payment_intent_id)
+
+    # Only the first delivery of this event moves the order to paid, so a
+    # replayed webhook can't commit the stock twice
+    paid = (
+        db.query(OrderQ)
+        .filter(OrderQ.id == order_id, OrderQ.status.in_(("pending", "expired")))
+        .update({"status": "paid", "payment_intent_status": "succeeded"})
+    )
+    if paid and not inventory.commit(db, order_id):
+        db.query(OrderQ).filter(OrderQ.id == order_id).update({"status": "backordered"})
+
+
+# Event type -> handler(db, event). Handlers don't commit; the worker
+# commits their changes together with the event's status.
+HANDLERS: Dict[str, Callable[[Session, dict], None]] = {
+    "payment_intent.succeeded": _mark_order_paid,
+}
+
+
+def payment_intent_of(event: dict) -> Optional[str]:
+    obj = event.get("data", {}).get("object", {})
+    if event.get("type", "").startswith("payment_intent."):
+        return obj.get("id")
+    return obj.get("payment_intent")
+
+
+def record_event(db: Session, event: dict) -> bool:
+    """Store a verified event. Returns False if it was already recorded."""
+    WebhookEventQ = WebhookEvent.__sqlmodel__
+    try:
+        db.execute(
+            insert(WebhookEventQ).values(
+                event_id=event["id"],
+                type=event["type"],
+                payment_intent_id=payment_intent_of(event),
+                payload=json.dumps(event),
+                status=PENDING,
+                attempts=0,
+                next_attempt_at=datetime.datetime.utcnow(),
+                created_at=datetime.datetime.utcnow(),
+            )
+        )
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        return False
+    return True
+
+
+def claim_next(db: Session, lease_seconds: int) -> Optional[int]:
+    """
+    Claim the oldest runnable event, returning its id, or None when there
+    is nothing to do right now.
+    """
+    WebhookEventQ = WebhookEvent.__sqlmodel__
+    older = aliased(WebhookEventQ)
+    now = datetime.datetime.utcnow()
+    runnable = and_(
+        WebhookEventQ.status == PENDING, WebhookEventQ.next_attempt_at <= now
+    )
+    blocked = exists().where(
+        older.payment_intent_id == WebhookEventQ.payment_intent_id,
+        older.id < WebhookEventQ.id,
+        older.status.in_((PENDING, PROCESSING)),
+    )
+    while True:
+        event_id = db.execute(
+            select(WebhookEventQ.id)
+            .where(runnable, ~blocked)
+            .order_by(WebhookEventQ.id)
+            .limit(1)
+        ).scalar()
+        if event_id is None:
+            db.rollback()
+            return None
+        # Another worker may claim the same event first; then look again
+        claimed = db.execute(
+            update(WebhookEventQ)
+            .where(WebhookEventQ.id == event_id, runnable)
+            .values(
+                status=PROCESSING,
+                attempts=WebhookEventQ.attempts + 1,
+                next_attempt_at=now + datetime.timedelta(seconds=lease_seconds),
+            )
+        ).rowcount
+        db.commit()
+        if claimed:
+            return event_id
+
+
+def release_expired_leases(db: Session) -> int:
+    """Make events whose worker died without finishing them runnable again."""
+    WebhookEventQ = WebhookEvent.__sqlmodel__
+    released = db.execute(
+        update(WebhookEventQ)
+        .where(
+            WebhookEventQ.status == PROCESSING,
+            WebhookEventQ.next_attempt_at <= datetime.datetime.utcnow(),
+        )
+        .values(status=PENDING)
+    ).rowcount
+    db.commit()
+    return released
+
+
+def backoff(attempts: int) -> float:
+    """Seconds to wait before retry number ``attempts``, with full jitter."""
+    ceiling = min(
+        app_config.STRIPE_WEBHOOK_BACKOFF_MAX_SECONDS,
+        app_config.STRIPE_WEBHOOK_BACKOFF_SECONDS * 2 ** (attempts - 1),
+    )
+    return random.uniform(ceiling / 2, ceiling)
+
+
+def process(db: Session, event_id: int):
+    """Run the handler for a claimed event and record the outcome."""
+    WebhookEventQ = WebhookEvent.__sqlmodel__
+    event = db.get(WebhookEventQ, event_id)
+    handler = HANDLERS.get(event.type)
+    try:
+        if handler is not None:
+            handler(db, json.loads(event.payload))
+        event.status = DONE
+        event.last_error = None
+        db.commit()
+    except Exception as exc:
+        db.rollback()
+        logger.exception("Processing webhook event %s failed", event.event_id)
+        event = db.get(WebhookEventQ, event_id)
+        event.last_error = repr(exc)
+        if event.attempts >= app_config.STRIPE_WEBHOOK_MAX_ATTEMPTS:
+            event.status = FAILED
+        else:
+            event.status = PENDING
+            event.next_attempt_at = datetime.datetime.utcnow() + datetime.timedelta(
+                seconds=backoff(event.attempts)
+            )
+        db.commit()
+
+
+def drain(session_factory, lease_seconds: Optional[int] = None) -> int:
+    """Process every runnable event in this thread. Returns how many ran."""
+    lease_seconds = lease_seconds or app_config.STRIPE_WEBHOOK_LEASE_SECONDS
+    processed = 0
+    with session_factory() as db:
+        release_expired_leases(db)
+        while (event_id := claim_next(db, lease_seconds)) is not None:
+            process(db, event_id)
+            processed += 1
+    return processed
+
+
+class WebhookProcessor:
+    """A pool of asyncio workers running events in the threadpool."""
+
+    def __init__(self, session_factory, workers: int = None):
+        self.session_factory = session_factory
+        self.workers = workers or app_config.STRIPE_WEBHOOK_WORKERS
+        self._wakeup = None
+        self._tasks = []
+
+    def start(self):
+        # Created here, inside the running loop: on Python 3.9 an Event
+        # binds to the loop current at construction, i.e. at import time.
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._run()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def notify(self):
+        """Wake idle workers, e.g. after an event was recorded."""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _run_one(self) -> bool:
+        with self.session_factory() as db:
+            event_id = claim_next(db, app_config.STRIPE_WEBHOOK_LEASE_SECONDS)
+            if event_id is None:
+                release_expired_leases(db)
+                return False
+            process(db, event_id)
+            return True
+
+    async def _run(self):
+        while True:
+            try:
+                busy = await run_in_threadpool(self._run_one)
+            except Exception:
+                logger.exception("Claiming a webhook event failed")
+                busy = False
+            if busy:
+                continue
+            try:
+                await asyncio.wait_for(
+                    self._wakeup.wait(), app_config.STRIPE_WEBHOOK_POLL_SECONDS
+                )
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
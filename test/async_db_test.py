@@ -0,0 +1,48 @@
+import asyncio
+import json
+
+from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlmodel import Session, SQLModel
+
+from db import run_db
+from models import Category, Product, User
+from pydantic_models import CartItemCreate
+from routes.cart import _add_to_cart, _get_cart
+
+
+def test_cart_queries_on_async_session(tmp_path):
+    path = tmp_path / "async.db"
+    engine = create_engine(f"sqlite:///{path}")
+    SQLModel.metadata.create_all(engine)
+    with Session(engine) as db:
+        category = Category.__sqlmodel__(name="Books", description="Books")
+        db.add(category)
+        db.commit()
+        db.add(
+            Product.__sqlmodel__(
+                name="Novel",
+                description="A novel",
+                price=10.0,
+                stock=5,
+                category_id=category.id,
+            )
+        )
+        user = User.__sqlmodel__(email="async@example.com", hashed_password="!")
+        db.add(user)
+        db.commit()
+        user_id = user.id
+
+    async def scenario():
+        async_engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+        async with AsyncSession(async_engine, expire_on_commit=False) as db:
+            item = CartItemCreate(product_id=1, quantity=2)
+            await run_db(db, _add_to_cart, user_id, item)
+            await run_db(db, _add_to_cart, user_id, item)
+            cart = await run_db(db, _get_cart, user_id)
+        await async_engine.dispose()
+        return cart
+
+    cart = json.loads(asyncio.run(scenario()))
+    assert cart["items"][0]["quantity"] == 4
+    assert cart["total"] == 40.0
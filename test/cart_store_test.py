@@ -0,0 +1,100 @@
+import time
+
+import pytest
+
+from cart_store import (
+    ADD,
+    REMOVE,
+    SET,
+    CartChange,
+    CartStore,
+    MemoryCartStore,
+    RedisCartStore,
+)
+
+PRICES = {10: 2.5, 11: 4.0, 12: 1.0, 13: 10.0}
+
+
+@pytest.fixture(params=["memory", "redis"])
+def store(request):
+    if request.param == "memory":
+        return MemoryCartStore(maxsize=100, ttl=60)
+    fakeredis = pytest.importorskip("fakeredis")
+    return RedisCartStore(client=fakeredis.FakeRedis(), ttl=60)
+
+
+def add(store, user_id, product_id, quantity):
+    store.add_item(None, user_id, product_id, quantity, PRICES[product_id])
+
+
+def test_add_get_clear(store):
+    assert store.get(None, 1) is None
+    add(store, 1, 10, 2)
+    add(store, 1, 11, 1)
+    add(store, 1, 10, 3)
+    add(store, 2, 10, 1)
+
+    cart = store.get(None, 1)
+    assert cart.items == {10: 5, 11: 1}
+    assert (cart.subtotal, cart.item_count) == (16.5, 6)
+    # The cart keeps its id across writes, and carts don't share one
+    assert store.get(None, 1).id == cart.id != store.get(None, 2).id
+
+    store.clear(None, 1)
+    assert store.get(None, 1) is None
+    assert store.get(None, 2).items == {10: 1}
+
+
+def test_changes_apply_in_order(store):
+    add(store, 1, 10, 2)
+    store.apply(
+        None,
+        1,
+        [
+            CartChange(SET, 10, 5),
+            CartChange(ADD, 11, 1),
+            CartChange(ADD, 11, 1),
+            CartChange(REMOVE, 12),
+            CartChange(ADD, 13, 1),
+            CartChange(SET, 13, 0),
+        ],
+        PRICES,
+    )
+    assert store.get(None, 1).items == {10: 5, 11: 2}
+    assert store.get_totals(None, 1)[1:] == (20.5, 7)
+
+
+def test_reprice_moves_subtotals(store):
+    add(store, 1, 10, 2)
+    add(store, 1, 11, 1)
+    add(store, 2, 11, 3)
+    store.reprice(None, 10, 2.5, 3.0)
+    assert store.get_totals(None, 1)[1:] == (10.0, 3)
+    assert store.get_totals(None, 2)[1:] == (12.0, 3)
+
+
+def test_memory_carts_expire():
+    store = MemoryCartStore(maxsize=100, ttl=0.05)
+    add(store, 1, 10, 1)
+    time.sleep(0.1)
+    assert store.get(None, 1) is None
+
+
+def test_redis_writes_reset_the_ttl():
+    fakeredis = pytest.importorskip("fakeredis")
+    client = fakeredis.FakeRedis()
+    store = RedisCartStore(client=client, ttl=60)
+    add(store, 1, 10, 1)
+    client.expire("cart:1", 5)
+    add(store, 1, 10, 1)
+    assert 55 < client.ttl("cart:1") <= 60
+
+
+def test_incomplete_store_fails_at_construction():
+    class NoClear(CartStore):
+        get = MemoryCartStore.get
+        apply = MemoryCartStore.apply
+        reprice = MemoryCartStore.reprice
+
+    with pytest.raises(TypeError, match="clear"):
+        NoClear()
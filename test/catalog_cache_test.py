@@ -0,0 +1,101 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from catalog_cache import CatalogCache, LocalBackend, RedisBackend
+
+
+@pytest.fixture(params=["local", "redis"])
+def cache(request):
+    if request.param == "local":
+        backend = LocalBackend(maxsize=100)
+    else:
+        fakeredis = pytest.importorskip("fakeredis")
+        backend = RedisBackend(client=fakeredis.FakeRedis())
+    return CatalogCache(backend, ttl=60)
+
+
+def test_read_through_and_prefix_invalidation(cache):
+    assert cache.get_or_load("product:4:", lambda: b"4") == b"4"
+    assert cache.get_or_load("product:42:", lambda: b"42") == b"42"
+    assert cache.get_or_load("product:4:", lambda: b"stale") == b"4"
+
+    cache.invalidate("product:4:")
+    assert cache.get_or_load("product:4:", lambda: b"fresh") == b"fresh"
+    assert cache.get_or_load("product:42:", lambda: b"stale") == b"42"
+
+    stats = cache.stats()["product"]
+    assert stats["hits"] == 2
+    assert stats["misses"] == 3
+    assert stats["hit_rate"] == 0.4
+
+
+def test_concurrent_misses_load_once(cache):
+    calls = []
+    started = threading.Event()
+
+    def load():
+        calls.append(1)
+        started.set()
+        time.sleep(0.1)
+        return b"[]"
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        results = list(
+            pool.map(lambda _: cache.get_or_load("products:0:100:", load), range(8))
+        )
+
+    assert results == [b"[]"] * 8
+    assert len(calls) == 1
+
+
+def test_invalidation_waits_for_commit(cache):
+    cache.get_or_load("products:0:100:", lambda: b"old")
+    engine = create_engine("sqlite://")
+
+    with Session(engine) as db:
+        cache.invalidate_on_commit(db, "products:")
+        db.rollback()
+    assert cache.get_or_load("products:0:100:", lambda: b"new") == b"old"
+
+    with Session(engine) as db:
+        cache.invalidate_on_commit(db, "products:")
+        assert cache.get_or_load("products:0:100:", lambda: b"new") == b"old"
+        db.commit()
+    assert cache.get_or_load("products:0:100:", lambda: b"new") == b"new"
+
+
+def test_loads_right_after_an_invalidation_are_not_stored():
+    # A replica may not have the write yet during the settle window
+    cache = CatalogCache(LocalBackend(maxsize=100), ttl=60, settle=0.2)
+    cache.invalidate("product:1:")
+    assert cache.get_or_load("product:1:", lambda: b"maybe stale") == b"maybe stale"
+    assert cache.get_or_load("product:1:", lambda: b"fresh") == b"fresh"
+
+    time.sleep(0.25)
+    assert cache.get_or_load("product:1:", lambda: b"settled") == b"settled"
+    assert cache.get_or_load("product:1:", lambda: b"unused") == b"settled"
+
+
+def test_family_invalidation_moves_to_a_new_version(cache):
+    cache.get_or_load("products:0:100:", lambda: b"old")
+    cache.get_or_load("product:4:", lambda: b"4")
+    cache.invalidate("products:")
+    assert cache.get_or_load("products:0:100:", lambda: b"new") == b"new"
+    assert cache.get_or_load("product:4:", lambda: b"stale") == b"4"
+
+
+@pytest.mark.parametrize(
+    "key,invalidated", [("products:0:100:", "products:"), ("product:4:", "product:4:")]
+)
+def test_loads_racing_an_invalidation_are_not_served(cache, key, invalidated):
+    def load():
+        cache.invalidate(invalidated)
+        return b"stale"
+
+    assert cache.get_or_load(key, load) == b"stale"
+    assert cache.get_or_load(key, lambda: b"fresh") == b"fresh"
@@ -0,0 +1,119 @@
+import time
+
+import pytest
+from fastapi import Depends, FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
+
+import db
+from cache import TTLCache
+from db import (
+    ReplicaRouter,
+    create_db_engine,
+    get_db,
+    get_replica_db,
+    pool_stats,
+    read_session,
+)
+from tokens import create_access_token
+
+
+def test_sqlite_engine_is_tuned_and_instrumented(tmp_path):
+    engine = create_db_engine(f"sqlite:///{tmp_path / 'tuned.db'}")
+
+    with engine.connect() as conn:
+        pragma = lambda name: conn.execute(text(f"PRAGMA {name}")).scalar()
+        assert pragma("journal_mode") == "wal"
+        assert pragma("synchronous") == 1  # NORMAL
+        assert pragma("busy_timeout") == 5000
+        assert pool_stats(engine)["checked_out"] == 1
+
+    stats = pool_stats(engine)
+    assert stats["checked_out"] == 0
+    assert stats["checkouts"] == 1
+    assert stats["checkout_wait_seconds_total"] >= 0
+    engine.dispose()
+
+
+def test_pool_stats_of_a_plain_queue_pool(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'plain.db'}", poolclass=QueuePool)
+    with engine.connect():
+        stats = pool_stats(engine)
+    assert stats["checked_out"] == 1
+    assert stats["size"] == 5
+    assert "checkouts" not in stats
+    engine.dispose()
+
+
+@pytest.fixture
+def nodes(tmp_path, monkeypatch):
+    """A primary and two replicas, SQLite files that each know their name."""
+    engines = {}
+    for name in ("primary", "replica1", "replica2"):
+        engine = create_db_engine(f"sqlite:///{tmp_path / name}.db")
+        with engine.begin() as conn:
+            conn.execute(text("CREATE TABLE node (name TEXT)"))
+            conn.execute(text("INSERT INTO node VALUES (:name)"), {"name": name})
+        engines[name] = engine
+    monkeypatch.setattr(db, "SessionLocal", sessionmaker(bind=engines["primary"]))
+    monkeypatch.setattr(db, "recent_writers", TTLCache(maxsize=100, ttl=0.2))
+    yield engines
+    for engine in engines.values():
+        engine.dispose()
+
+
+def node_of(session) -> str:
+    with session:
+        return session.execute(text("SELECT name FROM node")).scalar()
+
+
+def test_round_robin_and_least_connections(nodes):
+    replicas = [nodes["replica1"], nodes["replica2"]]
+    router = ReplicaRouter(replicas)
+    assert [node_of(read_session(None, router)) for _ in range(4)] == [
+        "replica1",
+        "replica2",
+        "replica1",
+        "replica2",
+    ]
+
+    router = ReplicaRouter(replicas, "least_connections")
+    with nodes["replica1"].connect():
+        assert node_of(read_session(None, router)) == "replica2"
+    with nodes["replica2"].connect():
+        assert node_of(read_session(None, router)) == "replica1"
+
+    assert node_of(read_session(None, None)) == "primary"
+
+
+def test_reads_follow_a_clients_own_writes(nodes, monkeypatch):
+    router = ReplicaRouter([nodes["replica1"], nodes["replica2"]])
+    monkeypatch.setattr(db, "replica_router", router)
+
+    app = FastAPI()
+
+    @app.post("/write")
+    def write(session=Depends(get_db)):
+        session.execute(text("INSERT INTO node VALUES ('written')"))
+        session.commit()
+
+    @app.get("/read")
+    def read(session=Depends(get_replica_db)):
+        return session.execute(text("SELECT name FROM node")).scalar()
+
+    client = TestClient(app)
+    alice = {"Authorization": f"Bearer {create_access_token({'sub': 'alice'})}"}
+    bob = {"Authorization": f"Bearer {create_access_token({'sub': 'bob'})}"}
+
+    assert client.get("/read", headers=alice).json().startswith("replica")
+    client.post("/write", headers=alice)
+    assert client.get("/read", headers=alice).json() == "primary"
+    # Another of alice's tokens is the same client
+    alice_again = {"Authorization": f"Bearer {create_access_token({'sub': 'alice'})}"}
+    assert client.get("/read", headers=alice_again).json() == "primary"
+    assert client.get("/read", headers=bob).json().startswith("replica")
+
+    time.sleep(0.3)
+    assert client.get("/read", headers=alice).json().startswith("replica")
@@ -0,0 +1,161 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+
+from gateway import (
+    CircuitBreaker,
+    FakeGateway,
+    GatewayUnavailable,
+    PaymentError,
+    PaymentGateway,
+    StripeGateway,
+)
+
+
+def stripe_gateway(handler, **kwargs):
+    kwargs.setdefault("breaker", CircuitBreaker(failure_threshold=2, reset_timeout=60))
+    return StripeGateway("sk_test", transport=httpx.MockTransport(handler), **kwargs)
+
+
+def create(gateway, key="key_1"):
+    return asyncio.run(
+        gateway.create_payment_intent(2000, "usd", {"user_id": "1"}, key)
+    )
+
+
+def intent_response(request):
+    return httpx.Response(
+        200,
+        json={
+            "id": "pi_1",
+            "client_secret": "pi_1_secret",
+            "amount": 2000,
+            "currency": "usd",
+            "status": "requires_payment_method",
+        },
+    )
+
+
+def test_stripe_request_is_form_encoded_with_idempotency_key():
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        return intent_response(request)
+
+    intent = create(stripe_gateway(handler))
+    assert intent.id == "pi_1"
+    request = requests[0]
+    assert request.url.path == "/v1/payment_intents"
+    assert request.headers["Idempotency-Key"] == "key_1"
+    assert b"metadata%5Buser_id%5D=1" in request.content
+
+
+def test_declines_raise_without_tripping_the_breaker():
+    def handler(request):
+        return httpx.Response(402, json={"error": {"message": "Card declined"}})
+
+    gateway = stripe_gateway(handler)
+    for _ in range(3):
+        with pytest.raises(PaymentError, match="Card declined") as exc:
+            create(gateway)
+        assert not isinstance(exc.value, GatewayUnavailable)
+    assert gateway.breaker.state == "closed"
+
+
+def test_breaker_opens_after_failures_and_recovers():
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        if len(calls) <= 2:
+            return httpx.Response(500, json={})
+        return intent_response(request)
+
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+    gateway = stripe_gateway(handler, breaker=breaker)
+    for _ in range(2):
+        with pytest.raises(GatewayUnavailable):
+            create(gateway)
+    assert breaker.state == "open"
+
+    # Open: fail fast without calling the provider
+    with pytest.raises(GatewayUnavailable) as exc:
+        create(gateway)
+    assert len(calls) == 2
+    assert exc.value.retry_after > 1
+
+    # After the reset timeout a trial call closes it again
+    breaker.opened_at = time.monotonic() - 61
+    assert breaker.state == "half-open"
+    assert create(gateway).id == "pi_1"
+    assert breaker.state == "closed"
+
+
+def test_cancelled_trial_call_frees_the_breaker():
+    calls = []
+
+    async def handler(request):
+        calls.append(request)
+        if len(calls) == 1:
+            await asyncio.sleep(10)
+        return intent_response(request)
+
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=60)
+    breaker.record_failure()
+    breaker.opened_at = time.monotonic() - 61
+    gateway = stripe_gateway(handler, breaker=breaker)
+
+    async def cancelled_trial():
+        call = asyncio.ensure_future(
+            gateway.create_payment_intent(2000, "usd", {}, "key_1")
+        )
+        await asyncio.sleep(0.05)
+        call.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await call
+
+    asyncio.run(cancelled_trial())
+    assert breaker.state == "half-open"
+    # The next caller gets the trial instead of a 503
+    assert create(gateway).id == "pi_1"
+    assert breaker.state == "closed"
+
+
+def test_timeouts_are_unavailable():
+    def handler(request):
+        raise httpx.ReadTimeout("timed out", request=request)
+
+    gateway = stripe_gateway(handler)
+    with pytest.raises(GatewayUnavailable):
+        create(gateway)
+    assert gateway.breaker.failures == 1
+
+
+def test_fake_gateway_is_idempotent_and_concurrent():
+    gateway = FakeGateway(latency=0.05)
+
+    async def checkouts():
+        return await asyncio.gather(
+            *[
+                gateway.create_payment_intent(100, "usd", {}, f"key_{i % 5}")
+                for i in range(50)
+            ]
+        )
+
+    started = time.perf_counter()
+    intents = asyncio.run(checkouts())
+    # 50 overlapping calls take about one call's latency, not 50
+    assert time.perf_counter() - started < 1
+    assert len({intent.id for intent in intents}) == 5
+    assert gateway.calls == 50
+
+
+def test_gateway_without_create_payment_intent_fails_at_construction():
+    class Incomplete(PaymentGateway):
+        pass
+
+    with pytest.raises(TypeError, match="create_payment_intent"):
+        Incomplete()
@@ -1,14 +1,33 @@
+import csv
+import io
+import json
 import random
+import time
+from contextlib import contextmanager
 from typing import Dict, Generator
+from unittest.mock import patch
 
 import pytest
+import metrics
+import webhooks
+from app.config import app_config
+from auth import user_cache
+from cart_store import MemoryCartStore
+from catalog_cache import catalog_cache
+from db import get_db
+from fastapi import HTTPException
 from fastapi.testclient import TestClient
+from main import app
+from models import Cart, Category, Order, Product, User
+from pagination import encode_cursor
+from profiler import profiler
+from routes.cart import _reserve_cart
+from routes.user import _add_user
+from sqlalchemy import event
+from sqlalchemy.orm import sessionmaker
 from sqlalchemy.pool import StaticPool
 from sqlmodel import Session, SQLModel, create_engine
-
-from db import get_db
-from main import app
-from models import Category, Product
+from tokens import create_access_token, revoke_token
 
 # Test database setup
 SQLALCHEMY_DATABASE_URL = "sqlite:///./test.db"
@@ -19,6 +38,39 @@ engine = create_engine(
 )
 
 
+# Maximum number of SQL statements each endpoint may issue, independent of
+# how many items a cart or order holds
+QUERY_BUDGETS = {
+    "get_cart": 1,
+    "cart_summary": 1,
+    "add_to_cart": 6,
+    "cart_batch": 7,
+    "checkout": 11,
+    "get_order": 2,
+}
+
+
+@contextmanager
+def query_budget(name: str):
+    """Fail if the statements run inside the block exceed QUERY_BUDGETS[name]."""
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+    budget = QUERY_BUDGETS[name]
+    assert (
+        len(statements) <= budget
+    ), f"{name} ran {len(statements)} queries, budget is {budget}:\n" + "\n".join(
+        statements
+    )
+
+
 # Test data generation
 def generate_test_products(db: Session) -> list:
     """Generate 30 dummy products across different categories"""
@@ -127,8 +179,35 @@ def auth_headers(client: TestClient) -> Dict[str, str]:
     return {"Authorization": f"Bearer {token}"}
 
 
+@pytest.fixture(scope="session")
+def admin_headers(db: Session) -> Dict[str, str]:
+    UserQ = User.__sqlmodel__
+    db.add(UserQ(email="admin@example.com", hashed_password="x", is_admin=True))
+    db.commit()
+    token = create_access_token(data={"sub": "admin@example.com"})
+    return {"Authorization": f"Bearer {token}"}
+
+
+@pytest.fixture(scope="session")
+def stocked_product(db: Session):
+    """A product the cart and checkout tests can keep reserving stock of."""
+    category = Category.__sqlmodel__(name="Stocked", description="Stocked")
+    db.add(category)
+    db.flush()
+    product = Product.__sqlmodel__(
+        name="Stocked",
+        description="Stocked",
+        price=5.0,
+        stock=10_000,
+        category_id=category.id,
+    )
+    db.add(product)
+    db.commit()
+    return product
+
+
 # Tests
-def test_create_user(client: TestClient):
+def test_create_user(client: TestClient, db: Session):
     response = client.post(
         "/user/users/", json={"email": "newuser@example.com", "password": "password123"}
     )
@@ -136,6 +215,11 @@ def test_create_user(client: TestClient):
     assert "email" in response.json()
     assert response.json()["email"] == "newuser@example.com"
 
+    # A sign-up racing this one past the email check hits the unique index
+    with pytest.raises(HTTPException) as exc:
+        _add_user(db, "newuser@example.com", "x")
+    assert exc.value.status_code == 400
+
 
 def test_create_categories(client: TestClient, auth_headers: Dict[str, str]):
     response = client.post(
@@ -171,10 +255,215 @@ def test_create_and_get_products(
     assert "name" in response.json()
 
 
-def test_cart_operations(client: TestClient, auth_headers: Dict[str, str]):
+def test_cursor_pagination(client: TestClient, auth_headers: Dict[str, str]):
+    everything = client.get("/catalog/products/?limit=1000", headers=auth_headers)
+    expected = sorted(everything.json(), key=lambda p: (p["price"], p["id"]))
+
+    seen, cursor = [], None
+    while True:
+        params = {"sort": "price", "limit": 7}
+        if cursor:
+            params["cursor"] = cursor
+        response = client.get("/catalog/products/", params=params, headers=auth_headers)
+        assert response.status_code == 200
+        seen.extend(response.json())
+        cursor = response.headers.get("X-Next-Cursor")
+        if cursor is None:
+            break
+    assert seen == expected
+
+    for bad in ("not-a-cursor", encode_cursor("name", ["Laptop"])):
+        response = client.get(
+            "/catalog/products/",
+            params={"sort": "name", "cursor": bad},
+            headers=auth_headers,
+        )
+        assert response.status_code == 400
+    for key in ([1.0], [[1.0], 2], [1.0, 2, 3], [None, 2]):
+        response = client.get(
+            "/catalog/products/",
+            params={"sort": "price", "cursor": encode_cursor("price", key)},
+            headers=auth_headers,
+        )
+        assert response.status_code == 400
+
+
+def test_search_products(client: TestClient, auth_headers: Dict[str, str], monkeypatch):
+    category = client.post(
+        "/catalog/categories/", json={"name": "Audio", "description": "Sound"}
+    ).json()
+    product = {"description": "Noise cancelling", "stock": 5}
+    for name, price in [("Studio Headset", 80.0), ("Budget Headset", 20.0)]:
+        client.post(
+            "/catalog/products/",
+            json={
+                **product,
+                "name": name,
+                "price": price,
+                "category_id": category["id"],
+            },
+        )
+
+    def search(**params):
+        response = client.get("/catalog/search", params=params, headers=auth_headers)
+        assert response.status_code == 200
+        return [p["name"] for p in response.json()]
+
+    assert set(search(q="headset", category_id=category["id"])) == {
+        "Studio Headset",
+        "Budget Headset",
+    }
+    assert search(q="stud") == ["Studio Headset"]
+    assert search(q="noise headset", max_price=50) == ["Budget Headset"]
+    assert search(q="headset", min_price=50, max_price=100) == ["Studio Headset"]
+    assert search(q="headset", category_id=category["id"] + 1) == []
+    assert search(q="?!") == []
+
+    for params in ({"limit": 0}, {"limit": -1}, {"offset": -1}):
+        response = client.get("/catalog/search", params={"q": "headset", **params})
+        assert response.status_code == 422
+
+    # Every match is ranked: the newest product only matches the description,
+    # so it comes after the older, better matches
+    client.post(
+        "/catalog/products/",
+        json={
+            "name": "Gaming Chair",
+            "description": "Pairs with any headset",
+            "price": 120.0,
+            "stock": 5,
+            "category_id": category["id"],
+        },
+    )
+    assert search(q="headset")[-1] == "Gaming Chair"
+    assert search(q="headset", offset=2) == ["Gaming Chair"]
+
+    # With a cap, only the newest matches are ranked and paging past it fails
+    monkeypatch.setattr(app_config, "SEARCH_MAX_CANDIDATES", 1)
+    assert search(q="headset") == ["Gaming Chair"]
+    response = client.get("/catalog/search", params={"q": "headset", "offset": 1})
+    assert response.status_code == 400
+
+
+def test_bulk_import_and_export(
+    client: TestClient,
+    auth_headers: Dict[str, str],
+    admin_headers: Dict[str, str],
+    monkeypatch,
+):
+    monkeypatch.setattr(app_config, "CATALOG_IMPORT_BATCH_SIZE", 2)
+    category = client.post(
+        "/catalog/categories/", json={"name": "Bulk", "description": "Imported"}
+    ).json()
+    good = {"description": "Fed in bulk", "price": 3.5, "stock": 4}
+    lines = [
+        json.dumps({**good, "name": "Bulk A", "category_id": category["id"]}),
+        json.dumps({**good, "name": "Bulk B", "price": "free"}),
+        "{not json",
+        "",
+        json.dumps({**good, "name": "Bulk C", "category_id": 10_000}),
+        json.dumps({**good, "name": "Bulk D", "category_id": category["id"]}),
+    ]
+    # Rows that aren't UTF-8 fail on their own, after earlier batches
+    latin1 = {**good, "name": "Bulk Caf\xe9", "category_id": category["id"]}
+    content = "\n".join(lines).encode() + b"\n"
+    content += json.dumps(latin1, ensure_ascii=False).encode("latin-1")
+
+    # Only admins can import
+    ndjson = {"Content-Type": "application/x-ndjson"}
+    response = client.post("/catalog/products/import", content=content, headers=ndjson)
+    assert response.status_code == 401
+    response = client.post(
+        "/catalog/products/import", content=content, headers={**ndjson, **auth_headers}
+    )
+    assert response.status_code == 403
+
+    response = client.post(
+        "/catalog/products/import",
+        content=content,
+        headers={**ndjson, **admin_headers},
+    )
+    assert response.status_code == 200
+    result = response.json()
+    assert (result["inserted"], result["failed"]) == (2, 4)
+    assert [e["row"] for e in result["errors"]] == [2, 3, 4, 6]
+
+    body = (
+        "name,description,price,stock,category_id\n"
+        f'Bulk E,"Two lines,\nand a comma",1.25,2,{category["id"]}\n'
+        f"Bulk Caf\xe9,Latin-1,2,2,{category['id']}\n"
+        f"Bulk F,Plain,2,2,{category['id']}\n"
+    )
+    response = client.post(
+        "/catalog/products/import",
+        content=body.encode("latin-1"),
+        headers={"Content-Type": "text/csv", **admin_headers},
+    )
+    assert response.json() == {
+        "inserted": 2,
+        "failed": 1,
+        "errors": [{"row": 2, "error": "Unparseable row: not valid UTF-8"}],
+    }
+
+    response = client.get("/catalog/products/export")
+    exported = [json.loads(line) for line in response.text.splitlines()]
+    assert [p["id"] for p in exported] == sorted(p["id"] for p in exported)
+    bulk = {p["name"]: p for p in exported if p["name"].startswith("Bulk")}
+    assert sorted(bulk) == ["Bulk A", "Bulk D", "Bulk E", "Bulk F"]
+    assert bulk["Bulk E"]["description"] == "Two lines,\nand a comma"
+
+    response = client.get("/catalog/products/export", params={"format": "csv"})
+    assert response.headers["content-type"].startswith("text/csv")
+    rows = list(csv.DictReader(io.StringIO(response.text)))
+    assert len(rows) == len(exported)
+
+
+def test_create_order_merges_duplicate_lines(client: TestClient, db: Session):
+    ProductQ = Product.__sqlmodel__
+    product = db.query(ProductQ).filter(ProductQ.stock >= 3).first()
+    stock = product.stock
+    response = client.get(f"/catalog/products/{product.id}")
+    assert response.json()["stock"] == stock
+
+    def listed_stock():
+        listing = client.get("/catalog/products/", params={"limit": 1000}).json()
+        return next(p["stock"] for p in listing if p["id"] == product.id)
+
+    assert listed_stock() == stock
+
+    response = client.post(
+        "/catalog/orders/",
+        json={
+            "items": [
+                {"product_id": product.id, "quantity": 1},
+                {"product_id": product.id, "quantity": 2},
+            ]
+        },
+    )
+    assert response.status_code == 200
+    assert response.json()["items"] == [{"product_id": product.id, "quantity": 3}]
+    db.refresh(product)
+    assert product.stock == stock - 3
+    response = client.get(f"/catalog/products/{product.id}")
+    assert response.json()["stock"] == stock - 3
+    # Cached listings are dropped too
+    assert listed_stock() == stock - 3
+
+    response = client.post(
+        "/catalog/orders/",
+        json={"items": [{"product_id": product.id, "quantity": stock}]},
+    )
+    assert response.status_code == 400
+
+
+def test_cart_operations(
+    client: TestClient, auth_headers: Dict[str, str], stocked_product
+):
     # Add item to cart
     response = client.post(
-        "/cart/cart/items/", json={"product_id": 1, "quantity": 2}, headers=auth_headers
+        "/cart/cart/items/",
+        json={"product_id": stocked_product.id, "quantity": 2},
+        headers=auth_headers,
     )
     assert response.status_code == 200
     assert "items" in response.json()
@@ -186,12 +475,235 @@ def test_cart_operations(client: TestClient, auth_headers: Dict[str, str]):
     assert len(response.json()["items"]) > 0
 
 
+def test_authenticated_user_is_cached(client: TestClient, auth_headers: Dict[str, str]):
+    client.get("/cart/cart/", headers=auth_headers)
+    hits = user_cache.hits
+    misses = user_cache.misses
+
+    response = client.get("/cart/cart/", headers=auth_headers)
+    assert response.status_code == 200
+    assert user_cache.hits == hits + 1
+    assert user_cache.misses == misses
+
+
+def test_batch_cart_changes(
+    client: TestClient, db: Session, auth_headers: Dict[str, str]
+):
+    ProductQ = Product.__sqlmodel__
+    products = db.query(ProductQ).filter(ProductQ.stock >= 5).limit(10).all()
+    ids = [product.id for product in products]
+
+    def quantities(response):
+        assert response.status_code == 200, response.text
+        items = response.json()["items"]
+        return {i["product_id"]: i["quantity"] for i in items if i["product_id"] in ids}
+
+    with query_budget("cart_batch"):
+        response = client.post(
+            "/cart/cart/items/batch",
+            json=[{"product_id": pid, "quantity": 2} for pid in ids],
+            headers=auth_headers,
+        )
+    assert quantities(response) == {pid: 2 for pid in ids}
+
+    changes = [
+        {"op": "set", "product_id": ids[0], "quantity": 1},
+        {"op": "remove", "product_id": ids[1]},
+        {"op": "add", "product_id": ids[2], "quantity": 1},
+        {"op": "set", "product_id": ids[3], "quantity": 0},
+    ]
+    with query_budget("cart_batch"):
+        response = client.post(
+            "/cart/cart/items/batch", json=changes, headers=auth_headers
+        )
+    expected = {pid: 2 for pid in ids[4:]}
+    expected.update({ids[0]: 1, ids[2]: 3})
+    assert quantities(response) == expected
+
+    # All or nothing: a missing product rejects the whole batch
+    response = client.post(
+        "/cart/cart/items/batch",
+        json=[{"product_id": ids[0], "quantity": 1}, {"product_id": 999999}],
+        headers=auth_headers,
+    )
+    assert response.status_code == 422  # add needs a quantity
+    response = client.post(
+        "/cart/cart/items/batch",
+        json=[
+            {"product_id": ids[0], "quantity": 1},
+            {"product_id": 999999, "quantity": 1},
+        ],
+        headers=auth_headers,
+    )
+    assert response.status_code == 404
+    response = client.get("/cart/cart/", headers=auth_headers)
+    assert quantities(response) == expected
+
+    response = client.post(
+        "/cart/cart/items/batch",
+        json=[{"op": "remove", "product_id": pid} for pid in ids],
+        headers=auth_headers,
+    )
+    assert quantities(response) == {}
+
+
+def test_cart_totals_follow_changes_and_prices(
+    client: TestClient,
+    db: Session,
+    auth_headers: Dict[str, str],
+    admin_headers: Dict[str, str],
+):
+    ProductQ = Product.__sqlmodel__
+    products = db.query(ProductQ).filter(ProductQ.stock >= 5).limit(2).all()
+    client.post(
+        "/cart/cart/items/batch",
+        json=[{"op": "set", "product_id": p.id, "quantity": 2} for p in products],
+        headers=auth_headers,
+    )
+    with query_budget("cart_summary"):
+        summary = client.get("/cart/cart/summary", headers=auth_headers).json()
+    cart = client.get("/cart/cart/", headers=auth_headers).json()
+    assert summary["total"] == pytest.approx(cart["total"])
+    assert summary["item_count"] == cart["item_count"]
+    assert cart["total"] == pytest.approx(
+        sum(i["product"]["price"] * i["quantity"] for i in cart["items"])
+    )
+
+    # A price change moves the carts holding the product
+    product = products[0]
+    old_price = product.price
+    url = f"/catalog/products/{product.id}"
+    assert client.patch(url, json={"price": 0}).status_code == 401
+    assert client.patch(url, json={"price": 0}, headers=auth_headers).status_code == 403
+    response = client.patch(url, json={"price": old_price + 1}, headers=admin_headers)
+    assert response.status_code == 200
+    repriced = client.get("/cart/cart/summary", headers=auth_headers).json()
+    assert repriced["total"] == pytest.approx(summary["total"] + 2)
+
+    client.patch(url, json={"price": old_price}, headers=admin_headers)
+    response = client.post(
+        "/cart/cart/items/batch",
+        json=[{"op": "remove", "product_id": p.id} for p in products],
+        headers=auth_headers,
+    )
+    assert response.json()["item_count"] == summary["item_count"] - 4
+
+
+def test_query_budgets(
+    client: TestClient,
+    db: Session,
+    auth_headers: Dict[str, str],
+    mock_payment_intent,
+):
+    ProductQ = Product.__sqlmodel__
+    products = db.query(ProductQ).filter(ProductQ.stock >= 5).limit(10).all()
+    for product in products:
+        with query_budget("add_to_cart"):
+            response = client.post(
+                "/cart/cart/items/",
+                json={"product_id": product.id, "quantity": 1},
+                headers=auth_headers,
+            )
+        assert response.status_code == 200
+
+    with query_budget("get_cart"):
+        response = client.get("/cart/cart/", headers=auth_headers)
+    assert len(response.json()["items"]) >= len(products)
+
+    with query_budget("checkout"):
+        response = client.post("/cart/cart/checkout/", headers=auth_headers)
+    assert response.status_code == 200
+
+    with query_budget("get_order"):
+        response = client.get(
+            f"/catalog/orders/{response.json()['order_id']}", headers=auth_headers
+        )
+    assert len(response.json()["items"]) >= len(products)
+
+
+def test_webhook_replay_commits_stock_once(
+    client: TestClient,
+    db: Session,
+    auth_headers: Dict[str, str],
+    mock_payment_intent,
+):
+    ProductQ = Product.__sqlmodel__
+    product = db.query(ProductQ).filter(ProductQ.stock >= 2).first()
+    client.post(
+        "/cart/cart/items/",
+        json={"product_id": product.id, "quantity": 2},
+        headers=auth_headers,
+    )
+    response = client.post("/cart/cart/checkout/", headers=auth_headers)
+    order_id = response.json()["order_id"]
+    intent_id = db.get(Order.__sqlmodel__, order_id).payment_intent_id
+    db.refresh(product)
+    stock = product.stock
+
+    event = {
+        "id": "evt_webhook",
+        "type": "payment_intent.succeeded",
+        "data": {"object": {"id": intent_id}},
+    }
+    with patch("stripe.Webhook.construct_event", return_value=event):
+        for _ in range(3):
+            response = client.post("/payments/webhook/stripe", content=b"{}")
+            assert response.status_code == 200
+
+    # Acknowledged, but not processed until a webhook worker runs
+    db.expire_all()
+    assert db.get(Order.__sqlmodel__, order_id).status == "pending"
+    assert webhooks.drain(sessionmaker(bind=engine)) == 1
+
+    db.expire_all()
+    assert db.get(Order.__sqlmodel__, order_id).status == "paid"
+    assert db.get(ProductQ, product.id).stock == stock
+
+
+def test_revoked_token_is_rejected(
+    client: TestClient, db: Session, auth_headers: Dict[str, str]
+):
+    # Put something in the cart, whatever earlier tests left there, so the
+    # request succeeds before the token is revoked
+    category = Category.__sqlmodel__(name="Revocation", description="Revocation")
+    db.add(category)
+    db.commit()
+    product = Product.__sqlmodel__(
+        name="Token", description="Token", price=1.0, stock=1, category_id=category.id
+    )
+    db.add(product)
+    db.commit()
+    token = create_access_token(data={"sub": "test@example.com"})
+    headers = {"Authorization": f"Bearer {token}"}
+    client.post(
+        "/cart/cart/items/",
+        json={"product_id": product.id, "quantity": 1},
+        headers=headers,
+    )
+    assert client.get("/cart/cart/", headers=headers).status_code == 200
+
+    revoke_token(token)
+    assert client.get("/cart/cart/", headers=headers).status_code == 401
+    # Other tokens of the same user still work
+    response = client.post(
+        "/cart/cart/items/batch",
+        json=[{"op": "remove", "product_id": product.id}],
+        headers=auth_headers,
+    )
+    assert response.status_code == 200
+
+
 def test_checkout_process(
-    client: TestClient, auth_headers: Dict[str, str], mock_payment_intent
+    client: TestClient,
+    auth_headers: Dict[str, str],
+    mock_payment_intent,
+    stocked_product,
 ):
     # First add item to cart
     client.post(
-        "/cart/cart/items/", json={"product_id": 1, "quantity": 1}, headers=auth_headers
+        "/cart/cart/items/",
+        json={"product_id": stocked_product.id, "quantity": 1},
+        headers=auth_headers,
     )
 
     # Attempt checkout
@@ -201,12 +713,52 @@ def test_checkout_process(
     assert "order_id" in response.json()
 
 
+def test_checkout_retry_pays_for_the_same_order(
+    client: TestClient,
+    db: Session,
+    auth_headers: Dict[str, str],
+    mock_payment_intent,
+    stocked_product,
+):
+    client.post(
+        "/cart/cart/items/",
+        json={"product_id": stocked_product.id, "quantity": 1},
+        headers=auth_headers,
+    )
+    UserQ = User.__sqlmodel__
+    user_id = db.query(UserQ.id).filter(UserQ.email == "test@example.com").scalar()
+    # A first submit that created its order but hasn't reached the gateway
+    order_id, _, idempotency_key = _reserve_cart(db, user_id)
+
+    response = client.post("/cart/cart/checkout/", headers=auth_headers)
+    assert response.json()["order_id"] == order_id
+    assert list(mock_payment_intent.intents) == [idempotency_key]
+    db.expire_all()
+    intent = mock_payment_intent.intents[idempotency_key]
+    assert db.get(Order.__sqlmodel__, order_id).payment_intent_id == intent.id
+
+    # Buying the same again later is a new order with its own intent
+    client.post(
+        "/cart/cart/items/",
+        json={"product_id": stocked_product.id, "quantity": 1},
+        headers=auth_headers,
+    )
+    response = client.post("/cart/cart/checkout/", headers=auth_headers)
+    assert response.json()["order_id"] != order_id
+    assert len(mock_payment_intent.intents) == 2
+
+
 def test_get_order(
-    client: TestClient, auth_headers: Dict[str, str], mock_payment_intent
+    client: TestClient,
+    auth_headers: Dict[str, str],
+    mock_payment_intent,
+    stocked_product,
 ):
     # First add item to cart
     client.post(
-        "/cart/cart/items/", json={"product_id": 1, "quantity": 1}, headers=auth_headers
+        "/cart/cart/items/",
+        json={"product_id": stocked_product.id, "quantity": 1},
+        headers=auth_headers,
     )
 
     # Create an order first through checkout
@@ -220,5 +772,144 @@ def test_get_order(
     assert "total_amount" in response.json()
 
 
+def test_checkout_from_memory_cart_store(
+    client: TestClient, db: Session, auth_headers: Dict[str, str], mock_payment_intent
+):
+    ProductQ = Product.__sqlmodel__
+    CartQ = Cart.__sqlmodel__
+    product = db.query(ProductQ).filter(ProductQ.stock >= 2).first()
+    carts = db.query(CartQ).count()
+
+    with patch("cart_store.cart_store", MemoryCartStore(maxsize=10, ttl=60)):
+        for _ in range(2):
+            response = client.post(
+                "/cart/cart/items/",
+                json={"product_id": product.id, "quantity": 1},
+                headers=auth_headers,
+            )
+            assert response.status_code == 200
+        assert response.json()["items"][0]["quantity"] == 2
+        assert response.json()["total"] == product.price * 2
+        # The cart never touched SQL
+        assert db.query(CartQ).count() == carts
+
+        response = client.post("/cart/cart/checkout/", headers=auth_headers)
+        assert response.status_code == 200
+        assert client.get("/cart/cart/", headers=auth_headers).status_code == 404
+
+    order = db.get(Order.__sqlmodel__, response.json()["order_id"])
+    assert [(i.product_id, i.quantity) for i in order.items] == [(product.id, 2)]
+
+
+def test_metrics_record_latency_and_sql_per_route(
+    client: TestClient, auth_headers: Dict[str, str], monkeypatch, caplog
+):
+    monkeypatch.setattr(app_config, "SLOW_REQUEST_SECONDS", 1e-9)
+    monkeypatch.setattr(app_config, "SLOW_REQUEST_PLAN_SAMPLE_RATE", 1.0)
+    metrics.registry.clear()
+    for _ in range(2):
+        client.get("/catalog/categories/")
+    with caplog.at_level("WARNING", logger="metrics"):
+        response = client.get("/cart/cart/", headers=auth_headers)
+    assert "Slow request GET /cart/cart/" in caplog.text
+    assert "SEARCH carts USING INDEX" in caplog.text
+
+    samples = dict(
+        line.rsplit(" ", 1)
+        for line in client.get("/metrics").text.splitlines()
+        if not line.startswith("#")
+    )
+    labels = f'method="GET",route="/cart/cart/",status="{response.status_code}"'
+    assert samples[f'http_request_duration_seconds_bucket{{{labels},le="+Inf"}}'] == "1"
+    assert samples[f"http_request_duration_seconds_count{{{labels}}}"] == "1"
+    assert int(samples[f"http_request_sql_queries_total{{{labels}}}"]) >= 1
+    assert float(samples[f"http_request_sql_seconds_total{{{labels}}}"]) > 0
+    assert any(
+        name.startswith(
+            'http_request_sql_slowest_seconds{method="GET",route="/cart/cart/"'
+        )
+        for name in samples
+    )
+    assert "db_pool_checked_out" in samples
+    # The request above authenticated, so the user cache was consulted
+    assert int(samples["user_cache_hits"]) + int(samples["user_cache_misses"]) >= 1
+    assert int(samples['catalog_cache_hits{family="categories"}']) >= 1
+    assert 0 < float(samples['catalog_cache_hit_rate{family="categories"}']) <= 1
+
+    client.get("/no/such/route")
+    assert 'route="unmatched",status="404"' in client.get("/metrics").text
+
+
+def test_profiler_is_admin_only(
+    client: TestClient, auth_headers: Dict[str, str], admin_headers: Dict[str, str]
+):
+    assert client.get("/admin/profile", headers=auth_headers).status_code == 403
+
+    response = client.put(
+        "/admin/profile",
+        json={"enabled": True, "sample_rate": 1.0},
+        headers=admin_headers,
+    )
+    assert response.json()["enabled"] is True
+
+    # Slow every statement down so each request spans several sampling
+    # intervals, and drop cached listings so the requests reach the database
+    def slow_statement(*args):
+        time.sleep(0.02)
+
+    catalog_cache.clear()
+    event.listen(engine, "before_cursor_execute", slow_statement)
+    try:
+        for skip in range(3):
+            client.get(
+                "/catalog/products/", params={"skip": skip}, headers=auth_headers
+            )
+    finally:
+        event.remove(engine, "before_cursor_execute", slow_statement)
+        client.put("/admin/profile", json={"enabled": False}, headers=admin_headers)
+    assert profiler.samples > 0
+
+    response = client.get("/admin/profile", headers=admin_headers)
+    assert response.status_code == 200
+    assert "profile.folded" in response.headers["content-disposition"]
+    routes = {
+        line.rsplit(" ", 1)[0].split(";", 1)[0] for line in response.text.splitlines()
+    }
+    # The request turning profiling off may have been sampled too
+    assert "GET /catalog/products/" in routes
+    assert routes <= {"GET /catalog/products/", "PUT /admin/profile"}
+    stats = client.delete("/admin/profile", headers=admin_headers).json()
+    assert stats["enabled"] is False
+    assert stats["samples"] == 0
+
+
+def test_admin_lists_orders_newest_first(
+    client: TestClient,
+    auth_headers: Dict[str, str],
+    admin_headers: Dict[str, str],
+    mock_payment_intent,
+    stocked_product,
+):
+    order_ids = []
+    for _ in range(3):
+        client.post(
+            "/cart/cart/items/",
+            json={"product_id": stocked_product.id, "quantity": 1},
+            headers=auth_headers,
+        )
+        response = client.post("/cart/cart/checkout/", headers=auth_headers)
+        order_ids.append(response.json()["order_id"])
+
+    assert client.get("/admin/orders", headers=auth_headers).status_code == 403
+    response = client.get("/admin/orders", params={"limit": 2}, headers=admin_headers)
+    assert [order["id"] for order in response.json()] == order_ids[:0:-1]
+    response = client.get(
+        "/admin/orders",
+        params={"limit": 1, "cursor": response.headers["x-next-cursor"]},
+        headers=admin_headers,
+    )
+    assert [order["id"] for order in response.json()] == order_ids[:1]
+
+
 if __name__ == "__main__":
     pytest.main(["-v"])
@@ -0,0 +1,143 @@
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from sqlalchemy.orm import sessionmaker
+from sqlmodel import SQLModel
+
+import inventory
+from db import create_db_engine
+from models import Category, Order, Product, StockReservation
+
+STOCK = 25
+BUYERS = 60
+
+
+@pytest.fixture
+def session_factory(tmp_path):
+    engine = create_db_engine(f"sqlite:///{tmp_path / 'inventory.db'}")
+    SQLModel.metadata.create_all(engine)
+    SessionLocal = sessionmaker(bind=engine, autoflush=False)
+    with SessionLocal() as db:
+        category = Category.__sqlmodel__(name="Flash", description="Flash sale")
+        db.add(category)
+        db.commit()
+        db.add(
+            Product.__sqlmodel__(
+                name="Limited",
+                description="Limited edition",
+                price=99.0,
+                stock=STOCK,
+                category_id=category.id,
+            )
+        )
+        db.commit()
+    yield SessionLocal
+    engine.dispose()
+
+
+def place_order(SessionLocal, quantity=1):
+    with SessionLocal() as db:
+        order = Order.__sqlmodel__(status="pending", total_amount=99.0)
+        db.add(order)
+        db.flush()
+        order_id = order.id
+        try:
+            inventory.reserve(db, order_id, {1: quantity})
+        except inventory.InsufficientStock:
+            db.rollback()
+            return None
+        db.commit()
+        return order_id
+
+
+def stock(SessionLocal):
+    with SessionLocal() as db:
+        return db.get(Product.__sqlmodel__, 1).stock
+
+
+def test_parallel_buyers_never_oversell(session_factory):
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        orders = list(pool.map(lambda _: place_order(session_factory), range(BUYERS)))
+
+    assert len([o for o in orders if o is not None]) == STOCK
+    assert stock(session_factory) == 0
+
+
+@pytest.mark.parametrize("sane_multi_rowcount", [True, False])
+def test_a_short_line_fails_the_whole_reservation(
+    session_factory, monkeypatch, sane_multi_rowcount
+):
+    with session_factory() as db:
+        dialect = db.connection().dialect
+    monkeypatch.setattr(dialect, "supports_sane_multi_rowcount", sane_multi_rowcount)
+    with session_factory() as db:
+        category_id = db.get(Product.__sqlmodel__, 1).category_id
+        db.add(
+            Product.__sqlmodel__(
+                name="Plenty",
+                description="Plenty",
+                price=1.0,
+                stock=100,
+                category_id=category_id,
+            )
+        )
+        db.commit()
+
+    def reserve(quantities):
+        with session_factory() as db:
+            order = Order.__sqlmodel__(status="pending", total_amount=100.0)
+            db.add(order)
+            db.flush()
+            inventory.reserve(db, order.id, quantities)
+            db.commit()
+
+    # Product 1 can't cover its line, so product 2 isn't taken either
+    with pytest.raises(inventory.InsufficientStock):
+        reserve({1: STOCK + 1, 2: 1})
+    reserve({1: 1, 2: 1})
+    with session_factory() as db:
+        assert db.get(Product.__sqlmodel__, 1).stock == STOCK - 1
+        assert db.get(Product.__sqlmodel__, 2).stock == 99
+
+
+def test_commit_and_release_are_idempotent(session_factory):
+    order_id = place_order(session_factory, quantity=5)
+    with session_factory() as db:
+        assert inventory.commit(db, order_id)
+        assert inventory.commit(db, order_id)
+        assert inventory.release(db, order_id) == {}
+        db.commit()
+    assert stock(session_factory) == STOCK - 5
+
+    order_id = place_order(session_factory, quantity=5)
+    with session_factory() as db:
+        assert inventory.release(db, order_id) == {1: 5}
+        assert inventory.release(db, order_id) == {}
+        db.commit()
+    assert stock(session_factory) == STOCK - 5
+
+
+def test_expired_reservations_are_released(session_factory):
+    order_id = place_order(session_factory, quantity=10)
+    assert stock(session_factory) == STOCK - 10
+
+    later = datetime.datetime.utcnow() + datetime.timedelta(days=1)
+    with session_factory() as db:
+        assert inventory.release_expired(db, now=later) == 1
+        assert inventory.release_expired(db, now=later) == 0
+        assert db.get(Order.__sqlmodel__, order_id).status == "expired"
+    assert stock(session_factory) == STOCK
+
+    # A payment that lands after expiry takes the stock again
+    with session_factory() as db:
+        assert inventory.commit(db, order_id)
+        db.commit()
+        statuses = {
+            r.status
+            for r in db.query(StockReservation.__sqlmodel__).filter_by(
+                order_id=order_id
+            )
+        }
+    assert statuses == {inventory.COMMITTED}
+    assert stock(session_factory) == STOCK - 10
@@ -0,0 +1,177 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from sqlalchemy import inspect, select, text
+from sqlalchemy.orm import Session
+from sqlmodel import SQLModel
+
+from db import create_db_engine
+from migrations import (
+    MIGRATIONS,
+    MigrationError,
+    applied_versions,
+    is_current,
+    upgrade,
+    upgrade_once,
+)
+from models import (
+    Cart,
+    CartItem,
+    Category,
+    Order,
+    OrderItem,
+    Product,
+    StockReservation,
+    User,
+)
+from search import search_products
+
+UserQ = User.__sqlmodel__
+CartQ = Cart.__sqlmodel__
+CartItemQ = CartItem.__sqlmodel__
+OrderQ = Order.__sqlmodel__
+OrderItemQ = OrderItem.__sqlmodel__
+ProductQ = Product.__sqlmodel__
+ReservationQ = StockReservation.__sqlmodel__
+
+HOT_QUERIES = {
+    "login": select(UserQ).where(UserQ.email == "a@example.com"),
+    "cart": select(CartQ).where(CartQ.user_id == 1),
+    "cart_item": select(CartItemQ).where(
+        CartItemQ.cart_id == 1, CartItemQ.product_id == 1
+    ),
+    "webhook": select(OrderQ).where(OrderQ.payment_intent_id == "pi_1"),
+    "order_items": select(OrderItemQ).where(OrderItemQ.order_id == 1),
+    "category": select(ProductQ).where(ProductQ.category_id == 1),
+    "products_by_price": select(ProductQ).order_by(ProductQ.price, ProductQ.id),
+    "expired_reservations": select(ReservationQ.order_id).where(
+        ReservationQ.status == "held", ReservationQ.expires_at <= "2024-01-01"
+    ),
+}
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_db_engine(f"sqlite:///{tmp_path / 'schema.db'}")
+    yield engine
+    engine.dispose()
+
+
+def index_names(engine):
+    inspector = inspect(engine)
+    return {
+        index["name"]
+        for table in inspector.get_table_names()
+        for index in inspector.get_indexes(table)
+    }
+
+
+def test_upgrade_indexes_an_existing_database(engine):
+    # A database created before the indexes were declared
+    SQLModel.metadata.create_all(engine)
+    with engine.begin() as conn:
+        for name in index_names(engine):
+            conn.execute(text(f"DROP INDEX {name}"))
+
+    assert upgrade(engine) == [version for version, _, _ in MIGRATIONS]
+    expected = {
+        index.name
+        for table in SQLModel.metadata.tables.values()
+        for index in table.indexes
+    }
+    assert expected <= index_names(engine)
+    assert upgrade(engine) == []
+
+
+def test_duplicate_emails_stop_the_upgrade(engine):
+    SQLModel.metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(text("DROP INDEX ix_users_email"))
+        for _ in range(2):
+            conn.execute(
+                UserQ.__table__.insert().values(
+                    email="twice@example.com", hashed_password="x", is_admin=False
+                )
+            )
+
+    with pytest.raises(MigrationError, match="'twice@example.com' \\(2 rows\\)"):
+        upgrade(engine)
+    assert 1 not in applied_versions(engine)
+
+
+def test_upgrade_indexes_existing_products_for_search(engine):
+    # Products written before the full-text index existed
+    SQLModel.metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(text("DROP TABLE products_fts"))
+        for trigger in ("insert", "delete", "update"):
+            conn.execute(text(f"DROP TRIGGER products_fts_{trigger}"))
+    with Session(engine) as db:
+        db.add(Category.__sqlmodel__(name="Tools", description="Tools"))
+        db.commit()
+        db.add(
+            ProductQ(
+                name="Claw Hammer",
+                description="Steel",
+                price=9.5,
+                stock=3,
+                category_id=1,
+            )
+        )
+        db.commit()
+
+    upgrade(engine)
+    with Session(engine) as db:
+        assert [p.name for p in search_products(db, "hamm")] == ["Claw Hammer"]
+        db.query(ProductQ).update({"name": "Sledgehammer"})
+        db.commit()
+        assert search_products(db, "claw") == []
+        assert [p.name for p in search_products(db, "sledge")] == ["Sledgehammer"]
+
+
+def test_upgrade_fills_in_cart_totals(engine):
+    # A carts table from before the totals columns
+    SQLModel.metadata.create_all(engine)
+    with Session(engine) as db:
+        db.add(Category.__sqlmodel__(name="Tools", description="Tools"))
+        db.add(UserQ(email="a@example.com", hashed_password="!"))
+        db.commit()
+        db.add(ProductQ(name="Nail", description="", price=0.5, stock=9, category_id=1))
+        db.add(CartQ(user_id=1))
+        db.commit()
+        db.add(CartItemQ(cart_id=1, product_id=1, quantity=3))
+        db.commit()
+    with engine.begin() as conn:
+        conn.execute(text("ALTER TABLE carts DROP COLUMN subtotal"))
+        conn.execute(text("ALTER TABLE carts DROP COLUMN item_count"))
+
+    upgrade(engine)
+    with Session(engine) as db:
+        cart = db.get(CartQ, 1)
+        assert (cart.subtotal, cart.item_count) == (1.5, 3)
+
+
+@pytest.mark.parametrize("name", HOT_QUERIES)
+def test_hot_query_uses_an_index(engine, name):
+    upgrade(engine)
+    sql = HOT_QUERIES[name].compile(
+        dialect=engine.dialect, compile_kwargs={"literal_binds": True}
+    )
+    with engine.connect() as conn:
+        plan = [row[-1] for row in conn.execute(text(f"EXPLAIN QUERY PLAN {sql}"))]
+    assert any("USING" in step and "INDEX" in step for step in plan), plan
+
+
+def test_concurrent_startups_migrate_once(tmp_path):
+    url = f"sqlite:///{tmp_path / 'schema.db'}"
+    engines = [create_db_engine(url) for _ in range(4)]
+    assert not is_current(engines[0])
+
+    with ThreadPoolExecutor(len(engines)) as pool:
+        applied = list(pool.map(upgrade_once, engines))
+
+    # One worker applied everything; the rest waited and found it done
+    assert sorted(applied, key=len) == [[], [], [], [v for v, _, _ in MIGRATIONS]]
+    assert is_current(engines[0])
+    for engine in engines:
+        engine.dispose()
@@ -0,0 +1,30 @@
+import asyncio
+import time
+
+import pytest
+from fastapi import HTTPException
+
+from passwords import HashingPool
+
+
+def test_hashing_pool_rejects_when_full():
+    pool = HashingPool(executor="thread", workers=1, queue_depth=0)
+
+    async def storm():
+        return await asyncio.gather(
+            pool.run(time.sleep, 0.2), pool.run(time.sleep, 0.2), return_exceptions=True
+        )
+
+    results = asyncio.run(storm())
+    pool.shutdown()
+
+    errors = [r for r in results if isinstance(r, HTTPException)]
+    assert len(errors) == 1
+    assert errors[0].status_code == 503
+    assert pool.rejected == 1
+    assert pool.pending == 0
+
+
+def test_hashing_pool_rejects_unknown_executor():
+    with pytest.raises(ValueError):
+        HashingPool(executor="gpu")
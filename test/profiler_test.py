@@ -0,0 +1,102 @@
+import sys
+import threading
+import time
+from types import SimpleNamespace
+
+from profiler import SamplingProfiler, _request
+
+
+def spin(stop: threading.Event):
+    while not stop.is_set():
+        pass
+
+
+def wait_for_samples(profiler: SamplingProfiler):
+    deadline = time.monotonic() + 5
+    while profiler.samples < 3 and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+def test_stacks_are_collapsed_per_sampled_request():
+    profiler = SamplingProfiler(enabled=True, sample_rate=1.0, interval=0.001)
+    stop = threading.Event()
+
+    def handle_request():
+        frame = sys._getframe()
+        profiler.begin(frame, "POST", {"route": SimpleNamespace(path="/slow")})
+        try:
+            spin(stop)
+        finally:
+            profiler.end(frame)
+
+    request = threading.Thread(target=handle_request)
+    request.start()
+    wait_for_samples(profiler)
+    stop.set()
+    request.join()
+    profiler.stop()
+
+    lines = profiler.collapsed().splitlines()
+    assert lines
+    for line in lines:
+        stack, count = line.rsplit(" ", 1)
+        # Rooted at the route, below the request's own frame
+        assert stack.startswith("POST /slow;")
+        assert "handle_request" not in stack
+        assert int(count) >= 1
+    assert any(";spin (profiler_test.py" in line for line in lines)
+    assert profiler.collapsed("GET /other") == ""
+
+
+def test_worker_threads_are_attributed_to_their_request():
+    profiler = SamplingProfiler(enabled=True, sample_rate=1.0, interval=0.001)
+    stop = threading.Event()
+    frame = sys._getframe()
+    scope = {"route": SimpleNamespace(path="/cart")}
+    profiler.begin(frame, "GET", scope)
+
+    def worker(stop):
+        spin(stop)
+
+    token = _request.set(("GET", scope))
+    thread = threading.Thread(target=profiler.tagged(worker), args=(stop,))
+    _request.reset(token)
+    thread.start()
+    wait_for_samples(profiler)
+    stop.set()
+    thread.join()
+    profiler.end(frame)
+    profiler.stop()
+
+    assert "GET /cart;" in profiler.collapsed()
+    assert ";worker (profiler_test.py" in profiler.collapsed()
+
+
+def test_sync_endpoints_are_attributed_to_their_matched_route():
+    profiler = SamplingProfiler(enabled=True, sample_rate=1.0, interval=0.001)
+    stop = threading.Event()
+
+    def list_products(stop):
+        spin(stop)
+
+    # Routing stores the matched route in the scope once the request starts
+    frame = sys._getframe()
+    scope = {}
+    profiler.begin(frame, "GET", scope)
+    scope["route"] = SimpleNamespace(path="/products", endpoint=list_products)
+    # A threadpool thread, not started through tagged()
+    thread = threading.Thread(target=list_products, args=(stop,))
+    thread.start()
+    wait_for_samples(profiler)
+    stop.set()
+    thread.join()
+    profiler.end(frame)
+    profiler.stop()
+
+    assert ";list_products (profiler_test.py" in profiler.collapsed("GET /products")
+
+
+def test_disabled_profiler_samples_nothing():
+    profiler = SamplingProfiler(enabled=False, sample_rate=1.0)
+    assert not profiler.should_sample()
+    assert profiler.tagged(spin) is spin
@@ -0,0 +1,253 @@
+import datetime
+
+import pytest
+from fastapi import HTTPException
+from sqlalchemy import func, select, text
+from sqlalchemy.orm import sessionmaker
+from sqlmodel import SQLModel
+
+import inventory
+import sharding
+import webhooks
+from cart_store import SQLCartStore
+from db import RoutingSession, ShardNotSelected, create_db_engine
+from migrations import upgrade_shards
+from models import Cart, Category, Order, Product, User
+from routes.cart import _confirm_order, _reserve_cart
+from sharding import ORDER_ID_SPAN, ShardMap, jump_hash, user_shards
+
+SHARDS = 3
+# Spread over every shard, see test_users_spread_out()
+USERS = range(1, 13)
+
+
+@pytest.fixture
+def shards(tmp_path):
+    """
+    A global database with two products and the users, SHARDS shards in use
+    and a spare one to grow into.
+    """
+    global_engine = create_db_engine(f"sqlite:///{tmp_path / 'global.db'}")
+    SQLModel.metadata.create_all(global_engine)
+    engines = [
+        create_db_engine(f"sqlite:///{tmp_path / f'shard{k}.db'}") for k in range(4)
+    ]
+    SessionLocal = sessionmaker(
+        bind=global_engine, autoflush=False, class_=RoutingSession
+    )
+    with SessionLocal() as db:
+        category = Category.__sqlmodel__(name="Tools", description="Tools")
+        db.add(category)
+        db.commit()
+        for name, price in (("Hammer", 10.0), ("Saw", 25.0)):
+            db.add(
+                Product.__sqlmodel__(
+                    name=name,
+                    description=name,
+                    price=price,
+                    stock=100,
+                    category_id=category.id,
+                )
+            )
+        for user_id in USERS:
+            db.add(
+                User.__sqlmodel__(
+                    id=user_id, email=f"user{user_id}@example.com", hashed_password="x"
+                )
+            )
+        db.commit()
+
+    shard_map = ShardMap(engines[:SHARDS], global_engine, cache_seconds=0.05)
+    sharding.enable(shard_map)
+    upgrade_shards(shard_map)
+    yield SessionLocal, shard_map, engines
+    sharding.disable()
+    for engine in [global_engine, *engines]:
+        engine.dispose()
+
+
+def count(engine, model, user_id) -> int:
+    table = model.__sqlmodel__
+    with engine.connect() as conn:
+        return conn.execute(
+            select(func.count()).select_from(table).where(table.user_id == user_id)
+        ).scalar()
+
+
+def fill_cart(SessionLocal, user_id, quantities={1: 2, 2: 1}):
+    store = SQLCartStore()
+    with SessionLocal() as db:
+        for product_id, quantity in quantities.items():
+            price = 10.0 if product_id == 1 else 25.0
+            store.add_item(db, user_id, product_id, quantity, price)
+
+
+def checkout(SessionLocal, user_id) -> int:
+    fill_cart(SessionLocal, user_id)
+    with SessionLocal() as db:
+        order_id, _, _ = _reserve_cart(db, user_id)
+        SQLCartStore().clear(db, user_id)
+        db.commit()
+    fill_cart(SessionLocal, user_id, {2: 3})
+    return order_id
+
+
+def test_jump_hash_moves_only_keys_to_the_new_shard():
+    moved = [key for key in range(10000) if jump_hash(key, 4) != jump_hash(key, 5)]
+    assert all(jump_hash(key, 5) == 4 for key in moved)
+    assert 1700 < len(moved) < 2300
+    assert [jump_hash(key, 1) for key in range(5)] == [0] * 5
+
+
+def test_users_spread_out():
+    assert {jump_hash(user_id, SHARDS) for user_id in USERS} == set(range(SHARDS))
+
+
+def test_carts_and_orders_live_on_the_users_shard(shards):
+    SessionLocal, shard_map, engines = shards
+    order_ids = {user_id: checkout(SessionLocal, user_id) for user_id in USERS}
+
+    for user_id, order_id in order_ids.items():
+        home = shard_map.home(user_id)
+        for shard in range(SHARDS):
+            expected = 1 if shard == home else 0
+            assert count(engines[shard], Cart, user_id) == expected
+            assert count(engines[shard], Order, user_id) == expected
+        # Each shard numbers its orders in its own range
+        assert shard_map.shard_for_order(order_id) == home
+        assert (home + 1) * ORDER_ID_SPAN <= order_id < (home + 2) * ORDER_ID_SPAN
+
+    # Nothing was written to the global copies of the tables
+    assert count(shard_map.global_engine, Order, 1) == 0
+    with SessionLocal() as db:
+        assert db.get(Product.__sqlmodel__, 1).stock == 100 - 2 * len(USERS)
+        assert SQLCartStore().get_totals(db, 5)[1:] == (75.0, 3)
+        assert b'"quantity":3' in SQLCartStore().get_json(db, 5)
+        assert sharding.route_to_order(db, order_ids[7])
+        assert db.get(Order.__sqlmodel__, order_ids[7]).user_id == 7
+        assert not sharding.route_to_order(db, order_ids[7] + 1000)
+
+
+def test_sharded_tables_need_a_route(shards):
+    SessionLocal, _, _ = shards
+    with SessionLocal() as db:
+        with pytest.raises(ShardNotSelected):
+            db.query(Cart.__sqlmodel__).count()
+        # Global tables don't
+        assert db.query(Product.__sqlmodel__).count() == 2
+
+
+def test_payments_and_expiry_find_the_order(shards):
+    SessionLocal, _, _ = shards
+    paid_id = checkout(SessionLocal, 1)
+    abandoned_id = checkout(SessionLocal, 2)
+    with SessionLocal() as db:
+        _confirm_order(db, 1, paid_id, "pi_1")
+    event = {"data": {"object": {"id": "pi_1", "object": "payment_intent"}}}
+    with SessionLocal() as db:
+        webhooks._mark_order_paid(db, event)
+        db.commit()
+
+    later = datetime.datetime.utcnow() + datetime.timedelta(days=1)
+    with SessionLocal() as db:
+        assert inventory.release_expired(db, now=later) == 1
+    with SessionLocal() as db:
+        statuses = {}
+        for user_id, order_id in ((1, paid_id), (2, abandoned_id)):
+            sharding.route(db, user_id)
+            statuses[order_id] = db.get(Order.__sqlmodel__, order_id).status
+        assert statuses == {paid_id: "paid", abandoned_id: "expired"}
+
+
+def test_reprice_reaches_every_shard(shards):
+    SessionLocal, _, _ = shards
+    for user_id in USERS:
+        fill_cart(SessionLocal, user_id)
+    store = SQLCartStore()
+    with SessionLocal() as db:
+        store.reprice(db, 1, 10.0, 12.0)
+        db.commit()
+        assert {store.get_totals(db, user_id)[1] for user_id in USERS} == {49.0}
+
+
+def test_admin_listing_merges_the_shards(shards):
+    SessionLocal, _, _ = shards
+    order_ids = [checkout(SessionLocal, user_id) for user_id in USERS]
+
+    with SessionLocal() as db:
+        first = sharding.list_orders(db, limit=5)
+        assert [order.id for order in first] == order_ids[::-1][:5]
+        last = first[-1]
+        rest = sharding.list_orders(db, before=(last.created_at, last.id), limit=20)
+        assert [order.id for order in rest] == order_ids[::-1][5:]
+        assert [o.id for o in sharding.list_orders(db, user_id=4)] == [order_ids[3]]
+        assert sharding.list_orders(db, status="paid") == []
+
+
+def test_move_user_keeps_their_rows(shards):
+    SessionLocal, shard_map, engines = shards
+    user_id = 1
+    order_id = checkout(SessionLocal, user_id)
+    with SessionLocal() as db:
+        cart = SQLCartStore().get_json(db, user_id)
+    home = shard_map.home(user_id)
+    target = (home + 1) % SHARDS
+
+    assert sharding.move_user(user_id, target, grace=0)
+    assert count(engines[home], Cart, user_id) == 0
+    assert count(engines[home], Order, user_id) == 0
+    assert shard_map.shard_for_user(user_id) == target
+    with SessionLocal() as db:
+        assert SQLCartStore().get_json(db, user_id) == cart
+        assert sharding.route_to_order(db, order_id)
+        order = db.get(Order.__sqlmodel__, order_id)
+        assert [item.quantity for item in order.items] == [2, 1]
+
+    # The moved order didn't change where the target numbers its orders
+    new_order_id = checkout(SessionLocal, user_id)
+    assert shard_map.shard_for_order(new_order_id) == target
+
+    # Moving home drops the directory entry
+    assert sharding.move_user(user_id, home, grace=0)
+    with shard_map.global_engine.connect() as conn:
+        assert conn.execute(select(func.count()).select_from(user_shards)).scalar() == 0
+    assert count(engines[target], Order, user_id) == 0
+    assert count(engines[home], Order, user_id) == 2
+
+
+def test_a_moving_user_gets_a_503(shards):
+    SessionLocal, shard_map, _ = shards
+    with shard_map.global_engine.begin() as conn:
+        conn.execute(user_shards.insert().values(user_id=2, shard=0, moving_to=1))
+
+    with SessionLocal() as db, pytest.raises(HTTPException) as e:
+        SQLCartStore().get(db, 2)
+    assert e.value.status_code == 503
+    assert e.value.headers["Retry-After"] == "1"
+    # Other users are unaffected
+    fill_cart(SessionLocal, 3)
+
+
+def test_adding_a_shard_pins_then_rebalances(shards):
+    SessionLocal, shard_map, engines = shards
+    order_ids = {user_id: checkout(SessionLocal, user_id) for user_id in USERS}
+    moving = [u for u in USERS if jump_hash(u, SHARDS + 1) != jump_hash(u, SHARDS)]
+    assert moving
+
+    assert sharding.pin(SHARDS + 1) == len(moving)
+    grown = ShardMap(engines, shard_map.global_engine, cache_seconds=0.05)
+    sharding.enable(grown)
+    upgrade_shards(grown)
+    # Still served from where they were
+    with SessionLocal() as db:
+        for user_id in USERS:
+            assert SQLCartStore().get_totals(db, user_id)[1:] == (75.0, 3)
+
+    assert sharding.rebalance(grace=0) == len(moving)
+    for user_id in moving:
+        assert count(engines[SHARDS], Order, user_id) == 1
+    with SessionLocal() as db:
+        for user_id, order_id in order_ids.items():
+            assert SQLCartStore().get_totals(db, user_id)[1:] == (75.0, 3)
+            assert sharding.route_to_order(db, order_id)
+        assert db.execute(text("SELECT count(*) FROM user_shards")).scalar() == 0
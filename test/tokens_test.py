@@ -0,0 +1,26 @@
+import time
+
+import pytest
+
+from tokens import RevocationList, RevocationListFull
+
+
+def test_revocations_are_kept_until_the_token_expires():
+    revoked = RevocationList(maxsize=2)
+    revoked.add("a", time.time() + 60)
+    revoked.add("b", time.time() + 0.05)
+    assert "a" in revoked and "b" in revoked
+
+    # Full: nothing is evicted to make room
+    with pytest.raises(RevocationListFull):
+        revoked.add("c", time.time() + 60)
+    assert "a" in revoked and "b" in revoked
+
+    # Expired revocations free their slot
+    time.sleep(0.1)
+    assert "b" not in revoked
+    revoked.add("c", time.time() + 60)
+    assert "a" in revoked and "c" in revoked
+    assert len(revoked) == 2
+    # Revoking again doesn't take another slot
+    revoked.add("a", time.time() + 60)
@@ -0,0 +1,143 @@
+import datetime
+
+import pytest
+from sqlalchemy.orm import sessionmaker
+from sqlmodel import SQLModel
+
+import webhooks
+from app.config import app_config
+from db import create_db_engine
+from models import Order, WebhookEvent
+
+WebhookEventQ = WebhookEvent.__sqlmodel__
+
+
+@pytest.fixture
+def SessionLocal(tmp_path):
+    engine = create_db_engine(f"sqlite:///{tmp_path / 'webhooks.db'}")
+    SQLModel.metadata.create_all(engine)
+    yield sessionmaker(bind=engine)
+    engine.dispose()
+
+
+def event(event_id, intent, type="payment_intent.processing"):
+    return {"id": event_id, "type": type, "data": {"object": {"id": intent}}}
+
+
+def test_duplicate_deliveries_are_recorded_once(SessionLocal):
+    with SessionLocal() as db:
+        assert webhooks.record_event(db, event("evt_1", "pi_1"))
+        assert not webhooks.record_event(db, event("evt_1", "pi_1"))
+        assert db.query(WebhookEventQ).count() == 1
+
+
+def test_events_for_one_intent_run_in_order(SessionLocal, monkeypatch):
+    seen = []
+    monkeypatch.setitem(
+        webhooks.HANDLERS,
+        "payment_intent.processing",
+        lambda db, e: seen.append(e["id"]),
+    )
+    with SessionLocal() as db:
+        for event_id, intent in [("a1", "pi_a"), ("b1", "pi_b"), ("a2", "pi_a")]:
+            webhooks.record_event(db, event(event_id, intent))
+
+        # While a1 is being processed, a2 waits but b1 can run
+        first = webhooks.claim_next(db, lease_seconds=60)
+        second = webhooks.claim_next(db, lease_seconds=60)
+        assert [db.get(WebhookEventQ, i).event_id for i in (first, second)] == [
+            "a1",
+            "b1",
+        ]
+        assert webhooks.claim_next(db, lease_seconds=60) is None
+
+        webhooks.process(db, first)
+        webhooks.process(db, second)
+        assert webhooks.drain(SessionLocal) == 1
+    assert seen == ["a1", "b1", "a2"]
+
+
+def test_failures_back_off_then_give_up(SessionLocal, monkeypatch):
+    def flaky(db, e):
+        raise RuntimeError("gateway timeout")
+
+    monkeypatch.setitem(webhooks.HANDLERS, "payment_intent.processing", flaky)
+    monkeypatch.setattr(app_config, "STRIPE_WEBHOOK_MAX_ATTEMPTS", 3)
+    with SessionLocal() as db:
+        webhooks.record_event(db, event("evt_1", "pi_1"))
+        webhooks.record_event(db, event("evt_2", "pi_1"))
+        for attempt in range(1, 4):
+            # evt_2 waits behind evt_1 until evt_1 gives up on the last attempt
+            assert webhooks.drain(SessionLocal) == (1 if attempt < 3 else 2)
+            db.expire_all()
+            failing = db.query(WebhookEventQ).filter_by(event_id="evt_1").one()
+            assert failing.attempts == attempt
+            if attempt < 3:
+                # Not retried before its backoff
+                assert failing.status == webhooks.PENDING
+                assert webhooks.drain(SessionLocal) == 0
+                failing.next_attempt_at = datetime.datetime.utcnow()
+                db.commit()
+
+        assert failing.status == webhooks.FAILED
+        assert "gateway timeout" in failing.last_error
+        assert db.query(WebhookEventQ).filter_by(event_id="evt_2").one().attempts == 1
+
+
+def test_expired_lease_is_reclaimed(SessionLocal):
+    with SessionLocal() as db:
+        webhooks.record_event(db, event("evt_1", "pi_1"))
+        claimed = webhooks.claim_next(db, lease_seconds=0)
+        assert webhooks.release_expired_leases(db) == 1
+        assert webhooks.claim_next(db, lease_seconds=60) == claimed
+        assert webhooks.release_expired_leases(db) == 0
+
+
+def test_payment_before_checkout_links_the_intent_is_retried(SessionLocal):
+    OrderQ = Order.__sqlmodel__
+    with SessionLocal() as db:
+        webhooks.record_event(
+            db, event("evt_1", "pi_late", type="payment_intent.succeeded")
+        )
+        assert webhooks.drain(SessionLocal) == 1
+        pending = db.query(WebhookEventQ).one()
+        assert pending.status == webhooks.PENDING
+        assert "OrderNotFound" in pending.last_error
+
+        # Checkout records the intent, then the retry finds the order
+        order = OrderQ(
+            user_id=1,
+            status="pending",
+            total_amount=10.0,
+            payment_intent_id="pi_late",
+            payment_intent_status="pending",
+        )
+        db.add(order)
+        pending.next_attempt_at = datetime.datetime.utcnow()
+        db.commit()
+        assert webhooks.drain(SessionLocal) == 1
+        db.expire_all()
+        assert db.query(WebhookEventQ).one().status == webhooks.DONE
+        assert db.get(OrderQ, order.id).status == "paid"
+
+
+def test_payment_finds_its_order_through_the_metadata(SessionLocal):
+    OrderQ = Order.__sqlmodel__
+    with SessionLocal() as db:
+        order = OrderQ(
+            user_id=1,
+            status="pending",
+            total_amount=10.0,
+            payment_intent_status="pending",
+        )
+        db.add(order)
+        db.commit()
+        paid = event("evt_1", "pi_early", type="payment_intent.succeeded")
+        paid["data"]["object"]["metadata"] = {"user_id": "1", "order_id": str(order.id)}
+        webhooks.record_event(db, paid)
+
+        assert webhooks.drain(SessionLocal) == 1
+        db.expire_all()
+        assert db.query(WebhookEventQ).one().status == webhooks.DONE
+        order = db.get(OrderQ, order.id)
+        assert (order.status, order.payment_intent_id) == ("paid", "pi_early")